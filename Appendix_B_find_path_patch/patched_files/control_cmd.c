@@ -721,35 +721,88 @@ static const control_cmd_syntax_t extendcircuit_syntax = {
 };
 
 
+/** Largest number of paths a single FINDPATH may ask for. Every path is an
+ * origin circuit that is only freed when the main loop runs again, so the
+ * count is capped; ask again for more paths. */
+#define FINDPATH_MAX_COUNT 10000
+
 static const control_cmd_syntax_t findpath_syntax = {
     .min_args = 0,
-    .max_args = 0,
+    .max_args = 1,
+    .accept_keywords = true,
+    .kvline_flags = KV_OMIT_VALS,
 };
 
-
-/** Called when we get a FINDPATH message. Find a path but do not establish 
- * a circuit. */
-static int
-handle_control_findpath(control_connection_t *conn, const control_cmd_args_t *args)
+/** Find one path as circuit_establish_circuit() would, without building
+ * it. Return the path in $DIGEST~Name form, or NULL if no path was found. */
+static char *
+findpath_pick_path(void)
 {
   origin_circuit_t *circ = NULL;
-  char *vpath;
-  (void)args;
+  char *vpath = NULL;
 
-  // Find a path. (see circuit_establish_circuit())
   circ = origin_circuit_init(CIRCUIT_PURPOSE_C_GENERAL, CIRCLAUNCH_NEED_CAPACITY);
-  if (onion_pick_cpath_exit(circ, NULL, 0) < 0 || 
+  if (onion_pick_cpath_exit(circ, NULL, 0) < 0 ||
       onion_populate_cpath(circ) < 0) {
     circuit_mark_for_close(TO_CIRCUIT(circ), END_CIRC_REASON_NOPATH);
-    connection_write_str_to_buf("551 Couldn't find a path.\r\n", conn);
   } else {
     vpath = circuit_list_path_impl(circ, 1, 1);
     circuit_mark_for_close(TO_CIRCUIT(circ), END_CIRC_REASON_NONE);
     circuit_reset_failure_count(0);
     //router_set_status(circ->cpath->extend_info->identity_digest, 1);
-    connection_printf_to_buf(conn, "250 PATH %s \r\n", vpath);
-    tor_free(vpath);
   }
+  return vpath;
+}
+
+/** Called when we get a FINDPATH message. Find paths but do not establish
+ * circuits.
+ *
+ * "FINDPATH" replies with a single "250 PATH <path>" line, as before.
+ * "FINDPATH <count> [FRESHGUARDS]" replies with one "250-PATH <path>" line
+ * per path, or "250-NOPATH" when no path was found, followed by "250 OK".
+ * With FRESHGUARDS the entry guards are dropped before every path, like
+ * sending DROPGUARDS before each FINDPATH. FRESHGUARDS needs a count, since
+ * the first argument is always parsed as the count: use "FINDPATH 1
+ * FRESHGUARDS" for a single path with fresh guards. */
+static int
+handle_control_findpath(control_connection_t *conn, const control_cmd_args_t *args)
+{
+  char *vpath;
+  int count = 1, ok = 1, i;
+  int fresh_guards = config_lines_contain_flag(args->kwargs, "FRESHGUARDS");
+
+  if (smartlist_len(args->args) == 0) {
+    // Single path reply, as expected by unbatched callers.
+    vpath = findpath_pick_path();
+    if (!vpath) {
+      connection_write_str_to_buf("551 Couldn't find a path.\r\n", conn);
+    } else {
+      connection_printf_to_buf(conn, "250 PATH %s \r\n", vpath);
+      tor_free(vpath);
+    }
+    return 0;
+  }
+
+  count = (int) tor_parse_long(smartlist_get(args->args, 0), 10, 1,
+                               FINDPATH_MAX_COUNT, &ok, NULL);
+  if (!ok) {
+    control_printf_endreply(conn, 512, "Path count must be between 1 and %d",
+                            FINDPATH_MAX_COUNT);
+    return 0;
+  }
+
+  for (i = 0; i < count; i++) {
+    if (fresh_guards)
+      remove_all_entry_guards();
+    vpath = findpath_pick_path();
+    if (!vpath) {
+      connection_write_str_to_buf("250-NOPATH\r\n", conn);
+    } else {
+      connection_printf_to_buf(conn, "250-PATH %s\r\n", vpath);
+      tor_free(vpath);
+    }
+  }
+  send_control_done(conn);
   return 0;
 }
 
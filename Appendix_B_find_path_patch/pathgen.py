@@ -31,6 +31,10 @@ import io
 import time
 import pycurl
 
+# Shared relay selection helpers in the repository root
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from relay_selection.findpath import find_paths
+
 
 def print_bootstrap_lines(line):
     if "Bootstrapped " in line:
@@ -99,6 +103,9 @@ CONNECTION_TIMEOUT = 120  # timeout before we give up on a circuit
 TOR_CONTROL_IP = "127.0.0.1"
 TOR_CONTROL_PORT = 9051
 
+# Paths fetched with one batched FINDPATH command
+NUM_PATHS = 5
+
 print(term.format("Starting Tor:\n", term.Attr.BOLD))
 
 tor_process = stem.process.launch_tor_with_config(
@@ -124,19 +131,10 @@ try:
         controller.authenticate()
 
 
-        # Change guard nodes for every path.
-        msg = controller.msg('DROPGUARDS')
-        assert msg.is_ok(), ("DUMPGUARDS command failed with error " +
-                            "'%s'. Is your tor client patched?\n" % str(msg))
-
-        # Get a path from tor.
-        msg = controller.msg('FINDPATH')
-        assert msg.is_ok(), ("FINDPATH command failed with error " +
-                            "'%s'. Is your tor client patched?\n" % str(msg))
-
-        relay_fingerprints = findall('[A-Z0-9]{40}', str(msg))
-        time_taken = scan(controller, relay_fingerprints)
-        print('%s => %0.2f seconds' % (relay_fingerprints, time_taken))
+        # Get NUM_PATHS paths from tor in one FINDPATH reply, with new guard nodes for every path.
+        for relay_fingerprints in find_paths(controller, NUM_PATHS, fresh_guards=True):
+            time_taken = scan(controller, relay_fingerprints)
+            print('%s => %0.2f seconds' % (relay_fingerprints, time_taken))
 
 
 
@@ -15,7 +15,7 @@ from socks import SOCKS5Error, PROXY_TYPE_SOCKS5, socksocket
 import requests
 import pycurl
 import io
-from math import radians, sin, cos, sqrt, atan2
+import numpy as np
 from re import findall
 import json
 
@@ -29,8 +29,17 @@ from stem import Signal
 from stem.control import Controller
 from stem.util import term
 
-# MaxMind imports
-import maxminddb
+# Shared relay selection helpers in the repository root
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from relay_selection.onionoo import ONIONOO_DETAILS_URL, ONIONOO_PARAMS
+from relay_selection.onionoo import get_cache as get_onionoo_cache
+from relay_selection.consensus import read_bandwidth_weights, read_cached_relays
+from relay_selection.table import RelayTable
+from relay_selection.pipeline import FilterPipeline
+from relay_selection.diff import enrich_table
+from relay_selection.findpath import find_paths
+from relay_selection.path_sampler import PathSampler, compare_with_findpath
+from relay_selection.snapshots import SnapshotStore, write_pools
 
 # --------------------- Constants ---------------------#
 # socks port for Tor and pycurl
@@ -45,6 +54,28 @@ TOR_CONTROL_PORT = 9051
 CLIENT_LAT = 61.1322
 CLIENT_LONG = 11.3716
 
+# Seconds a cached Onionoo document is used before it is revalidated (one consensus interval)
+ONIONOO_CACHE_MAX_AGE = 3600
+
+# MaxMind GeoLite database used to locate the relays
+GEOIP_DATABASE = "./GeoIPPlotter/GeoLite2-City20230428.mmdb"
+
+# Where the relay list comes from: "onionoo" for the Onionoo details document, or "consensus"
+# to build it offline from the consensus and descriptors Tor cached in TOR_DATA_DIRECTORY
+RELAY_SOURCE = "onionoo"
+TOR_DATA_DIRECTORY = os.path.expanduser("~/.tor")
+
+# Relay snapshots shared by all experiments, see relay_selection/snapshots.py
+SNAPSHOT_DIRECTORY = "./results/snapshots"
+
+# Where the paths come from: "sampler" draws them in Python with Tor's bandwidth weighting and
+# family and /16 exclusion (see relay_selection/path_sampler.py), "findpath" asks the patched
+# Tor for the paths with batched FINDPATH commands (see relay_selection/findpath.py)
+PATH_SOURCE = "sampler"
+
+# Number of FINDPATH paths compared with the sampler's distribution after an experiment, 0 skips it
+VALIDATION_PATHS = 0
+
 
 # --------------------- Main ---------------------#
 def main():
@@ -226,262 +257,15 @@ def map_ipv4_to_heatmap(relays, filename):
 
     # Run the python script that will map the IPv4 addresses to a heatmap
     os.system(
-        f"python3 ./GeoIPPlotter/geoipplotter.py -t heatmap --db ./GeoIPPlotter/GeoLite2-City_20230303.mmdb --input ./GeoIPPlotter/ipv4.txt -o ./GeoIPPlotter/heatmap_{filename}.png"
+        f"python3 ./GeoIPPlotter/geoipplotter.py -t heatmap --db {GEOIP_DATABASE} --input ./GeoIPPlotter/ipv4.txt -o ./GeoIPPlotter/heatmap_{filename}.png"
     )
     # Run the python script that will map the IPv4 addresses to a scatter map and zoom in on Europe
     os.system(
-        f'python3 ./GeoIPPlotter/geoipplotter.py -t scatter --db ./GeoIPPlotter/GeoLite2-City_20230303.mmdb --input ./GeoIPPlotter/ipv4.txt -o ./GeoIPPlotter/scattermap_{filename}.png -e " -12/45/30/65"'
+        f'python3 ./GeoIPPlotter/geoipplotter.py -t scatter --db {GEOIP_DATABASE} --input ./GeoIPPlotter/ipv4.txt -o ./GeoIPPlotter/scattermap_{filename}.png -e " -12/45/30/65"'
     )
 
     # Run the python script that will map the IPv4 addresses to a connection map
-    # os.system('python3 ./GeoIPPlotter/geoipplotter.py -t connectionmap --db ./GeoIPPlotter/GeoLite2-City_20230303.mmdb --input ./GeoIPPlotter/ipv4.txt -o ./GeoIPPlotter/connectionmap.png -d 11.3716/61.1322')
-
-
-def get_lat_long(relays):
-    """
-    Looks up the latitude and longitude for each relay's IPv4 address using maxmind GeoLite IP database. 
-    # Download updated database from https://www.maxmind.com/en/accounts/834180/geoip/downloads
-
-    Args:
-    - relays: a list of relays, where each relay is a dictionary returned from Tor Metrics
-    (https://metrics.torproject.org/onionoo.html)
-
-    Returns:
-    - a list of relays, where each relay dictionary now includes its latitude and longitude
-    """
-    with maxminddb.open_database(
-        "./GeoIPPlotter/GeoLite2-City20230428.mmdb"
-        #"./GeoIPPlotter/GeoLite2-City_20230303.mmdb"
-    ) as reader:
-        for relay in relays:
-            address = relay["ipv4_address"]
-            data = reader.get(address)
-            if data != None:
-                try:
-                    relay["latitude"] = data["location"]["latitude"]
-                    relay["longitude"] = data["location"]["longitude"]
-                except:
-                    pass
-    return relays
-
-
-def calc_distance(relays):
-    """
-    Calculates the distance between the client and each relay based on latitude and longitude.
-
-    Args:
-    - relays: a list of relays, where each relay is a dictionary returned from Tor Metrics
-    (https://metrics.torproject.org/onionoo.html)
-
-    Returns:
-    - a list of relays, where each relay dictionary includes its distance from the client
-    """
-    # Earth's radius in kilometers
-    R = 6373.0
-
-    for relay in relays:
-        try:
-            # Convert to radians
-            lat1 = radians(CLIENT_LAT)
-            lon1 = radians(CLIENT_LONG)
-            lat2 = radians(relay["latitude"])
-            lon2 = radians(relay["longitude"])
-
-            # Calculate the distance
-            dlon = lon2 - lon1
-            dlat = lat2 - lat1
-            a = sin(dlat / 2) ** 2 + cos(lat1) * cos(lat2) * sin(dlon / 2) ** 2
-            c = 2 * atan2(sqrt(a), sqrt(1 - a))
-
-            # Return the distance in kilometers
-            distance = R * c
-            relay["distance"] = distance
-        except:
-            relay["distance"] = float("inf")
-    return relays
-
-
-def sort_relay_distances(relays):
-    """
-    Sorts relays by their distance from the client.
-
-    Args:
-    - relays: a list of relays, where each relay is a dictionary returned from Tor Metrics
-    (https://metrics.torproject.org/onionoo.html)
-
-    Returns:
-    - a sorted list of relays by distance
-    """
-    sorted_relays = sorted(
-        relays, key=lambda relay: relay.get("distance", float("inf"))
-    )
-    return sorted_relays
-
-
-def filter_out_high_distance_relays(relays, distance_threshold):
-    """
-    Filters out relays with high distance.
-
-    Args:
-    - relays: a list of relays, where each relay is a dictionary returned from Tor Metrics
-    (https://metrics.torproject.org/onionoo.html)
-    - distance_threshold: a float representing the percentage of relays to be filtered out, based on distance
-
-    Returns:
-    - a list of relays, where the top distance_threshold percentage of relays have been filtered out
-    """
-
-    def remove_high_distance_relays(relays, distance_threshold):
-        cutoff = int(len(relays) * (1 - distance_threshold))
-        return relays[:cutoff]
-
-    filtered_relays = remove_high_distance_relays(relays, distance_threshold)
-    return filtered_relays
-
-
-def sort_relays_by_bandwidth(entry_pool, middle_pool, exit_pool):
-    """
-    Sorts the relays in each pool by bandwidth.
-
-    Args:
-    - entry_pool: a list of entry relays
-    - middle_pool: a list of middle relays
-    - exit_pool: a list of exit relays
-
-    Returns:
-    - a tuple of three sorted lists of relays (one for each pool)
-
-    """
-    # Sort the relays in each pool by bandwidth
-    sorted_entry_pool = sorted(
-        entry_pool, key=lambda relay: relay["observed_bandwidth"], reverse=True
-    )
-    sorted_middle_pool = sorted(
-        middle_pool, key=lambda relay: relay["observed_bandwidth"], reverse=True
-    )
-    sorted_exit_pool = sorted(
-        exit_pool, key=lambda relay: relay["observed_bandwidth"], reverse=True
-    )
-
-    return sorted_entry_pool, sorted_middle_pool, sorted_exit_pool
-
-def categorize_relays(relays):
-    """
-    Categorizes relays into entry, middle, and exit pools based on their flags.
-    
-    Args:
-    - relays (list): a list of relays, where each relay is a dictionary returned from Tor Metrics
-    
-    Returns:
-    - entry_pool (list): A list of relay dictionaries categorized as entry relays.
-    - middle_pool (list): A list of relay dictionaries categorized as middle relays.
-    - exit_pool (list): A list of relay dictionaries categorized as exit relays.
-    """
-    entry_pool = []
-    middle_pool = []
-    exit_pool = []
-
-    for relay in relays:
-        flags = relay.get("flags", [])
-        # If the relay has the 'Guard' flag and not the 'Exit' flag, it's an entry relay
-        if "Guard" in flags:
-            entry_pool.append(relay)
-        # If the relay has the 'Exit' flag and not the 'Guard' flag, it's an exit relay
-        elif "Exit" in flags:
-            exit_pool.append(relay)
-        # If the relay has neither the 'Guard' nor the 'Exit' flag, it's a middle relay
-        else:
-            middle_pool.append(relay)
-
-    return entry_pool, middle_pool, exit_pool
-
-
-def filter_based_on_flags(relays):
-    """
-    Filters the relays based on the presence of the 'Fast' flag.
-    
-    Args:
-    - relays (list): a list of relays, where each relay is a dictionary returned from Tor Metrics
-    
-    Returns:
-    - fast_relays (list): A list of relay dictionaries that have the 'Fast' flag.
-    """
-    fast_relays = []
-    for relay in relays:
-        flags = relay.get("flags", [])
-        if "Fast" in flags:
-            fast_relays.append(relay)
-
-    return fast_relays
-
-
-def filter_out_low_bandwidth_relays(
-    entry_pool, middle_pool, exit_pool, relay_bandwidth_cutoff
-):
-    """
-    Filters out relays with low bandwidth.
-
-    Args:
-    - entry_pool: a list of entry relays
-    - middle_pool: a list of middle relays
-    - exit_pool: a list of exit relays
-    - relay_bandwidth_cutoff: a float representing the percentage of relays to be filtered out, based on bandwidth
-
-    Returns:
-    - a tuple of three lists of relays (one for each pool: entry, middle, and exit)
-    """
-
-    # Helper function to apply the cutoff
-    def apply_cutoff(pool, cutoff):
-        cutoff_index = int(len(pool) * (1 - cutoff))
-        return pool[:cutoff_index]
-
-    # Apply the cutoff to each pool
-    filtered_entry_pool = apply_cutoff(entry_pool, relay_bandwidth_cutoff)
-    filtered_middle_pool = apply_cutoff(middle_pool, relay_bandwidth_cutoff)
-    filtered_exit_pool = apply_cutoff(exit_pool, relay_bandwidth_cutoff)
-
-    return filtered_entry_pool, filtered_middle_pool, filtered_exit_pool
-
-
-def filter_by_overload_general_timestamp(entry_pool, middle_pool, exit_pool, overload):
-    """
-    Filters out relays that have a too recent overload_general_timestamp.
-
-    Args:
-    - entry_pool: a list of entry relays
-    - middle_pool: a list of middle relays
-    - exit_pool: a list of exit relays
-    - overload: an integer representing the number of hours to filter out recent overload_general_timestamps
-
-    Returns:
-    - a tuple of three lists of relays (one for each pool: entry, middle, and exit)
-
-    """
-
-    # Filters a single relay pool based on the specified overload threshold.
-    def filter_pool_overload(pool, overload):
-        filtered_pool = []
-        for relay in pool:
-            if "overload_general_timestamp" in relay:
-                current_time_millis = int(round(time.time() * 1000))
-                current_time = datetime.datetime.fromtimestamp(
-                    current_time_millis / 1000
-                )
-                X_hour_ago = current_time - datetime.timedelta(hours=overload)
-                time_filter = int(round(X_hour_ago.timestamp() * 1000))
-
-                if relay["overload_general_timestamp"] <= time_filter:
-                    filtered_pool.append(relay)
-            else:
-                filtered_pool.append(relay)
-        return filtered_pool
-
-    filtered_entry_pool = filter_pool_overload(entry_pool, overload)
-    filtered_middle_pool = filter_pool_overload(middle_pool, overload)
-    filtered_exit_pool = filter_pool_overload(exit_pool, overload)
-
-    return filtered_entry_pool, filtered_middle_pool, filtered_exit_pool
+    # os.system(f'python3 ./GeoIPPlotter/geoipplotter.py -t connectionmap --db {GEOIP_DATABASE} --input ./GeoIPPlotter/ipv4.txt -o ./GeoIPPlotter/connectionmap.png -d 11.3716/61.1322')
 
 
 # --------------------- EXPERIMENT functions ---------------------#
@@ -570,32 +354,25 @@ def measure_circuit_rtt(controller, circuit_id):
     return rtt
 
 
-def measure_request(controller):
+def measure_request(controller, paths):
     """
     This function measures the time taken to fetch a URL using Tor while changing guard nodes for each request.
-    It first drops the current guard nodes, then obtains a new path from the Tor controller using its default algorithm.
+    It takes the next path from paths, which Tor found with its default algorithm after dropping the current guard nodes.
     Next, it creates a new circuit with the obtained path and collects various measurements related to RTT, latency, TTFB, and throughput.
 
     Args:
     - url (str): The URL to fetch.
     - controller: The Tor controller object.
     - start_time: The starting time to measure the request.
+    - paths: Generator of relay fingerprint paths, see relay_selection.findpath.find_paths().
 
     Returns:
     - dict: A dictionary containing the measurements if the request is successful, or an error message otherwise.
     The dictionary includes timestamp, total_time, rtt, latency, ttfb, throughput, circ_id, and circuit.
     """
 
-    # Change guard nodes for every path.
-    msg = controller.msg("DROPGUARDS")
-
-    # Get a path from the controller using Tor's default algorithm
-    msg = controller.msg("FINDPATH")
-    assert msg.is_ok(), (
-        "FINDPATH command failed with error "
-        + "'%s'. Is your tor client patched?\n" % str(msg)
-    )
-    relay_fingerprints = findall("[A-Z0-9]{40}", str(msg))
+    # Next path from Tor's default algorithm, found with fresh guard nodes in a batched FINDPATH
+    relay_fingerprints = next(paths)
 
 
     print("Relay fingerprints: %s" % relay_fingerprints)
@@ -629,69 +406,50 @@ def experiment(distance, bandwidth, overload, flags, NUM_REQUESTS, TIME, filenam
     TIME_START = datetime.datetime.now()
 
     # Make pools of relays
-    url = "https://onionoo.torproject.org/details"
-    params = {
-        "running": "true",
-        "fields": "or_addresses,nickname,fingerprint,flags,country,consensus_weight,observed_bandwidth,advertised_bandwidth,exit_policy",
-    }
-    response_entry = requests.get(url, params=params)
-    data = response_entry.json()
-    relays = data["relays"]
+    if RELAY_SOURCE == "consensus":
+        # Read from the consensus Tor cached during the previous run, no network round trip
+        relays = read_cached_relays(TOR_DATA_DIRECTORY)
+    else:
+        # Served from the shared on-disk cache, Onionoo is only asked again once the copy is stale.
+        # The document is streamed into compact records holding only the fields used below.
+        relays = get_onionoo_cache(max_age=ONIONOO_CACHE_MAX_AGE).get_relays(
+            ONIONOO_DETAILS_URL, ONIONOO_PARAMS
+        )
 
 
 
-    # Modify the relay list with distance information
-    relays = filter_out_ipv6(relays)
-    relays = get_lat_long(relays)
-    relays = calc_distance(relays)
+    # Store the relays in a columnar table, the pools below are arrays of row indices into it
+    table = RelayTable(relays)
 
-    # Save the total number of relays before filtering
-    TOTAL_NUM_RELAYS = len(relays)
+    # Modify the relay table with distance information. Locations are cached between runs, so
+    # only relays that joined or changed address since the previous run are looked up again.
+    snapshot_diff = enrich_table(table, GEOIP_DATABASE, CLIENT_LAT, CLIENT_LONG)
+    if snapshot_diff is not None:
+        print(snapshot_diff.summary())
 
+    # Save the total number of relays before filtering
+    TOTAL_NUM_RELAYS = len(table)
 
-    if distance != 0: 
-        relays = sort_relay_distances(relays)
-        relays = filter_out_high_distance_relays(relays, distance)
+    # Filter stages in the order distance -> flags -> bandwidth -> overload, a parameter of 0
+    # leaves its stage out. The stages only run when the rows or pools are requested, and their
+    # masks are memoized, so repeating a configuration on the same relays costs nothing.
+    relay_filter = FilterPipeline(table).distance(distance).fast_flag(flags)
+    pool_filter = relay_filter.bandwidth(bandwidth).overload(overload)
+    relays = relay_filter.rows()
 
     # Make plot before filtering
-    # map_ipv4_to_heatmap(relays, "before_filtering")
-
-    if flags != 0:
-        relays = filter_based_on_flags(relays)
-        entry_pool, middle_pool, exit_pool = categorize_relays(relays)
-    else:
-        entry_pool, middle_pool, exit_pool = categorize_relays(relays)
-        # Split relays dict into three lists
-
-
-    if bandwidth != 0:
-        entry_pool, middle_pool, exit_pool = sort_relays_by_bandwidth(
-            entry_pool, middle_pool, exit_pool
-        )
-        entry_pool, middle_pool, exit_pool = filter_out_low_bandwidth_relays(
-            entry_pool, middle_pool, exit_pool, bandwidth
-        )
+    # map_ipv4_to_heatmap(table.to_relays(relays), "before_filtering")
 
-    if overload != 0:
-        entry_pool, middle_pool, exit_pool = filter_by_overload_general_timestamp(
-            entry_pool, middle_pool, exit_pool, overload
-        )
+    # Split relay rows into three pools
+    entry_pool, middle_pool, exit_pool = pool_filter.pools()
 
     # Make plot before filtering
-    # map_ipv4_to_heatmap(entry_pool, "before_filtering_entry")
-    # map_ipv4_to_heatmap(middle_pool, "before_filtering_middle")
-    # map_ipv4_to_heatmap(exit_pool, "before_filtering_exit")
+    # map_ipv4_to_heatmap(table.to_relays(entry_pool), "before_filtering_entry")
+    # map_ipv4_to_heatmap(table.to_relays(middle_pool), "before_filtering_middle")
+    # map_ipv4_to_heatmap(table.to_relays(exit_pool), "before_filtering_exit")
 
 
-    # Get the top relay fingerprints
-    top_entries_fingerprint = [relay['fingerprint'] for relay in entry_pool]
-    top_middles_fingerprint = [relay['fingerprint'] for relay in middle_pool]
-    top_exits_fingerprint = [relay['fingerprint'] for relay in exit_pool]
-    ENTRY_FINGERPRINT = ",".join(top_entries_fingerprint)
-    MIDDLE_FINGERPRINT = ",".join(top_middles_fingerprint)
-    EXIT_FINGERPRINT = ",".join(top_exits_fingerprint)
-
-    # Start Tor with the given fingerprints
+    # Start Tor, the circuits are built from the pools below
     print(term.format("Starting Tor:\n", term.Attr.BOLD))
     tor_process = stem.process.launch_tor_with_config(
         config={
@@ -702,6 +460,7 @@ def experiment(distance, bandwidth, overload, flags, NUM_REQUESTS, TIME, filenam
             "FetchDirInfoEarly": "1",
             "FetchDirInfoExtraEarly": "1",
             "DownloadExtraInfo": "1",
+            "DataDirectory": TOR_DATA_DIRECTORY, # Keeps the cached consensus for RELAY_SOURCE = "consensus"
             "CircuitBuildTimeout": "60", # Set the timeout for circuit builds to 60 seconds.
             "LearnCircuitBuildTimeout": "0", #To keep circuit build timeouts static.
             #"EntryNodes": f"9BD0EE79BB9878DD6D8D8EA2A288D5E301E5C136,B4E3546B058FEB655A6D8698D97C1459A2DF8E77,8FB6DF980DAABE530944E29247DAE6E85CF3AB8F",
@@ -735,31 +494,52 @@ def experiment(distance, bandwidth, overload, flags, NUM_REQUESTS, TIME, filenam
             measurement = ""
             num_failed_circuits = 0
             i = 0
-            while i < NUM_REQUESTS:
-                # If previous measurement failed, adjust variables accordingly
-                if measurement == "error":
-                    i -= 1
-                    num_failed_circuits += 1
-
-                # Perform a measurement and store it if successful
-                measurement = measure_request(controller)
-                if measurement != "error":
-                    requests_measurements[i] = measurement
-
-                # Exit loop if too many failed circuits to prevent infinite loop
-                if num_failed_circuits > NUM_REQUESTS*1.5:
-                    print("Too many failed circuits. Exiting program")
-                    break
-
-                # Sleep for a specified time between requests
-                #print(f"Sleeping for {TIME} seconds")
-                #time.sleep(TIME)
-                i += 1
+
+            # Paths are fetched from Tor in batches, one FINDPATH per batch instead of per request
+            paths = find_paths(controller)
+
+            # Tor has the consensus cached in TOR_DATA_DIRECTORY by now, the sampler uses its weights
+            if PATH_SOURCE == "sampler" or VALIDATION_PATHS:
+                sampler = PathSampler(
+                    table, entry_pool, middle_pool, exit_pool, read_bandwidth_weights(TOR_DATA_DIRECTORY)
+                )
+            if PATH_SOURCE == "sampler":
+                for i, relay_fingerprints in enumerate(sampler.paths(NUM_REQUESTS)):
+                    requests_measurements[i] = {"circuit": relay_fingerprints}
+            else:
+                while i < NUM_REQUESTS:
+                    # If previous measurement failed, adjust variables accordingly
+                    if measurement == "error":
+                        i -= 1
+                        num_failed_circuits += 1
+
+                    # Perform a measurement and store it if successful
+                    measurement = measure_request(controller, paths)
+                    if measurement != "error":
+                        requests_measurements[i] = measurement
+
+                    # Exit loop if too many failed circuits to prevent infinite loop
+                    if num_failed_circuits > NUM_REQUESTS*1.5:
+                        print("Too many failed circuits. Exiting program")
+                        break
+
+                    # Sleep for a specified time between requests
+                    #print(f"Sleeping for {TIME} seconds")
+                    #time.sleep(TIME)
+                    i += 1
 
             TIME_END = datetime.datetime.now()
             # Make directory for the results
             os.makedirs(f"./results/{filename}", exist_ok=True)
 
+            # Check that the sampler draws paths the way the patched Tor does
+            if VALIDATION_PATHS:
+                findpath_paths = list(find_paths(controller, VALIDATION_PATHS))
+                validation = compare_with_findpath(sampler, findpath_paths)
+                print(f"Sampler against FINDPATH: {validation}")
+                with open(f"./results/{filename}/{filename}_validation.json", "w") as outfile:
+                    json.dump(validation, outfile, indent=4)
+
             # Save the results to a file in json format
             with open(f"./results/{filename}/{filename}.json", "w") as outfile:
                 json.dump(requests_measurements, outfile, indent=4)
@@ -783,17 +563,20 @@ def experiment(distance, bandwidth, overload, flags, NUM_REQUESTS, TIME, filenam
                 outfile.write("\n")
                 outfile.write(f"NUM_FAILED_CIRCUITS: {str(num_failed_circuits)}")
 
-            # Save relay object to a file
-            with open(f"./results/{filename}/{filename}_relays.json", "w") as outfile:
-                json.dump(relays, outfile)
-
-            # Save the entry, middle and exit pools to a file
-            with open(f"./results/{filename}/{filename}_entry_pool.json", "w") as outfile:
-                json.dump(entry_pool, outfile)
-            with open(f"./results/{filename}/{filename}_middle_pool.json", "w") as outfile:
-                json.dump(middle_pool, outfile)
-            with open(f"./results/{filename}/{filename}_exit_pool.json", "w") as outfile:
-                json.dump(exit_pool, outfile)
+            # Save the relay snapshot once under its content hash, and the filtered relays and
+            # the entry, middle and exit pools as row indices into it.
+            # python -m relay_selection.snapshots ./results/{filename} rebuilds the old pool files.
+            snapshot_id = SnapshotStore(SNAPSHOT_DIRECTORY).save_table(table)
+            write_pools(
+                f"./results/{filename}/{filename}_pools.json",
+                snapshot_id,
+                {
+                    "relays": relays,
+                    "entry_pool": entry_pool,
+                    "middle_pool": middle_pool,
+                    "exit_pool": exit_pool,
+                },
+            )
 
 
             # --------------------- EXIT PROGRAM ---------------------#
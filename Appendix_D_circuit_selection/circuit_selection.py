@@ -1,28 +1,31 @@
+import os
+import sys
 import time
 from stem import Signal
 from stem.control import Controller
 import stem.process
 
+# Shared relay selection helpers in the repository root
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from relay_selection.circuit_pool import CircuitPool
+from relay_selection.dispatcher import StreamDispatcher
+from relay_selection.rtt import RttProber
+
 # Socks port for Tor
 SOCKS_PORT = 9050
 CONNECTION_TIMEOUT = 120  # timeout before we give up on a circuit
 TOR_CONTROL_IP = "127.0.0.1"
 TOR_CONTROL_PORT = 9051
 
+# Circuits kept in the pool
+POOL_SIZE = 5
+
 
 
 def print_bootstrap_lines(line):
     if "Bootstrapped" in line:
         print(line)
 
-def measure_circuit_rtt(controller, circuit_id):
-    # Measure the round-trip time (RTT) for a given circuit
-    # You can implement this using a custom function that sends a payload and measures the response time
-    return rtt_value
-
-def is_unused_for_5_minutes(circuit_creation_time):
-    return time.time() - circuit_creation_time > 5 * 60
-
 # --------------------- Main ---------------------#
 def main():
     tor_process = stem.process.launch_tor_with_config(
@@ -55,43 +58,23 @@ def main():
              By setting this value to "1", the Tor client will no longer create these circuits.
             """
 
-            circuit_pool = {}
-            circuit_creation_times = {}
-
-            while True:
-                if len(circuit_pool) < 5:
-                    # Create a new circuit and measure its RTT
-                    new_circuit_id = controller.new_circuit(await_build=True)
-                    new_circuit_rtt = measure_circuit_rtt(controller, new_circuit_id)
-
-                    # Add new circuit to the pool if there's space
-                    if len(circuit_pool) <= 5:
-                        circuit_pool[new_circuit_id] = new_circuit_rtt
-                        circuit_creation_times[new_circuit_id] = time.time()
-                    else:
-                        # Replace the worst circuit if the new one has a better RTT
-                        worst_circuit_id = max(circuit_pool, key=circuit_pool.get)
-                        if new_circuit_rtt < circuit_pool[worst_circuit_id]:
-                            controller.close_circuit(worst_circuit_id)
-                            del circuit_pool[worst_circuit_id]
-                            del circuit_creation_times[worst_circuit_id]
-
-                            circuit_pool[new_circuit_id] = new_circuit_rtt
-                            circuit_creation_times[new_circuit_id] = time.time()
-
-                # Close circuits unused for more than 5 minutes
-                for circuit_id in list(circuit_pool.keys()):
-                    if is_unused_for_5_minutes(circuit_creation_times[circuit_id]):
-                        controller.close_circuit(circuit_id)
-                        del circuit_pool[circuit_id]
-                        del circuit_creation_times[circuit_id]
-
-                # Select the best circuit based on RTT when needed
-                best_circuit_id = min(circuit_pool, key=circuit_pool.get)
-                # Use the best_circuit_id for making requests
-
-
-                time.sleep(10)  # Adjust the sleep interval as needed
+            # Every stream is attached by the dispatcher, the RTT probes to their circuit by source port
+            dispatcher = StreamDispatcher(controller)
+            prober = RttProber(dispatcher, socks_port=SOCKS_PORT)
+
+            # Keep 5 circuits ranked by RTT, built, re-probed and evicted by a background thread
+            with CircuitPool(controller, prober, size=POOL_SIZE) as pool:
+                pool.wait_ready()
+                # Every other new stream goes to the best circuit of the pool
+                dispatcher.fallback = pool.best
+                try:
+                    while True:
+                        print(f"Circuit pool: {pool.stats()}")
+                        time.sleep(10)  # Adjust the sleep interval as needed
+                except KeyboardInterrupt:
+                    pass
+                dispatcher.fallback = None
+            dispatcher.close()
 
             # Close the Tor control port
             controller.close()
@@ -101,3 +84,7 @@ def main():
 
     # Stop the tor process
     tor_process.stop()
+
+
+if __name__ == "__main__":
+    main()
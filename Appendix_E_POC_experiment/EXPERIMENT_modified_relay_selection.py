@@ -1,5 +1,6 @@
 # Standard library imports
 #from datetime import datetime
+import concurrent.futures
 import datetime
 import json
 import re
@@ -9,16 +10,11 @@ import os
 # from rpy2.robjects.packages import importr
 import sys
 
-# from socket import socket as socksocket
-# from SocksiPy.socks import Socks5Error, PROXY_TYPE_SOCKS5
-from socks import SOCKS5Error, PROXY_TYPE_SOCKS5, socksocket
-
 # Third-party imports
 import requests
 import pycurl
 import io
-from math import radians, sin, cos, sqrt, atan2
-from re import findall
+import numpy as np
 import json
 
 # Stem imports
@@ -31,8 +27,24 @@ from stem import Signal
 from stem.control import Controller
 from stem.util import term
 
-# MaxMind imports
-import maxminddb
+# Shared relay selection helpers in the repository root
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from relay_selection.onionoo import ONIONOO_DETAILS_URL, ONIONOO_PARAMS
+from relay_selection.onionoo import get_cache as get_onionoo_cache
+from relay_selection.consensus import read_cached_relays
+from relay_selection.table import RelayTable
+from relay_selection.pipeline import FilterPipeline
+from relay_selection.diff import enrich_table
+from relay_selection.exit_policy import url_port
+from relay_selection.circuit_builder import CircuitBuilder
+from relay_selection.dispatcher import StreamDispatcher
+from relay_selection.engine import MeasurementEngine
+from relay_selection.findpath import find_paths
+from relay_selection.prefetch import PREFETCH_SIZE, PathPrefetcher
+from relay_selection.race import close_circuits
+from relay_selection.reuse import CircuitReuse
+from relay_selection.rtt import RttProber
+from relay_selection.snapshots import SnapshotStore, write_pools
 
 # --------------------- Constants ---------------------#
 # socks port for Tor and pycurl
@@ -47,6 +59,33 @@ TOR_CONTROL_PORT = 9051
 CLIENT_LAT = 61.1322
 CLIENT_LONG = 11.3716
 
+# Seconds a cached Onionoo document is used before it is revalidated (one consensus interval)
+ONIONOO_CACHE_MAX_AGE = 3600
+
+# MaxMind GeoLite database used to locate the relays
+GEOIP_DATABASE = "./GeoIPPlotter/GeoLite2-City20230428.mmdb"
+
+# Where the relay list comes from: "onionoo" for the Onionoo details document, or "consensus"
+# to build it offline from the consensus and descriptors Tor cached in TOR_DATA_DIRECTORY
+RELAY_SOURCE = "onionoo"
+TOR_DATA_DIRECTORY = os.path.expanduser("~/.tor")
+
+# Relay snapshots shared by all experiments, see relay_selection/snapshots.py
+SNAPSHOT_DIRECTORY = "./results/snapshots"
+
+# The request measured through each circuit, exits that reject its port are left out of the pool
+TARGET_URL = "http://google.com/"
+
+# Requests carried by each circuit before it is closed, 1 builds a new circuit for every request
+REQUESTS_PER_CIRCUIT = 1
+# Seconds a circuit is reused for after its first request, None for no limit. Tor closes a used
+# circuit after MaxCircuitDirtiness (10 minutes by default) on its own.
+CIRCUIT_DIRTINESS = None
+
+# Requests in flight at once, each on its own circuit, without sleeping TIME between them. They run
+# on one pycurl CurlMulti, see relay_selection/engine.py. 1 measures one request at a time.
+CONCURRENT_REQUESTS = 1
+
 
 # --------------------- Main ---------------------#
 def main():
@@ -222,262 +261,15 @@ def map_ipv4_to_heatmap(relays, filename):
 
     # Run the python script that will map the IPv4 addresses to a heatmap
     os.system(
-        f"python3 ./GeoIPPlotter/geoipplotter.py -t heatmap --db ./GeoIPPlotter/GeoLite2-City_20230303.mmdb --input ./GeoIPPlotter/ipv4.txt -o ./GeoIPPlotter/heatmap_{filename}.png"
+        f"python3 ./GeoIPPlotter/geoipplotter.py -t heatmap --db {GEOIP_DATABASE} --input ./GeoIPPlotter/ipv4.txt -o ./GeoIPPlotter/heatmap_{filename}.png"
     )
     # Run the python script that will map the IPv4 addresses to a scatter map and zoom in on Europe
     os.system(
-        f'python3 ./GeoIPPlotter/geoipplotter.py -t scatter --db ./GeoIPPlotter/GeoLite2-City_20230303.mmdb --input ./GeoIPPlotter/ipv4.txt -o ./GeoIPPlotter/scattermap_{filename}.png -e " -12/45/30/65"'
+        f'python3 ./GeoIPPlotter/geoipplotter.py -t scatter --db {GEOIP_DATABASE} --input ./GeoIPPlotter/ipv4.txt -o ./GeoIPPlotter/scattermap_{filename}.png -e " -12/45/30/65"'
     )
 
     # Run the python script that will map the IPv4 addresses to a connection map
-    # os.system('python3 ./GeoIPPlotter/geoipplotter.py -t connectionmap --db ./GeoIPPlotter/GeoLite2-City_20230303.mmdb --input ./GeoIPPlotter/ipv4.txt -o ./GeoIPPlotter/connectionmap.png -d 11.3716/61.1322')
-
-
-def get_lat_long(relays):
-    """
-    Looks up the latitude and longitude for each relay's IPv4 address using maxmind GeoLite IP database. 
-    # Download updated database from https://www.maxmind.com/en/accounts/834180/geoip/downloads
-
-    Args:
-    - relays: a list of relays, where each relay is a dictionary returned from Tor Metrics
-    (https://metrics.torproject.org/onionoo.html)
-
-    Returns:
-    - a list of relays, where each relay dictionary now includes its latitude and longitude
-    """
-    with maxminddb.open_database(
-        "./GeoIPPlotter/GeoLite2-City20230428.mmdb"
-        #"./GeoIPPlotter/GeoLite2-City_20230303.mmdb"
-    ) as reader:
-        for relay in relays:
-            address = relay["ipv4_address"]
-            data = reader.get(address)
-            if data != None:
-                try:
-                    relay["latitude"] = data["location"]["latitude"]
-                    relay["longitude"] = data["location"]["longitude"]
-                except:
-                    pass
-    return relays
-
-
-def calc_distance(relays):
-    """
-    Calculates the distance between the client and each relay based on latitude and longitude.
-
-    Args:
-    - relays: a list of relays, where each relay is a dictionary returned from Tor Metrics
-    (https://metrics.torproject.org/onionoo.html)
-
-    Returns:
-    - a list of relays, where each relay dictionary includes its distance from the client
-    """
-    # Earth's radius in kilometers
-    R = 6373.0
-
-    for relay in relays:
-        try:
-            # Convert to radians
-            lat1 = radians(CLIENT_LAT)
-            lon1 = radians(CLIENT_LONG)
-            lat2 = radians(relay["latitude"])
-            lon2 = radians(relay["longitude"])
-
-            # Calculate the distance
-            dlon = lon2 - lon1
-            dlat = lat2 - lat1
-            a = sin(dlat / 2) ** 2 + cos(lat1) * cos(lat2) * sin(dlon / 2) ** 2
-            c = 2 * atan2(sqrt(a), sqrt(1 - a))
-
-            # Return the distance in kilometers
-            distance = R * c
-            relay["distance"] = distance
-        except:
-            relay["distance"] = float("inf")
-    return relays
-
-
-def sort_relay_distances(relays):
-    """
-    Sorts relays by their distance from the client.
-
-    Args:
-    - relays: a list of relays, where each relay is a dictionary returned from Tor Metrics
-    (https://metrics.torproject.org/onionoo.html)
-
-    Returns:
-    - a sorted list of relays by distance
-    """
-    sorted_relays = sorted(
-        relays, key=lambda relay: relay.get("distance", float("inf"))
-    )
-    return sorted_relays
-
-
-def filter_out_high_distance_relays(relays, distance_threshold):
-    """
-    Filters out relays with high distance.
-
-    Args:
-    - relays: a list of relays, where each relay is a dictionary returned from Tor Metrics
-    (https://metrics.torproject.org/onionoo.html)
-    - distance_threshold: a float representing the percentage of relays to be filtered out, based on distance
-
-    Returns:
-    - a list of relays, where the top distance_threshold percentage of relays have been filtered out
-    """
-
-    def remove_high_distance_relays(relays, distance_threshold):
-        cutoff = int(len(relays) * (1 - distance_threshold))
-        return relays[:cutoff]
-
-    filtered_relays = remove_high_distance_relays(relays, distance_threshold)
-    return filtered_relays
-
-
-def sort_relays_by_bandwidth(entry_pool, middle_pool, exit_pool):
-    """
-    Sorts the relays in each pool by bandwidth.
-
-    Args:
-    - entry_pool: a list of entry relays
-    - middle_pool: a list of middle relays
-    - exit_pool: a list of exit relays
-
-    Returns:
-    - a tuple of three sorted lists of relays (one for each pool)
-
-    """
-    # Sort the relays in each pool by bandwidth
-    sorted_entry_pool = sorted(
-        entry_pool, key=lambda relay: relay["observed_bandwidth"], reverse=True
-    )
-    sorted_middle_pool = sorted(
-        middle_pool, key=lambda relay: relay["observed_bandwidth"], reverse=True
-    )
-    sorted_exit_pool = sorted(
-        exit_pool, key=lambda relay: relay["observed_bandwidth"], reverse=True
-    )
-
-    return sorted_entry_pool, sorted_middle_pool, sorted_exit_pool
-
-def categorize_relays(relays):
-    """
-    Categorizes relays into entry, middle, and exit pools based on their flags.
-    
-    Args:
-    - relays (list): a list of relays, where each relay is a dictionary returned from Tor Metrics
-    
-    Returns:
-    - entry_pool (list): A list of relay dictionaries categorized as entry relays.
-    - middle_pool (list): A list of relay dictionaries categorized as middle relays.
-    - exit_pool (list): A list of relay dictionaries categorized as exit relays.
-    """
-    entry_pool = []
-    middle_pool = []
-    exit_pool = []
-
-    for relay in relays:
-        flags = relay.get("flags", [])
-        # If the relay has the 'Guard' flag and not the 'Exit' flag, it's an entry relay
-        if "Guard" in flags:
-            entry_pool.append(relay)
-        # If the relay has the 'Exit' flag and not the 'Guard' flag, it's an exit relay
-        elif "Exit" in flags:
-            exit_pool.append(relay)
-        # If the relay has neither the 'Guard' nor the 'Exit' flag, it's a middle relay
-        else:
-            middle_pool.append(relay)
-
-    return entry_pool, middle_pool, exit_pool
-
-
-def filter_based_on_flags(relays):
-    """
-    Filters the relays based on the presence of the 'Fast' flag.
-    
-    Args:
-    - relays (list): a list of relays, where each relay is a dictionary returned from Tor Metrics
-    
-    Returns:
-    - fast_relays (list): A list of relay dictionaries that have the 'Fast' flag.
-    """
-    fast_relays = []
-    for relay in relays:
-        flags = relay.get("flags", [])
-        if "Fast" in flags:
-            fast_relays.append(relay)
-
-    return fast_relays
-
-
-def filter_out_low_bandwidth_relays(
-    entry_pool, middle_pool, exit_pool, relay_bandwidth_cutoff
-):
-    """
-    Filters out relays with low bandwidth.
-
-    Args:
-    - entry_pool: a list of entry relays
-    - middle_pool: a list of middle relays
-    - exit_pool: a list of exit relays
-    - relay_bandwidth_cutoff: a float representing the percentage of relays to be filtered out, based on bandwidth
-
-    Returns:
-    - a tuple of three lists of relays (one for each pool: entry, middle, and exit)
-    """
-
-    # Helper function to apply the cutoff
-    def apply_cutoff(pool, cutoff):
-        cutoff_index = int(len(pool) * (1 - cutoff))
-        return pool[:cutoff_index]
-
-    # Apply the cutoff to each pool
-    filtered_entry_pool = apply_cutoff(entry_pool, relay_bandwidth_cutoff)
-    filtered_middle_pool = apply_cutoff(middle_pool, relay_bandwidth_cutoff)
-    filtered_exit_pool = apply_cutoff(exit_pool, relay_bandwidth_cutoff)
-
-    return filtered_entry_pool, filtered_middle_pool, filtered_exit_pool
-
-
-def filter_by_overload_general_timestamp(entry_pool, middle_pool, exit_pool, overload):
-    """
-    Filters out relays that have a too recent overload_general_timestamp.
-
-    Args:
-    - entry_pool: a list of entry relays
-    - middle_pool: a list of middle relays
-    - exit_pool: a list of exit relays
-    - overload: an integer representing the number of hours to filter out recent overload_general_timestamps
-
-    Returns:
-    - a tuple of three lists of relays (one for each pool: entry, middle, and exit)
-
-    """
-
-    # Filters a single relay pool based on the specified overload threshold.
-    def filter_pool_overload(pool, overload):
-        filtered_pool = []
-        for relay in pool:
-            if "overload_general_timestamp" in relay:
-                current_time_millis = int(round(time.time() * 1000))
-                current_time = datetime.datetime.fromtimestamp(
-                    current_time_millis / 1000
-                )
-                X_hour_ago = current_time - datetime.timedelta(hours=overload)
-                time_filter = int(round(X_hour_ago.timestamp() * 1000))
-
-                if relay["overload_general_timestamp"] <= time_filter:
-                    filtered_pool.append(relay)
-            else:
-                filtered_pool.append(relay)
-        return filtered_pool
-
-    filtered_entry_pool = filter_pool_overload(entry_pool, overload)
-    filtered_middle_pool = filter_pool_overload(middle_pool, overload)
-    filtered_exit_pool = filter_pool_overload(exit_pool, overload)
-
-    return filtered_entry_pool, filtered_middle_pool, filtered_exit_pool
+    # os.system(f'python3 ./GeoIPPlotter/geoipplotter.py -t connectionmap --db {GEOIP_DATABASE} --input ./GeoIPPlotter/ipv4.txt -o ./GeoIPPlotter/connectionmap.png -d 11.3716/61.1322')
 
 
 # --------------------- EXPERIMENT functions ---------------------#
@@ -502,111 +294,80 @@ def get_circuit_info(controller, circuit_id):
     return circuit.id, relays
 
 
-def attach_stream_to_circuit(controller, circuit_id):
-    """
-    Attaches a stream to a specific circuit.
-
-    Parameters:
-    - controller: a Stem controller
-    - circuit_id: the ID of the circuit to attach the stream to
-
-    Returns:
-    - The attached stream
-    """
-
-    def attach_stream(stream):
-        if stream.status == "NEW":
-            controller.attach_stream(stream.id, circuit_id)
-
-    controller.add_event_listener(attach_stream, stem.control.EventType.STREAM)
-    return attach_stream
-
-
-def measure_circuit_rtt(controller, circuit_id):
+def prepare_circuit(paths, builder, prober, reuse):
     """
-    Measures the circuit Round-Trip Time (RTT) by opening a TCP connection to an IP address
-    in the 127.0.0.0/8 network and measuring the time interval between sending the request
-    and receiving the corresponding reply.
+    This function gets the circuit for one request: the circuit of the last request while it has requests left,
+    otherwise a new circuit through the next path from paths, with its RTT measured.
 
     Args:
-    - controller: Tor controller object
-    - circuit_id: ID of the circuit to measure RTT for
+    - paths: Iterator of relay fingerprint paths, e.g. a relay_selection.prefetch.PathPrefetcher.
+    - builder: relay_selection.circuit_builder.CircuitBuilder that builds the circuits.
+    - prober: relay_selection.rtt.RttProber that measures the RTT of the circuits.
+    - reuse: relay_selection.reuse.CircuitReuse that decides whether the last circuit carries this request.
 
     Returns:
-    - rtt: Round-Trip Time of the circuit in seconds
-    """
-
-    # Attach a stream to the circuit
-    controller.set_conf("__LeaveStreamsUnattached", "1")
-    attach_stream_listener = attach_stream_to_circuit(controller, circuit_id)
-
-    # Connect to the IP address in the 127.0.0.0/8 network
-    try:
-        # Create a socket and set the proxy
-        socket = socksocket()
-        socket.setproxy(PROXY_TYPE_SOCKS5, "localhost", SOCKS_PORT)
-        start_time_rtt = time.time()
-        socket.connect(("127.0.0.1", 80))
-    except Exception as error:
-        end_time_rtt = time.time()
-        # Tor's SOCKS implementation sends a general error response
-        # when the Tor protocol is violated.
-        
-    # Calculate RTT
-    rtt = end_time_rtt - start_time_rtt
-
-    # Remove the event listener
-    controller.remove_event_listener(attach_stream_listener)
-    return rtt
-
-
-def measure_request(url, controller, start_time):
+    - dict: The circuit from reuse with its circuit_id, path, rtt and number of requests, or "error" if no circuit
+    could be built.
+    """
+    # Reuse the circuit of the last request while it has requests left, see REQUESTS_PER_CIRCUIT
+    # and CIRCUIT_DIRTINESS, otherwise build a new one
+    circuit = reuse.take()
+    if circuit is None:
+        # Next path from Tor's default algorithm, found with fresh guard nodes in a batched FINDPATH
+        relay_fingerprints = next(paths)
+
+        print("Relay fingerprints: %s" % relay_fingerprints)
+
+        print("Creating a new circuit with the desired path")
+        # Create a new circuit with the desired path
+        build = builder.build(relay_fingerprints).result()
+        if build.status != "BUILT":
+            print(f"ERROR:Unable to create a new circuit: {build.status} {build.reason}")
+            return "error"
+        circuit_id = build.circuit_id
+
+        # --------------------- RTT MEASUREMENT ------------------------#
+        print("Measuring RTT")
+        circuit_rtt = prober.probe(circuit_id)
+        if circuit_rtt is None:
+            # The probe could not be attached or timed out, the circuit is not usable
+            print("ERROR:Unable to measure the RTT of the circuit")
+            close_circuits(builder.controller, [circuit_id])
+            return "error"
+        circuit = reuse.start(circuit_id, relay_fingerprints, circuit_rtt)
+    return circuit
+
+
+def measure_request(url, controller, start_time, paths, builder, prober, reuse, dispatcher):
     """
     This function measures the time taken to fetch a URL using Tor while changing guard nodes for each request.
-    It first drops the current guard nodes, then obtains a new path from the Tor controller using its default algorithm.
+    It takes the next path from paths, which Tor found with its default algorithm after dropping the current guard nodes.
     Next, it creates a new circuit with the obtained path and collects various measurements related to RTT, latency, TTFB, and throughput.
 
     Args:
     - url (str): The URL to fetch.
     - controller: The Tor controller object.
     - start_time: The starting time to measure the request.
+    - paths: Iterator of relay fingerprint paths, e.g. a relay_selection.prefetch.PathPrefetcher.
+    - builder: relay_selection.circuit_builder.CircuitBuilder that builds the circuits.
+    - prober: relay_selection.rtt.RttProber that measures the RTT of the circuits.
+    - reuse: relay_selection.reuse.CircuitReuse that decides whether the last circuit carries this request.
+    - dispatcher: relay_selection.dispatcher.StreamDispatcher that attaches the request's stream to its circuit.
 
     Returns:
     - dict: A dictionary containing the measurements if the request is successful, or an error message otherwise.
-    The dictionary includes timestamp, total_time, rtt, latency, ttfb, throughput, circ_id, and circuit.
+    The dictionary includes timestamp, total_time, rtt, latency, ttfb, throughput, circ_id, circuit, build_timeline,
+    reused and circuit_request.
     """
     print("Fetching %s" % url)
-    # Change guard nodes for every path.
-    msg = controller.msg("DROPGUARDS")
-
-    # Get a path from the controller using Tor's default algorithm
-    msg = controller.msg("FINDPATH")
-    assert msg.is_ok(), (
-        "FINDPATH command failed with error "
-        + "'%s'. Is your tor client patched?\n" % str(msg)
-    )
-    relay_fingerprints = findall("[A-Z0-9]{40}", str(msg))
-
-    print("Relay fingerprints: %s" % relay_fingerprints)
-
-    print("Creating a new circuit with the desired path")
-    # Create a new circuit with the desired path
-    try:
-        circuit_id = controller.new_circuit(
-            path=relay_fingerprints, await_build=True#, timeout=180
-        )  # !path=
-    except Exception as exc:
-        print(f"ERROR:Unable to create a new circuit: {exc}")
+    circuit = prepare_circuit(paths, builder, prober, reuse)
+    if circuit == "error":
         return "error"
-
-    # --------------------- RTT MEASUREMENT ------------------------#
-    print("Measuring RTT")
-    circuit_rtt = measure_circuit_rtt(controller, circuit_id)
+    circuit_id, relay_fingerprints, circuit_rtt = circuit["circuit_id"], circuit["path"], circuit["rtt"]
 
     # --------------------- QUERY MEASUREMENTS ---------------------#
-    # Attach a stream to the circuit
-    controller.set_conf("__LeaveStreamsUnattached", "1")
-    attach_stream_listener = attach_stream_to_circuit(controller, circuit_id)
+    # The dispatcher attaches the request's stream to the circuit by its SOCKS username
+    username = dispatcher.route(circuit_id)
 
     # Prepare the query
     output = io.BytesIO()
@@ -615,9 +376,11 @@ def measure_request(url, controller, start_time):
     query.setopt(pycurl.PROXY, "localhost")
     query.setopt(pycurl.PROXYPORT, SOCKS_PORT)
     query.setopt(pycurl.PROXYTYPE, pycurl.PROXYTYPE_SOCKS5_HOSTNAME)
+    query.setopt(pycurl.PROXYUSERNAME, username)
     query.setopt(pycurl.WRITEFUNCTION, output.write)
     query.setopt(pycurl.HEADERFUNCTION, output.write)
 
+    completed = False
     try:
         print("Performing query")
         query.perform()
@@ -645,7 +408,11 @@ def measure_request(url, controller, start_time):
             "throughput": throughput,
             "circ_id": circuit_id,
             "circuit": relay_fingerprints,
+            "build_timeline": builder.timeline.record(circuit_id),
+            "reused": circuit["requests"] > 1,
+            "circuit_request": circuit["requests"],
         }
+        completed = True
 
 
         return result
@@ -655,15 +422,79 @@ def measure_request(url, controller, start_time):
         return "error" 
     finally:
         try: 
-            # Close the circuit
-            controller.remove_event_listener(attach_stream_listener)
-            controller.reset_conf("__LeaveStreamsUnattached")
-            controller.close_circuit(circuit_id)
+            # Stop routing streams to the circuit
+            dispatcher.unroute(circuit_id)
+            # Keep the circuit for the next request, unless it has carried its requests or this one failed
+            reuse.release(circuit_id, failed=not completed)
         except Exception as exc:
             print(f"ERROR:Unable to close circuit: {exc}, Moving on..")
 
 
 
+def measure_requests_concurrently(url, num_requests, paths, builder, prober, reuse, engine):
+    """
+    This function measures num_requests successful requests of url like measure_request(), with up to
+    engine.max_in_flight requests in flight at once. The circuit of each request is prepared in a thread while
+    the transfers of the other requests run on the engine, and no time is slept between requests.
+
+    Args:
+    - url (str): The URL to fetch.
+    - num_requests (int): The number of successful requests to measure.
+    - paths: Iterator of relay fingerprint paths, e.g. a relay_selection.prefetch.PathPrefetcher.
+    - builder: relay_selection.circuit_builder.CircuitBuilder that builds the circuits.
+    - prober: relay_selection.rtt.RttProber that measures the RTT of the circuits.
+    - reuse: relay_selection.reuse.CircuitReuse that decides whether the last circuit carries a request.
+    - engine: relay_selection.engine.MeasurementEngine that runs the transfers.
+
+    Returns:
+    - dict: The measurements of each successful request, as returned by measure_request(), keyed by request number.
+    - int: The number of failed requests.
+    """
+    requests_measurements = {}
+    num_failed_circuits = 0
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=engine.max_in_flight)
+
+    def next_job():
+        # Start no more requests than needed for num_requests, and stop after too many failed circuits
+        if len(requests_measurements) + engine.in_flight() >= num_requests:
+            return None
+        if num_failed_circuits > num_requests*1.5:
+            return None
+        print("Fetching %s" % url)
+        start_time = time.time()
+        return url, executor.submit(prepare_circuit, paths, builder, prober, reuse), start_time
+
+    for start_time, circuit, measurements, error in engine.run(next_job):
+        if circuit is not None:
+            # Keep the circuit for the next request, unless it has carried its requests or this one failed
+            reuse.release(circuit["circuit_id"], failed=error is not None)
+        if error is not None:
+            print("error: Unable to reach %s (%s)" % (url, error))
+            num_failed_circuits += 1
+            continue
+
+        circuit_id = circuit["circuit_id"]
+        requests_measurements[len(requests_measurements)] = {
+            "timestamp": start_time,
+            "total_time": measurements["end_time"] - start_time,
+            "rtt": circuit["rtt"],
+            "latency": measurements["latency"],
+            "ttfb": measurements["ttfb"],
+            "throughput": measurements["throughput"],
+            "circ_id": circuit_id,
+            "circuit": circuit["path"],
+            "build_timeline": builder.timeline.record(circuit_id),
+            "reused": circuit["requests"] > 1,
+            "circuit_request": circuit["requests"],
+        }
+        print(f"Gathered measurements {len(requests_measurements)}/{num_requests}")
+
+    executor.shutdown()
+    if num_failed_circuits > num_requests*1.5:
+        print("Too many failed circuits. Exiting program")
+    return requests_measurements, num_failed_circuits
+
+
 def experiment(distance, bandwidth, overload, flags, NUM_REQUESTS, TIME, filename):
     """
     This function conducts a Tor network experiment based on various parameters such as distance, bandwidth,
@@ -684,64 +515,53 @@ def experiment(distance, bandwidth, overload, flags, NUM_REQUESTS, TIME, filenam
     TIME_START = datetime.datetime.now()
 
     # Make pools of relays
-    url = "https://onionoo.torproject.org/details"
-    params = {
-        "running": "true",
-        "fields": "or_addresses,nickname,fingerprint,flags,country,consensus_weight,observed_bandwidth,advertised_bandwidth,exit_policy",
-    }
-    response_entry = requests.get(url, params=params)
-    data = response_entry.json()
-    relays = data["relays"]
+    if RELAY_SOURCE == "consensus":
+        # Read from the consensus Tor cached during the previous run, no network round trip
+        relays = read_cached_relays(TOR_DATA_DIRECTORY)
+    else:
+        # Served from the shared on-disk cache, Onionoo is only asked again once the copy is stale.
+        # The document is streamed into compact records holding only the fields used below.
+        relays = get_onionoo_cache(max_age=ONIONOO_CACHE_MAX_AGE).get_relays(
+            ONIONOO_DETAILS_URL, ONIONOO_PARAMS
+        )
 
 
 
-    # Modify the relay list with distance information
-    relays = filter_out_ipv6(relays)
-    relays = get_lat_long(relays)
-    relays = calc_distance(relays)
+    # Store the relays in a columnar table, the pools below are arrays of row indices into it
+    table = RelayTable(relays)
 
-    # Save the total number of relays before filtering
-    TOTAL_NUM_RELAYS = len(relays)
+    # Modify the relay table with distance information. Locations are cached between runs, so
+    # only relays that joined or changed address since the previous run are looked up again.
+    snapshot_diff = enrich_table(table, GEOIP_DATABASE, CLIENT_LAT, CLIENT_LONG)
+    if snapshot_diff is not None:
+        print(snapshot_diff.summary())
 
+    # Save the total number of relays before filtering
+    TOTAL_NUM_RELAYS = len(table)
 
-    if distance != 0: 
-        relays = sort_relay_distances(relays)
-        relays = filter_out_high_distance_relays(relays, distance)
+    # Filter stages in the order distance -> flags -> bandwidth -> overload, a parameter of 0
+    # leaves its stage out. The stages only run when the rows or pools are requested, and their
+    # masks are memoized, so repeating a configuration on the same relays costs nothing.
+    relay_filter = FilterPipeline(table).distance(distance).fast_flag(flags)
+    pool_filter = relay_filter.bandwidth(bandwidth).overload(overload).exit_port(url_port(TARGET_URL))
+    relays = relay_filter.rows()
 
     # Make plot before filtering
-    # map_ipv4_to_heatmap(relays, "before_filtering")
-
-    if flags != 0:
-        relays = filter_based_on_flags(relays)
-        entry_pool, middle_pool, exit_pool = categorize_relays(relays)
-    else:
-        entry_pool, middle_pool, exit_pool = categorize_relays(relays)
-        # Split relays dict into three lists
-
-
-    if bandwidth != 0:
-        entry_pool, middle_pool, exit_pool = sort_relays_by_bandwidth(
-            entry_pool, middle_pool, exit_pool
-        )
-        entry_pool, middle_pool, exit_pool = filter_out_low_bandwidth_relays(
-            entry_pool, middle_pool, exit_pool, bandwidth
-        )
+    # map_ipv4_to_heatmap(table.to_relays(relays), "before_filtering")
 
-    if overload != 0:
-        entry_pool, middle_pool, exit_pool = filter_by_overload_general_timestamp(
-            entry_pool, middle_pool, exit_pool, overload
-        )
+    # Split relay rows into three pools
+    entry_pool, middle_pool, exit_pool = pool_filter.pools()
 
     # Make plot before filtering
-    # map_ipv4_to_heatmap(entry_pool, "before_filtering_entry")
-    # map_ipv4_to_heatmap(middle_pool, "before_filtering_middle")
-    # map_ipv4_to_heatmap(exit_pool, "before_filtering_exit")
+    # map_ipv4_to_heatmap(table.to_relays(entry_pool), "before_filtering_entry")
+    # map_ipv4_to_heatmap(table.to_relays(middle_pool), "before_filtering_middle")
+    # map_ipv4_to_heatmap(table.to_relays(exit_pool), "before_filtering_exit")
 
 
     # Get the top relay fingerprints
-    top_entries_fingerprint = [relay['fingerprint'] for relay in entry_pool]
-    top_middles_fingerprint = [relay['fingerprint'] for relay in middle_pool]
-    top_exits_fingerprint = [relay['fingerprint'] for relay in exit_pool]
+    top_entries_fingerprint = table.fingerprints(entry_pool)
+    top_middles_fingerprint = table.fingerprints(middle_pool)
+    top_exits_fingerprint = table.fingerprints(exit_pool)
     ENTRY_FINGERPRINT = ",".join(top_entries_fingerprint)
     MIDDLE_FINGERPRINT = ",".join(top_middles_fingerprint)
     EXIT_FINGERPRINT = ",".join(top_exits_fingerprint)
@@ -757,6 +577,7 @@ def experiment(distance, bandwidth, overload, flags, NUM_REQUESTS, TIME, filenam
             "FetchDirInfoEarly": "1",
             "FetchDirInfoExtraEarly": "1",
             "DownloadExtraInfo": "1",
+            "DataDirectory": TOR_DATA_DIRECTORY, # Keeps the cached consensus for RELAY_SOURCE = "consensus"
             "CircuitBuildTimeout": "60", # Set the timeout for circuit builds to 60 seconds.
             "LearnCircuitBuildTimeout": "0", #To keep circuit build timeouts static.
             "EntryNodes": f"{ENTRY_FINGERPRINT}",
@@ -790,29 +611,50 @@ def experiment(distance, bandwidth, overload, flags, NUM_REQUESTS, TIME, filenam
             measurement = ""
             num_failed_circuits = 0
             i = 0
-            while i < NUM_REQUESTS:
-                # If previous measurement failed, adjust variables accordingly
-                if measurement == "error":
-                    i -= 1
-                    num_failed_circuits += 1
-
-                # Perform a measurement and store it if successful
-                start_time = time.time()
-                measurement = measure_request(
-                    "http://google.com/", controller, start_time
+            # Circuits are built through EXTENDCIRCUIT and CIRC events, which records their build times
+            builder = CircuitBuilder(controller)
+            # One STREAM listener attaches the streams of every request and RTT probe to their circuit
+            dispatcher = StreamDispatcher(controller)
+            prober = RttProber(dispatcher, socks_port=SOCKS_PORT)
+            # Each circuit carries REQUESTS_PER_CIRCUIT requests before it is closed
+            reuse = CircuitReuse(controller, REQUESTS_PER_CIRCUIT, CIRCUIT_DIRTINESS)
+            # Paths are fetched from Tor in the background, one FINDPATH per batch, and kept ready in a
+            # bounded queue, so measure_request() does not wait on the control port for its path
+            paths = PathPrefetcher(
+                find_paths(controller, batch_size=PREFETCH_SIZE),
+                pools=(top_entries_fingerprint, top_middles_fingerprint, top_exits_fingerprint),
+            )
+            if CONCURRENT_REQUESTS > 1:
+                # Keep CONCURRENT_REQUESTS requests in flight, each on its own circuit
+                engine = MeasurementEngine(dispatcher, socks_port=SOCKS_PORT, max_in_flight=CONCURRENT_REQUESTS)
+                requests_measurements, num_failed_circuits = measure_requests_concurrently(
+                    TARGET_URL, NUM_REQUESTS, paths, builder, prober, reuse, engine
                 )
-                if measurement != "error":
-                    requests_measurements[i] = measurement
-
-                # Exit loop if too many failed circuits to prevent infinite loop
-                if num_failed_circuits > NUM_REQUESTS*1.5:
-                    print("Too many failed circuits. Exiting program")
-                    break
-
-                # Sleep for a specified time between requests
-                print(f"Sleeping for {TIME} seconds")
-                time.sleep(TIME)
-                i += 1
+                engine.close()
+            else:
+                while i < NUM_REQUESTS:
+                    # If previous measurement failed, adjust variables accordingly
+                    if measurement == "error":
+                        i -= 1
+                        num_failed_circuits += 1
+
+                    # Perform a measurement and store it if successful
+                    start_time = time.time()
+                    measurement = measure_request(
+                        TARGET_URL, controller, start_time, paths, builder, prober, reuse, dispatcher
+                    )
+                    if measurement != "error":
+                        requests_measurements[i] = measurement
+
+                    # Exit loop if too many failed circuits to prevent infinite loop
+                    if num_failed_circuits > NUM_REQUESTS*1.5:
+                        print("Too many failed circuits. Exiting program")
+                        break
+
+                    # Sleep for a specified time between requests
+                    print(f"Sleeping for {TIME} seconds")
+                    time.sleep(TIME)
+                    i += 1
 
             TIME_END = datetime.datetime.now()
             # Make directory for the results
@@ -840,21 +682,50 @@ def experiment(distance, bandwidth, overload, flags, NUM_REQUESTS, TIME, filenam
                 outfile.write(f"Total time : {TIME_END - TIME_START}")
                 outfile.write("\n")
                 outfile.write(f"NUM_FAILED_CIRCUITS: {str(num_failed_circuits)}")
-
-            # Save relay object to a file
-            with open(f"./results/{filename}/{filename}_relays.json", "w") as outfile:
-                json.dump(relays, outfile)
-
-            # Save the entry, middle and exit pools to a file
-            with open(f"./results/{filename}/{filename}_entry_pool.json", "w") as outfile:
-                json.dump(entry_pool, outfile)
-            with open(f"./results/{filename}/{filename}_middle_pool.json", "w") as outfile:
-                json.dump(middle_pool, outfile)
-            with open(f"./results/{filename}/{filename}_exit_pool.json", "w") as outfile:
-                json.dump(exit_pool, outfile)
+                outfile.write("\n")
+                outfile.write(f"PATH QUEUE: {paths.stats()}")
+                outfile.write("\n")
+                outfile.write(f"STREAMS: {dispatcher.stats()}")
+                outfile.write("\n")
+                outfile.write(f"CONCURRENT_REQUESTS: {CONCURRENT_REQUESTS}")
+
+            # Save the relay snapshot once under its content hash, and the filtered relays and
+            # the entry, middle and exit pools as row indices into it.
+            # python -m relay_selection.snapshots ./results/{filename} rebuilds the old pool files.
+            snapshot_id = SnapshotStore(SNAPSHOT_DIRECTORY).save_table(table)
+            write_pools(
+                f"./results/{filename}/{filename}_pools.json",
+                snapshot_id,
+                {
+                    "relays": relays,
+                    "entry_pool": entry_pool,
+                    "middle_pool": middle_pool,
+                    "exit_pool": exit_pool,
+                },
+                parameters={
+                    "distance": distance,
+                    "bandwidth": bandwidth,
+                    "overload": overload,
+                    "flags": flags,
+                    "exit_port": url_port(TARGET_URL),
+                },
+            )
+
+
+            # Save the build time histograms and failure reasons of the circuits
+            with open(f"./results/{filename}/{filename}_build_times.json", "w") as outfile:
+                json.dump(builder.summary(), outfile, indent=4)
+
+            # Save the per-hop build timeline of every circuit, the failed ones included
+            with open(f"./results/{filename}/{filename}_timelines.json", "w") as outfile:
+                json.dump(builder.timeline.records(), outfile, indent=4)
 
 
             # --------------------- EXIT PROGRAM ---------------------#
+            reuse.close()
+            builder.close()
+            dispatcher.close()
+            paths.close()
             controller.close()
     except stem.SocketError as exc:
         print(f"Unable to connect to Tor on {TOR_CONTROL_IP}:{TOR_CONTROL_PORT}: {exc}")
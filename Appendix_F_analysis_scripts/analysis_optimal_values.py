@@ -11,6 +11,12 @@ import statistics
 import csv
 from tabulate import tabulate
 import os
+import sys
+
+# Shared relay selection helpers in the repository root
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from relay_selection.snapshots import load_pools
+from relay_selection.sweep import POOLS
 
 
 
@@ -48,6 +54,9 @@ def main():
     # Calculate the median for each parameter type and store the results in a dictionary
     results = create_results_dict(parameter_types, percentiles_dict, parameters)
 
+    # Add the pool sizes of every distance-bandwidth point, derived from the relay snapshot in one pass
+    add_grid_pool_sizes(results, percentiles_dict["distance-bandwidth"])
+
 
     # Print top 3 of each parameter type
     for parameter_type in parameter_types:
@@ -142,6 +151,28 @@ def write_csv(results, output_filename):
                 csv_writer.writerow(row)
 
 
+def add_grid_pool_sizes(results, percentiles):
+    """
+    Add the entry, middle and exit pool sizes of each distance-bandwidth point to the results.
+
+    The sizes are read from the row indices each grid experiment saved in its _pools.json, so
+    they are the sizes of the pools the measurements used.
+
+    Args:
+        results (dict): The nested results dictionary from create_results_dict().
+        percentiles (list): The distance-bandwidth keys, e.g. ['30-30', '30-40'].
+    """
+    for percentile in percentiles:
+        name = f"distance-bandwidth_{percentile}_percent"
+        pools_path = f"results/{name}/{name}_pools.json"
+        if not os.path.exists(pools_path):
+            print(f"No pools saved for {name} ({pools_path}), skipping its pool sizes")
+            continue
+        _, pools = load_pools(pools_path)
+        for pool in POOLS:
+            results["distance-bandwidth"][f"{percentile}_percent"][f"{pool}_size"] = len(pools[pool])
+
+
 def load_json_files(parameter_type, steps=range(10, 80, 10)):
     """
     Load JSON files for a given parameter_type and a range of steps.
@@ -12,6 +12,7 @@
 # Imports
 import argparse
 import contextlib
+import os
 import sys
 import matplotlib
 import numpy as np
@@ -19,11 +20,16 @@ import numpy as np
 matplotlib.use('Agg')
 import matplotlib.pyplot as plt
 from mpl_toolkits.basemap import Basemap
-import geoip2.database
 from matplotlib import cm
 from numpy import array
 import matplotlib.colors as colors
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from relay_selection.geoip import lookup_locations
+
+# Same GeoLite2 City build as the experiment scripts (GEOIP_DATABASE)
+GEOIP_DATABASE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "GeoLite2-City20230428.mmdb")
+
 # Adopted from https://stackoverflow.com/questions/10664856/make-a-dictionary-with-duplicate-keys-in-python
 # This class will allow us to store multiple iterations of the samle lat/lon for specific IP so we can establish weight
 class DictList(dict):
@@ -61,29 +67,28 @@ def get_ip(ip_file):
     with contextlib.closing(ip_file):
         return [line.strip() for line in ip_file]
 
-def geoip_lat_lon(gi, ip_list=[], lats=[], lons=[]):
+def geoip_lat_lon(database, ip_list=[], lats=[], lons=[]):
     """
-    This function uses the MaxMind library and databases to geolocate IP addresses
+    This function uses the MaxMind library and databases to geolocate IP addresses.
+    All addresses are looked up in one batch through the shared reader in relay_selection/geoip.py.
     Returns two lists (latitude and longitude).
     """
     print("Processing {} IPs...".format(len(ip_list)))
-    for ip in ip_list:
-        try:
-            r = gi.city(ip)
-        except Exception:
-            print("Unable to locate or process IP: %s" % ip)
-            continue
-        if r is None or r.location.latitude is None or r.location.longitude is None:
+    latitudes, longitudes, _ = lookup_locations(database, ip_list)
+    for ip, latitude, longitude in zip(ip_list, latitudes, longitudes):
+        if np.isnan(latitude) or np.isnan(longitude):
             print("Unable to find lat/long for IP: %s" % ip)
             continue
+        latitude = float(latitude)
+        longitude = float(longitude)
         # put numbers to list
-        lats.append(r.location.latitude)
-        lons.append(r.location.longitude)
+        lats.append(latitude)
+        lons.append(longitude)
 
         # append to dictionary - to be used for later and where plot type needs it (it will only hold unique values)
-        long_lat[ip] = {'lats':r.location.latitude,'lons':r.location.longitude}
+        long_lat[ip] = {'lats':latitude,'lons':longitude}
         # Experimental for heatmap        
-        long_lat2[ip] = {'lats':r.location.latitude,'lons':r.location.longitude}
+        long_lat2[ip] = {'lats':latitude,'lons':longitude}
 
     return lats, lons
 
@@ -181,7 +186,7 @@ def main():
     arguments = argparse.ArgumentParser(description='Visualize IP addresses on the map')
     arguments.add_argument('-i', '--input', dest="input", type=argparse.FileType('r'), help='Input file. One IP per line',default=sys.stdin)
     arguments.add_argument('-o', '--output', default='output.png', help='Path to save the file (e.g. /tmp/output.png)')
-    arguments.add_argument('-db', '--db', default=None, help='Full path to MaxMind GeoLite2-City.mmdb database file (download from https://dev.maxmind.com/geoip/geoip2/geolite2/)')
+    arguments.add_argument('-db', '--db', default=GEOIP_DATABASE, help='Full path to MaxMind GeoLite2-City.mmdb database file (download from https://dev.maxmind.com/geoip/geoip2/geolite2/)')
     arguments.add_argument('-e','--extents', default=None, help='Extents for the plot (west/east/south/north). Default to globe.')
     arguments.add_argument("-t","--type", default="scatter", help="Plot type scatter, bubble, connectionmap, heatmap, hexbin")
     arguments.add_argument("-d","--destination", default=None, help="When connectionmap line plot is used, add latitude and longitude as destination (i.e. -d 51.50/0.12)")
@@ -192,10 +197,8 @@ def main():
 
     # Get list of IPs out of file
     ip_list = get_ip(args.input)
-    # Parse MaxMind db file
-    gi = geoip2.database.Reader(args.db)
     # Get latitude and longitude as lists
-    lats, lons = geoip_lat_lon(gi, ip_list)
+    lats, lons = geoip_lat_lon(args.db, ip_list)
     # Call final function to start drawing on the map
     generate_map(output, lats, lons, plottype=args.type, wesn=args.extents,plotdest=args.destination)
 
@@ -0,0 +1,6 @@
+"""
+Shared relay selection helpers used by the experiment scripts in the appendix folders.
+
+The experiment scripts are run as standalone files, so they put the repository root on
+sys.path before importing from this package.
+"""
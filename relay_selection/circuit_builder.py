@@ -0,0 +1,185 @@
+"""
+Concurrent circuit building driven by Tor's CIRC events.
+
+controller.new_circuit(path, await_build=True) blocks until one circuit is built or fails,
+which can take up to CircuitBuildTimeout. CircuitBuilder sends EXTENDCIRCUIT without waiting
+and follows each circuit through its CIRC events instead, so many circuits can be built at
+once. build() returns a concurrent.futures.Future that resolves to a BuildResult when the
+circuit is BUILT, or when it FAILED or was CLOSED before that.
+"""
+import collections
+import concurrent.futures
+import threading
+import time
+
+import numpy as np
+import stem
+from stem import CircStatus
+from stem.control import EventType
+
+from relay_selection.timeline import CircuitTimeline
+
+# --------------------- Constants ---------------------#
+# Circuits being built at once
+MAX_IN_FLIGHT = 8
+
+# Bin edges in seconds of the build time histograms, the last bin holds everything slower
+HISTOGRAM_BINS = (0, 0.5, 1, 1.5, 2, 3, 4, 5, 7.5, 10, 15, 20, 30, 45, 60, float("inf"))
+
+# Outcome of a circuit build
+# - circuit_id: the circuit ID Tor assigned, None if EXTENDCIRCUIT itself failed
+# - path: the relay fingerprints the circuit was built through
+# - status: "BUILT", "FAILED" or "CLOSED"
+# - reason: Tor's reason for a failed or closed circuit (e.g. "TIMEOUT"), None if built
+# - build_time: seconds from EXTENDCIRCUIT to the final CIRC event
+BuildResult = collections.namedtuple("BuildResult", ["circuit_id", "path", "status", "reason", "build_time"])
+
+
+class CircuitBuilder:
+    """
+    Builds circuits without blocking on them, at most max_in_flight at a time.
+
+    Args:
+    - controller: an authenticated stem Controller
+    - max_in_flight: largest number of circuits being built at once, build() waits for a free slot
+
+    Attributes:
+    - build_times: seconds to the final event of each finished build, keyed by status
+    - failure_reasons: number of failed or closed builds for each reason
+    - timeline: CircuitTimeline with the per-hop build timeline of every circuit
+    """
+
+    def __init__(self, controller, max_in_flight=MAX_IN_FLIGHT):
+        self.controller = controller
+        self.build_times = {"BUILT": [], "FAILED": [], "CLOSED": []}
+        self.failure_reasons = collections.Counter()
+        self.timeline = CircuitTimeline(controller)
+        self._slots = threading.BoundedSemaphore(max_in_flight)
+        # Held while EXTENDCIRCUIT is sent, so no CIRC event is handled before its circuit is known
+        self._lock = threading.Lock()
+        # Circuit ID -> (future, path, start time) of the circuits being built
+        self._pending = {}
+        controller.add_event_listener(self._circuit_event, EventType.CIRC)
+
+    def in_flight(self):
+        """
+        Returns the number of circuits being built.
+        """
+        with self._lock:
+            return len(self._pending)
+
+    def _finish(self, circuit_id, status, reason):
+        # Called with the lock held. The future is resolved by the caller once the lock is
+        # released, so its callbacks can start new builds.
+        future, path, start = self._pending.pop(circuit_id)
+        build_time = time.time() - start
+        self.build_times[status].append(build_time)
+        if status != "BUILT":
+            self.failure_reasons[reason] += 1
+        self._slots.release()
+        return future, BuildResult(circuit_id, path, status, reason, build_time)
+
+    def _circuit_event(self, event):
+        with self._lock:
+            if event.id not in self._pending:
+                return
+            if event.status == CircStatus.BUILT:
+                future, result = self._finish(event.id, "BUILT", None)
+            elif event.status in (CircStatus.FAILED, CircStatus.CLOSED):
+                future, result = self._finish(event.id, str(event.status), event.remote_reason or event.reason)
+            else:
+                return
+        future.set_result(result)
+
+    def build(self, path, purpose="general"):
+        """
+        Starts building a circuit through path and returns at once, unless max_in_flight circuits
+        are being built, in which case it waits for one of them to finish first.
+
+        Args:
+        - path: the relay fingerprints of the circuit, e.g. [entry, middle, exit]
+        - purpose: the circuit purpose, "general" like controller.new_circuit()
+
+        Returns:
+        - a concurrent.futures.Future resolving to a BuildResult
+        """
+        self._slots.acquire()
+        future = concurrent.futures.Future()
+        # The slot is released by _finish() once the build is pending, and here on any other
+        # way out, e.g. a closed control socket or a KeyboardInterrupt
+        pending = False
+        try:
+            with self._lock:
+                start = time.time()
+                try:
+                    circuit_id = self.controller.extend_circuit("0", path, purpose)
+                except stem.ControllerError as exc:
+                    self.failure_reasons[str(exc)] += 1
+                    future.set_result(BuildResult(None, path, "FAILED", str(exc), time.time() - start))
+                    return future
+                self._pending[circuit_id] = (future, path, start)
+                pending = True
+        finally:
+            if not pending:
+                self._slots.release()
+        return future
+
+    def abandon(self, future, reason="TIMEOUT"):
+        """
+        Stops waiting for a build, e.g. one that took longer than CircuitBuildTimeout. The build
+        resolves as FAILED with reason and frees its slot, the caller closes the circuit.
+
+        Args:
+        - future: a future returned by build()
+        - reason: the failure reason to record
+
+        Returns:
+        - the BuildResult of the build, its actual outcome if it finished before it was abandoned
+        """
+        with self._lock:
+            circuit_id = next(
+                (circuit_id for circuit_id, entry in self._pending.items() if entry[0] is future), None
+            )
+            if circuit_id is not None:
+                future, result = self._finish(circuit_id, "FAILED", reason)
+        if circuit_id is not None:
+            future.set_result(result)
+        return future.result()
+
+    def build_many(self, paths, purpose="general"):
+        """
+        Starts building a circuit for each path, see build(), and returns their futures in order.
+        """
+        return [self.build(path, purpose) for path in paths]
+
+    def histogram(self, status="BUILT", bins=HISTOGRAM_BINS):
+        """
+        Returns the histogram of build times for an outcome.
+
+        Returns:
+        - a dictionary with the bin "edges" in seconds and the number of builds in each bin as "counts"
+        """
+        counts, edges = np.histogram(self.build_times[status], bins=bins)
+        return {"edges": [float(edge) for edge in edges], "counts": counts.tolist()}
+
+    def summary(self):
+        """
+        Returns the build time histogram of every outcome and the failure reasons, e.g. to save
+        next to the results of an experiment.
+        """
+        return {
+            "histograms": {status: self.histogram(status) for status in self.build_times},
+            "failure_reasons": dict(self.failure_reasons),
+        }
+
+    def close(self):
+        """
+        Stops listening for CIRC events. Circuits still being built resolve as CLOSED with the
+        reason "BUILDER_CLOSED".
+        """
+        self.controller.remove_event_listener(self._circuit_event)
+        self.timeline.close()
+        with self._lock:
+            finished = [self._finish(circuit_id, "CLOSED", "BUILDER_CLOSED") for circuit_id in list(self._pending)]
+        for future, result in finished:
+            future.set_result(result)
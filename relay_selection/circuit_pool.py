@@ -0,0 +1,322 @@
+"""
+Pool of pre-built circuits ranked by RTT.
+
+CircuitPool keeps size circuits built, in a heap ordered by their last measured RTT, so best()
+returns the circuit with the lowest RTT in O(1). A background thread maintains the pool:
+
+- circuits idle for max_idle seconds since they were last handed out (or since they joined the
+  pool if they never were) are closed, as are circuits first handed out more than max_age seconds
+  ago, like Tor's MaxCircuitDirtiness
+- every circuit's RTT is probed again after probe_interval seconds and its rank updated
+- missing circuits are built concurrently with a CircuitBuilder, and once the pool is full one
+  challenger per round replaces the slowest circuit that was never handed out if it is faster
+
+Circuits Tor closes or that fail a probe leave the pool at once.
+"""
+import collections
+import concurrent.futures
+import heapq
+import itertools
+import threading
+import time
+
+import stem
+from stem import CircStatus
+from stem.control import EventType
+
+from relay_selection.circuit_builder import CircuitBuilder
+
+# --------------------- Constants ---------------------#
+# Circuits kept in the pool
+POOL_SIZE = 5
+
+# Seconds a circuit may go without being handed out
+MAX_IDLE = 5 * 60
+
+# Seconds a circuit is handed out for after its first use, Tor's default MaxCircuitDirtiness
+MAX_AGE = 10 * 60
+
+# Seconds between RTT probes of a circuit
+PROBE_INTERVAL = 60
+
+# Seconds between maintenance rounds
+MAINTENANCE_INTERVAL = 10
+
+# Circuits built per round to challenge the slowest one once the pool is full
+CHALLENGERS = 1
+
+# Seconds to wait for a circuit build, somewhat above the CircuitBuildTimeout of 60 seconds the
+# experiments start Tor with. Builds that take longer are counted as failed and closed.
+BUILD_TIMEOUT = 75
+
+
+class CircuitPool:
+    """
+    Keeps size circuits built and ranked by RTT, see the module docstring.
+
+    Args:
+    - controller: an authenticated stem Controller
+    - prober: relay_selection.rtt.RttProber to measure the RTTs with
+    - paths: iterator of [entry, middle, exit] fingerprint paths for new circuits, e.g. a
+    PathPrefetcher. If None, Tor chooses the path of each circuit.
+    - size: number of circuits kept in the pool
+    - max_idle, max_age, probe_interval: seconds, see the module docstring
+    - interval: seconds between maintenance rounds
+    - builder: CircuitBuilder to build the circuits with, a new one if None
+    - build_timeout: seconds to wait for a circuit build before it is abandoned and closed
+
+    Attributes:
+    - circuits: circuit ID -> dictionary with the "path", "rtt", "joined", "probed", "first_used",
+    "last_used" and "uses" of each circuit in the pool
+    - evicted: number of circuits that left the pool for each reason
+    """
+
+    def __init__(
+        self,
+        controller,
+        prober,
+        paths=None,
+        size=POOL_SIZE,
+        max_idle=MAX_IDLE,
+        max_age=MAX_AGE,
+        probe_interval=PROBE_INTERVAL,
+        interval=MAINTENANCE_INTERVAL,
+        builder=None,
+        build_timeout=BUILD_TIMEOUT,
+    ):
+        self.controller = controller
+        self.paths = iter(paths) if paths is not None else None
+        self.size = size
+        self.max_idle = max_idle
+        self.max_age = max_age
+        self.probe_interval = probe_interval
+        self.interval = interval
+        self._own_builder = builder is None
+        self.builder = builder if builder is not None else CircuitBuilder(controller)
+        self.prober = prober
+        self.build_timeout = build_timeout
+
+        self.circuits = {}
+        self.evicted = collections.Counter()
+        # (rtt, sequence, circuit ID) of every circuit. Entries whose sequence is no longer the
+        # circuit's are stale and are dropped once they reach the top.
+        self._heap = []
+        self._sequence = itertools.count()
+        self._lock = threading.Lock()
+        self._ready = threading.Condition(self._lock)
+        self._closed = threading.Event()
+        controller.add_event_listener(self._circuit_event, EventType.CIRC)
+        self._worker = threading.Thread(target=self._maintain, name="circuit-pool", daemon=True)
+        self._worker.start()
+
+    # --------------------- Ranking ---------------------#
+    def _is_current(self, item):
+        rtt, sequence, circuit_id = item
+        entry = self.circuits.get(circuit_id)
+        return entry is not None and entry["sequence"] == sequence
+
+    def _prune(self):
+        # Called with the lock held, keeps a current entry at the top of the heap
+        if len(self._heap) > 4 * len(self.circuits) + 16:
+            self._heap = [item for item in self._heap if self._is_current(item)]
+            heapq.heapify(self._heap)
+        while self._heap and not self._is_current(self._heap[0]):
+            heapq.heappop(self._heap)
+
+    def _rank(self, circuit_id, rtt):
+        # Called with the lock held
+        entry = self.circuits[circuit_id]
+        entry["rtt"] = rtt
+        entry["sequence"] = next(self._sequence)
+        heapq.heappush(self._heap, (rtt, entry["sequence"], circuit_id))
+        self._prune()
+
+    def _remove(self, circuit_id, reason):
+        # Called with the lock held, returns whether the circuit was in the pool
+        if self.circuits.pop(circuit_id, None) is None:
+            return False
+        self.evicted[reason] += 1
+        self._prune()
+        return True
+
+    def _close(self, circuit_ids):
+        for circuit_id in circuit_ids:
+            try:
+                self.controller.close_circuit(circuit_id)
+            except stem.ControllerError:
+                # Already closed by Tor
+                pass
+
+    def _circuit_event(self, event):
+        if event.status in (CircStatus.FAILED, CircStatus.CLOSED):
+            with self._lock:
+                self._remove(event.id, "CLOSED")
+
+    def best(self):
+        """
+        Hands out the circuit with the lowest RTT, in O(1).
+
+        Returns:
+        - the circuit ID, or None if the pool is empty
+        """
+        with self._lock:
+            if not self._heap:
+                return None
+            circuit_id = self._heap[0][2]
+            entry = self.circuits[circuit_id]
+            entry["last_used"] = time.time()
+            if entry["first_used"] is None:
+                entry["first_used"] = entry["last_used"]
+            entry["uses"] += 1
+            return circuit_id
+
+    def wait_ready(self, timeout=None):
+        """
+        Waits until the pool holds at least one circuit.
+
+        Returns:
+        - True if it does, False if the timeout expired or the pool was closed
+        """
+        with self._ready:
+            self._ready.wait_for(lambda: self._heap or self._closed.is_set(), timeout)
+            return bool(self._heap)
+
+    def ranking(self):
+        """
+        Returns (circuit ID, RTT) of every circuit in the pool, lowest RTT first.
+        """
+        with self._lock:
+            ranking = [(circuit_id, entry["rtt"]) for circuit_id, entry in self.circuits.items()]
+        return sorted(ranking, key=lambda item: item[1])
+
+    def stats(self):
+        """
+        Returns the ranking and the number of circuits evicted for each reason.
+        """
+        return {"ranking": self.ranking(), "evicted": dict(self.evicted)}
+
+    # --------------------- Maintenance ---------------------#
+    def _evict_expired(self, now):
+        expired = []
+        with self._lock:
+            for circuit_id, entry in list(self.circuits.items()):
+                if now - entry["last_used"] > self.max_idle:
+                    reason = "IDLE"
+                elif entry["first_used"] is not None and now - entry["first_used"] > self.max_age:
+                    reason = "AGE"
+                else:
+                    continue
+                self._remove(circuit_id, reason)
+                expired.append(circuit_id)
+        self._close(expired)
+
+    def _reprobe(self, now):
+        with self._lock:
+            due = [circuit_id for circuit_id, entry in self.circuits.items() if now - entry["probed"] >= self.probe_interval]
+        for circuit_id in due:
+            rtt = self.prober.probe(circuit_id)
+            with self._lock:
+                if circuit_id not in self.circuits:
+                    continue
+                if rtt is None:
+                    self._remove(circuit_id, "PROBE_FAILED")
+                else:
+                    self.circuits[circuit_id]["probed"] = time.time()
+                    self._rank(circuit_id, rtt)
+                    continue
+            self._close([circuit_id])
+
+    def _add(self, build):
+        rtt = self.prober.probe(build.circuit_id)
+        if rtt is None:
+            with self._lock:
+                self.evicted["PROBE_FAILED"] += 1
+            self._close([build.circuit_id])
+            return
+
+        now = time.time()
+        # The challenger itself if it is not faster, otherwise the circuit it replaces
+        closing = None
+        with self._ready:
+            if len(self.circuits) >= self.size:
+                unused = [circuit_id for circuit_id, entry in self.circuits.items() if not entry["uses"]]
+                slowest = max(unused, key=lambda circuit_id: self.circuits[circuit_id]["rtt"], default=None)
+                if slowest is None or rtt >= self.circuits[slowest]["rtt"]:
+                    closing = build.circuit_id
+                else:
+                    self._remove(slowest, "REPLACED")
+                    closing = slowest
+            if closing != build.circuit_id:
+                self.circuits[build.circuit_id] = {
+                    "path": build.path,
+                    "rtt": rtt,
+                    "joined": now,
+                    "probed": now,
+                    "first_used": None,
+                    "last_used": now,
+                    "uses": 0,
+                    "sequence": None,
+                }
+                self._rank(build.circuit_id, rtt)
+                self._ready.notify_all()
+        if closing is not None:
+            self._close([closing])
+
+    def _next_paths(self, count):
+        if self.paths is None:
+            return [None] * count
+        return list(itertools.islice(self.paths, count))
+
+    def _replenish(self):
+        with self._lock:
+            missing = self.size - len(self.circuits)
+        for future in self.builder.build_many(self._next_paths(missing if missing > 0 else CHALLENGERS)):
+            try:
+                build = future.result(timeout=self.build_timeout)
+            except concurrent.futures.TimeoutError:
+                # No CIRC event finished the build in time, stop waiting for it and close it
+                build = self.builder.abandon(future)
+                if build.status != "BUILT":
+                    self._close([build.circuit_id])
+                    continue
+            if build.status == "BUILT" and not self._closed.is_set():
+                self._add(build)
+            elif build.status == "BUILT":
+                self._close([build.circuit_id])
+
+    def _maintain(self):
+        while not self._closed.is_set():
+            try:
+                self._evict_expired(time.time())
+                self._replenish()
+                self._reprobe(time.time())
+            except stem.SocketClosed:
+                break
+            except stem.ControllerError as exc:
+                print(f"ERROR: Circuit pool maintenance failed: {exc}")
+            self._closed.wait(self.interval)
+        with self._ready:
+            self._ready.notify_all()
+
+    def close(self):
+        """
+        Stops the maintenance thread and closes every circuit in the pool.
+        """
+        self._closed.set()
+        with self._ready:
+            self._ready.notify_all()
+        self._worker.join()
+        self.controller.remove_event_listener(self._circuit_event)
+        with self._lock:
+            circuit_ids = list(self.circuits)
+            self.circuits.clear()
+            self._heap = []
+        self._close(circuit_ids)
+        if self._own_builder:
+            self.builder.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
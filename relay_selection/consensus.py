@@ -0,0 +1,262 @@
+"""
+Builds the relay list from the consensus and descriptors Tor keeps in its DataDirectory.
+
+This is an offline alternative to the Onionoo request in experiment(). The relays are returned
+as the same compact records iter_relays() produces (see onionoo.RELAY_FIELDS), so they can be
+put straight into a RelayTable.
+"""
+import calendar
+import datetime
+import os
+
+import stem.descriptor
+
+from relay_selection.onionoo import RELAY_FIELDS, compact_relay
+
+# --------------------- Constants ---------------------#
+# Files in Tor's DataDirectory, the first consensus that exists is used
+CONSENSUS_FILES = ("cached-microdesc-consensus", "cached-consensus")
+MICRODESCRIPTOR_FILES = ("cached-microdescs", "cached-microdescs.new")
+SERVER_DESCRIPTOR_FILES = ("cached-descriptors", "cached-descriptors.new")
+
+CONSENSUS_TYPE = "network-status-consensus-3 1.0"
+MICRODESC_CONSENSUS_TYPE = "network-status-microdesc-consensus-3 1.0"
+MICRODESCRIPTOR_TYPE = "microdescriptor 1.0"
+SERVER_DESCRIPTOR_TYPE = "server-descriptor 1.0"
+
+
+def exit_policy_rules(policy):
+    """
+    Converts a stem exit policy summary (from a microdescriptor or the consensus "p" line) to
+    the list of rules Onionoo returns in exit_policy, e.g. ["accept *:80", "reject *:*"].
+    """
+    if policy is None:
+        return ["reject *:*"]
+    rules = [str(rule) for rule in policy]
+    if rules[-1] not in ("accept *:*", "reject *:*"):
+        # A summary lists the exceptions, everything else gets the opposite action
+        rules.append("reject *:*" if policy.is_accept else "accept *:*")
+    return rules
+
+
+def parse_overload_general(lines):
+    """
+    Returns the overload_general_timestamp in milliseconds from a server descriptor's
+    "overload-general <version> <YYYY-MM-DD HH:MM:SS>" line, or None if it has none.
+    """
+    for line in lines:
+        if line.startswith("overload-general "):
+            fields = line.split()
+            try:
+                published = datetime.datetime.strptime(" ".join(fields[2:4]), "%Y-%m-%d %H:%M:%S")
+            except (IndexError, ValueError):
+                return None
+            return calendar.timegm(published.timetuple()) * 1000
+    return None
+
+
+def family_fingerprints(family):
+    """
+    Returns the fingerprints in a descriptor's declared family, e.g. {"$ABCD...", "$EF01...=nick"}.
+    Nicknames are skipped, since they do not identify a relay.
+    """
+    fingerprints = set()
+    for member in family or ():
+        if member.startswith("$"):
+            fingerprints.add(member[1:41].upper())
+    return fingerprints
+
+
+def effective_families(declared):
+    """
+    Returns the effective family of each relay, like Onionoo's effective_family: the relay itself
+    and the relays that declare it in their family while it declares them in its own.
+
+    Args:
+    - declared: a dictionary mapping fingerprints to the set of fingerprints the relay declares
+
+    Returns:
+    - a dictionary mapping each fingerprint to its sorted list of $-prefixed family fingerprints
+    """
+    families = {}
+    for fingerprint, members in declared.items():
+        mutual = {member for member in members if fingerprint in declared.get(member, ())}
+        families[fingerprint] = ["$" + member for member in sorted(mutual | {fingerprint})]
+    return families
+
+
+def consensus_type(path):
+    """
+    Returns the stem descriptor type of a consensus file, based on its network-status-version
+    line ("network-status-version 3 microdesc" for a microdescriptor consensus).
+    """
+    with open(path, "rb") as infile:
+        for line in infile:
+            if line.startswith(b"network-status-version"):
+                return MICRODESC_CONSENSUS_TYPE if b"microdesc" in line else CONSENSUS_TYPE
+    return CONSENSUS_TYPE
+
+
+def _existing(data_directory, names):
+    paths = [os.path.join(data_directory, name) for name in names]
+    return [path for path in paths if os.path.exists(path)]
+
+
+def read_microdescriptors(paths):
+    """
+    Reads microdescriptors and returns them keyed by their base64 SHA256 digest, which is how
+    the microdescriptor consensus refers to them.
+    """
+    microdescriptors = {}
+    for path in paths:
+        for microdescriptor in stem.descriptor.parse_file(path, MICRODESCRIPTOR_TYPE):
+            microdescriptors[microdescriptor.digest()] = microdescriptor
+    return microdescriptors
+
+
+def read_server_descriptors(paths):
+    """
+    Reads server descriptors and returns them keyed by fingerprint. When a relay has several
+    descriptors the most recently published one is kept.
+    """
+    descriptors = {}
+    for path in paths:
+        for descriptor in stem.descriptor.parse_file(path, SERVER_DESCRIPTOR_TYPE):
+            previous = descriptors.get(descriptor.fingerprint)
+            if previous is None or descriptor.published > previous.published:
+                descriptors[descriptor.fingerprint] = descriptor
+    return descriptors
+
+
+def read_bandwidth_weights(data_directory=None, consensus_path=None):
+    """
+    Returns the bandwidth-weights line of Tor's cached consensus as a dictionary, e.g.
+    {"Wgg": 5917, "Wmg": 4083, "Wee": 10000, ...}, or None if there is no cached consensus or it
+    has no weights.
+
+    Args:
+    - data_directory: Tor's DataDirectory
+    - consensus_path: path of a consensus file, overrides the one in data_directory
+    """
+    if consensus_path is None:
+        consensus_paths = _existing(data_directory, CONSENSUS_FILES)
+        if not consensus_paths:
+            return None
+        consensus_path = consensus_paths[0]
+
+    documents = stem.descriptor.parse_file(
+        consensus_path,
+        consensus_type(consensus_path),
+        document_handler=stem.descriptor.DocumentHandler.BARE_DOCUMENT,
+    )
+    for document in documents:
+        return dict(document.bandwidth_weights) or None
+    return None
+
+
+def read_cached_relays(
+    data_directory=None,
+    consensus_path=None,
+    microdescriptor_paths=None,
+    server_descriptor_paths=None,
+    running_only=True,
+):
+    """
+    Builds the relay list from Tor's cached consensus and descriptors.
+
+    The consensus provides the fingerprint, addresses, flags and consensus weight of each relay.
+    A microdescriptor consensus only has exit policies in the microdescriptors, so those are
+    read as well. Without any microdescriptor a FileNotFoundError is raised, since every exit
+    would get "reject *:*" and be dropped by the exit port filter. Relays whose microdescriptor
+    is missing are counted and a warning is printed. Families are declared in the descriptors,
+    and only mutual declarations end up in effective_family. Observed bandwidth and overload
+    timestamps only exist in server descriptors, which Tor caches when FetchUselessDescriptors is
+    set. Without them the observed bandwidth is estimated from the consensus weight (kilobytes to
+    bytes) and no relay is marked overloaded.
+
+    The paths can be given explicitly instead of a data directory, e.g. to read a fixture file.
+
+    Args:
+    - data_directory: Tor's DataDirectory
+    - consensus_path: path of a consensus file, overrides the one in data_directory
+    - microdescriptor_paths: paths of microdescriptor files, overrides the ones in data_directory
+    - server_descriptor_paths: paths of server descriptor files, overrides the ones in data_directory
+    - running_only: only return relays with the Running flag, like Onionoo's running=true
+
+    Returns:
+    - a list of relay dictionaries with the fields in onionoo.RELAY_FIELDS
+    """
+    if consensus_path is None:
+        consensus_paths = _existing(data_directory, CONSENSUS_FILES)
+        if not consensus_paths:
+            raise FileNotFoundError(f"No cached consensus found in {data_directory}")
+        consensus_path = consensus_paths[0]
+
+    if microdescriptor_paths is None:
+        microdescriptor_paths = _existing(data_directory, MICRODESCRIPTOR_FILES) if data_directory else []
+    if server_descriptor_paths is None:
+        server_descriptor_paths = _existing(data_directory, SERVER_DESCRIPTOR_FILES) if data_directory else []
+
+    microdescriptors = read_microdescriptors(microdescriptor_paths)
+    server_descriptors = read_server_descriptors(server_descriptor_paths)
+
+    descriptor_type = consensus_type(consensus_path)
+    if descriptor_type == MICRODESC_CONSENSUS_TYPE and not microdescriptors:
+        raise FileNotFoundError(
+            f"No microdescriptors found for the microdescriptor consensus {consensus_path}, "
+            f"the exit policies are only in {' or '.join(MICRODESCRIPTOR_FILES)}"
+        )
+
+    relays = []
+    declared = {}
+    missing_microdescriptors = 0
+    for entry in stem.descriptor.parse_file(consensus_path, descriptor_type):
+        if running_only and "Running" not in entry.flags:
+            continue
+
+        or_addresses = [f"{entry.address}:{entry.or_port}"]
+        for address, port, is_ipv6 in entry.or_addresses:
+            or_addresses.append(f"[{address}]:{port}" if is_ipv6 else f"{address}:{port}")
+
+        relay = {
+            "fingerprint": entry.fingerprint,
+            "or_addresses": or_addresses,
+            "flags": list(entry.flags),
+            "consensus_weight": entry.bandwidth or 0,
+        }
+
+        # The full consensus has the exit policy summary in the entry itself
+        policy = getattr(entry, "exit_policy", None)
+        microdescriptor = microdescriptors.get(getattr(entry, "microdescriptor_digest", None))
+        if microdescriptor is not None:
+            policy = microdescriptor.exit_policy
+        elif descriptor_type == MICRODESC_CONSENSUS_TYPE:
+            missing_microdescriptors += 1
+        relay["exit_policy"] = exit_policy_rules(policy)
+
+        descriptor = server_descriptors.get(entry.fingerprint)
+        family = descriptor.family if descriptor is not None else getattr(microdescriptor, "family", None)
+        declared[entry.fingerprint] = family_fingerprints(family)
+        if descriptor is not None:
+            relay["observed_bandwidth"] = descriptor.observed_bandwidth
+            overload = parse_overload_general(descriptor.get_unrecognized_lines())
+            if overload is not None:
+                relay["overload_general_timestamp"] = overload
+        else:
+            relay["observed_bandwidth"] = relay["consensus_weight"] * 1000
+        relays.append(relay)
+
+    if missing_microdescriptors:
+        print(
+            f"WARNING: {missing_microdescriptors} of {len(relays)} relays have no microdescriptor, "
+            f"their exit policy is taken as reject *:*. The cached microdescriptors may be out of date."
+        )
+
+    # Families are only known once every relay has been read
+    families = effective_families(declared)
+    shared = {}
+    compact = []
+    for relay in relays:
+        relay["effective_family"] = families[relay["fingerprint"]]
+        compact.append(compact_relay(relay, RELAY_FIELDS, shared))
+    return compact
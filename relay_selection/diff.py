@@ -0,0 +1,187 @@
+"""
+Incremental relay enrichment based on the difference between two relay snapshots.
+
+Between two runs only a few relays join, leave or change address, so the GeoIP lookup and
+distance calculation of the previous run are cached on disk and only the relays that are new
+or have a new address are looked up again.
+"""
+import json
+import os
+
+import numpy as np
+
+from relay_selection.onionoo import DEFAULT_CACHE_DIR
+from relay_selection.table import calc_distance, get_lat_long
+
+# --------------------- Constants ---------------------#
+DEFAULT_ENRICHMENT_CACHE = os.path.join(DEFAULT_CACHE_DIR, "enriched_table.npz")
+
+# Columns saved in the enrichment cache
+CACHED_COLUMNS = (
+    "fingerprint",
+    "ipv4_address",
+    "latitude",
+    "longitude",
+    "distance",
+    "observed_bandwidth",
+    "consensus_weight",
+    "flags",
+)
+
+
+class SnapshotDiff:
+    """
+    Difference between a previous and a new relay snapshot, matched by fingerprint.
+
+    Attributes (row indices into the new snapshot unless noted otherwise):
+    - added: relays that are not in the previous snapshot
+    - removed: fingerprints of previous relays that are not in the new snapshot
+    - readdressed: relays whose IPv4 address changed
+    - bandwidth_changed: relays whose observed bandwidth or consensus weight changed
+    - flags_changed: relays whose flags changed
+    - previous_rows, rows: matching rows of the relays in both snapshots
+    """
+
+    def __init__(self, previous, current):
+        previous_fingerprints = np.asarray(previous["fingerprint"], dtype=str)
+        current_fingerprints = np.asarray(current["fingerprint"], dtype=str)
+
+        _, previous_rows, rows = np.intersect1d(
+            previous_fingerprints, current_fingerprints, assume_unique=True, return_indices=True
+        )
+        self.previous_rows = previous_rows
+        self.rows = rows
+
+        in_previous = np.zeros(len(current_fingerprints), dtype=bool)
+        in_previous[rows] = True
+        in_current = np.zeros(len(previous_fingerprints), dtype=bool)
+        in_current[previous_rows] = True
+
+        self.added = np.flatnonzero(~in_previous)
+        self.removed = previous_fingerprints[~in_current].tolist()
+
+        def changed(column):
+            return previous[column][previous_rows] != current[column][rows]
+
+        self.readdressed = rows[changed("ipv4_address")]
+        self.bandwidth_changed = rows[changed("observed_bandwidth") | changed("consensus_weight")]
+        self.flags_changed = rows[changed("flags")]
+
+    def unchanged_address(self):
+        """
+        Returns the matching (previous_rows, rows) of relays that kept their IPv4 address.
+        """
+        keep = np.isin(self.rows, self.readdressed, invert=True)
+        return self.previous_rows[keep], self.rows[keep]
+
+    def summary(self):
+        """
+        Returns a one line description of the difference.
+        """
+        return (
+            f"Relays added: {len(self.added)}, removed: {len(self.removed)}, "
+            f"readdressed: {len(self.readdressed)}, bandwidth changed: {len(self.bandwidth_changed)}, "
+            f"flags changed: {len(self.flags_changed)}"
+        )
+
+
+def diff_snapshots(previous, current):
+    """
+    Compares two relay snapshots by fingerprint.
+
+    Args:
+    - previous, current: dictionaries of columns, see RelayTable.columns()
+
+    Returns:
+    - a SnapshotDiff
+    """
+    return SnapshotDiff(previous, current)
+
+
+class EnrichmentCache:
+    """
+    Keeps the enriched columns of the last RelayTable on disk.
+
+    The cache entry is only used when it was made with the same GeoIP database file and client
+    location, so replacing the mmdb file or moving the client makes every relay be enriched again.
+
+    Args:
+    - path: the .npz file the columns are saved in
+    """
+
+    def __init__(self, path=DEFAULT_ENRICHMENT_CACHE):
+        self.path = path
+
+    @staticmethod
+    def key(database, client_lat, client_long):
+        """
+        Returns the key identifying the GeoIP database and client location of an enrichment.
+        """
+        stat = os.stat(database)
+        return json.dumps([os.path.abspath(database), stat.st_size, stat.st_mtime, client_lat, client_long])
+
+    def load(self, key):
+        """
+        Returns the cached columns if they were saved with the same key, otherwise None.
+        """
+        if not os.path.exists(self.path):
+            return None
+        try:
+            with np.load(self.path, allow_pickle=False) as data:
+                if str(data["key"]) != key:
+                    return None
+                columns = {column: data[column] for column in CACHED_COLUMNS}
+        except (OSError, ValueError, KeyError):
+            return None
+        columns["ipv4_address"] = np.where(columns["ipv4_address"] == "", None, columns["ipv4_address"].astype(object))
+        return columns
+
+    def save(self, table, key):
+        """
+        Saves the enriched columns of a RelayTable under a key.
+        """
+        columns = table.columns()
+        data = {column: columns[column] for column in CACHED_COLUMNS}
+        data["fingerprint"] = np.asarray(data["fingerprint"], dtype=str)
+        data["ipv4_address"] = np.array(["" if address is None else address for address in data["ipv4_address"]], dtype=str)
+
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        with open(self.path + ".tmp", "wb") as outfile:
+            np.savez(outfile, key=np.array(key), **data)
+        os.replace(self.path + ".tmp", self.path)
+
+
+def enrich_table(table, database, client_lat, client_long, cache=None):
+    """
+    Adds the location and distance of every relay to a RelayTable, reusing the cached enrichment
+    of the previous table for relays that kept their address.
+
+    Args:
+    - table: a RelayTable
+    - database: path to the GeoLite2 City mmdb file
+    - client_lat, client_long: the client location in degrees
+    - cache: an EnrichmentCache, the default cache in ./relay_cache if None
+
+    Returns:
+    - the SnapshotDiff against the cached table, or None if every relay had to be enriched
+    """
+    if cache is None:
+        cache = EnrichmentCache()
+    key = EnrichmentCache.key(database, client_lat, client_long)
+    previous = cache.load(key)
+
+    if previous is None:
+        snapshot_diff = None
+        rows = table.all_rows()
+    else:
+        snapshot_diff = diff_snapshots(previous, table.columns())
+        previous_rows, kept_rows = snapshot_diff.unchanged_address()
+        table.latitude[kept_rows] = previous["latitude"][previous_rows]
+        table.longitude[kept_rows] = previous["longitude"][previous_rows]
+        table.distance[kept_rows] = previous["distance"][previous_rows]
+        rows = np.concatenate([snapshot_diff.added, snapshot_diff.readdressed])
+
+    get_lat_long(table, database, rows)
+    calc_distance(table, client_lat, client_long, rows)
+    cache.save(table, key)
+    return snapshot_diff
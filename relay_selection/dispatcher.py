@@ -0,0 +1,145 @@
+"""
+One STREAM listener that attaches every new stream to its circuit.
+
+attach_stream_to_circuit() in the experiment scripts registered a new STREAM listener per request
+and attached every new stream to that request's circuit, toggling __LeaveStreamsUnattached around
+it, so only one request could be in flight. StreamDispatcher sets __LeaveStreamsUnattached once and
+keeps one listener for the whole experiment. A request routes its circuit before it connects and
+the dispatcher recognises the request's stream by:
+
+- its SOCKS username, "circuit-<circuit ID>", which the request sends to the SocksPort (pycurl's
+  PROXYUSERNAME). Tor reports it as SOCKS_USERNAME in the STREAM event.
+- or the source port of its connection to the SocksPort, for sockets bound before they connect
+
+Streams that match no route go to fallback(), or are left to Tor's own circuit selection.
+"""
+import collections
+import threading
+
+import stem
+from stem import StreamStatus
+from stem.control import EventType
+
+# --------------------- Constants ---------------------#
+# SOCKS username of the streams routed to a circuit, followed by the circuit ID
+USERNAME_PREFIX = "circuit-"
+
+# Circuit ID that lets Tor choose the circuit of a stream
+TOR_CHOOSES = "0"
+
+
+def circuit_username(circuit_id):
+    """
+    Returns the SOCKS username whose streams are attached to circuit_id.
+    """
+    return f"{USERNAME_PREFIX}{circuit_id}"
+
+
+class StreamDispatcher:
+    """
+    Attaches new streams to the circuits routed for them, see the module docstring.
+
+    Args:
+    - controller: an authenticated stem Controller
+
+    Attributes:
+    - fallback: function returning the circuit ID for streams without a route, None lets Tor choose
+    - attached: number of streams attached to a routed circuit
+    - unmatched: number of streams without a route
+    - failed: number of streams that could not be attached, for example because the circuit closed
+    """
+
+    def __init__(self, controller):
+        self.controller = controller
+        self.fallback = None
+        self.attached = 0
+        self.unmatched = 0
+        self.failed = 0
+        self._lock = threading.Lock()
+        # Circuit ID -> number of requests routed to it
+        self._routes = collections.Counter()
+        # Source port -> circuit ID
+        self._ports = {}
+        # Source ports of routed streams that could not be attached
+        self._failed_ports = set()
+        controller.set_conf("__LeaveStreamsUnattached", "1")
+        controller.add_event_listener(self._stream_event, EventType.STREAM)
+
+    def route(self, circuit_id, source_port=None):
+        """
+        Routes new streams to circuit_id, by SOCKS username and by source_port if given. Every
+        route() is undone with unroute() once the request is over.
+
+        Returns:
+        - the SOCKS username to connect to the SocksPort with
+        """
+        with self._lock:
+            self._routes[circuit_id] += 1
+            if source_port is not None:
+                self._ports[source_port] = circuit_id
+        return circuit_username(circuit_id)
+
+    def unroute(self, circuit_id, source_port=None):
+        """
+        Undoes one route() to circuit_id.
+
+        Returns:
+        - True if the stream from source_port could not be attached to the circuit
+        """
+        with self._lock:
+            self._routes[circuit_id] -= 1
+            if self._routes[circuit_id] <= 0:
+                del self._routes[circuit_id]
+            if source_port is None:
+                return False
+            if self._ports.get(source_port) == circuit_id:
+                del self._ports[source_port]
+            if source_port in self._failed_ports:
+                self._failed_ports.discard(source_port)
+                return True
+            return False
+
+    def _circuit_for(self, event):
+        username = event.keyword_args.get("SOCKS_USERNAME") or ""
+        with self._lock:
+            if username.startswith(USERNAME_PREFIX) and username[len(USERNAME_PREFIX):] in self._routes:
+                return username[len(USERNAME_PREFIX):]
+            return self._ports.get(event.source_port)
+
+    def _stream_event(self, event):
+        if event.status not in (StreamStatus.NEW, StreamStatus.NEWRESOLVE):
+            return
+        circuit_id = self._circuit_for(event)
+        if circuit_id is None:
+            self.unmatched += 1
+            fallback = self.fallback
+            circuit_id = (fallback() if fallback is not None else None) or TOR_CHOOSES
+        else:
+            self.attached += 1
+
+        try:
+            self.controller.attach_stream(event.id, circuit_id)
+        except stem.ControllerError:
+            # The circuit is gone, closing the stream fails the request at once instead of
+            # leaving it unattached until SocksTimeout
+            self.failed += 1
+            with self._lock:
+                if self._ports.get(event.source_port) == circuit_id:
+                    self._failed_ports.add(event.source_port)
+            try:
+                self.controller.close_stream(event.id)
+            except stem.ControllerError:
+                pass
+
+    def stats(self):
+        """
+        Returns the number of attached, unmatched and failed streams.
+        """
+        return {"attached": self.attached, "unmatched": self.unmatched, "failed": self.failed}
+
+    def close(self):
+        """
+        Stops attaching streams and lets Tor attach them again.
+        """
+        self.controller.remove_event_listener(self._stream_event)
+        self.controller.reset_conf("__LeaveStreamsUnattached")
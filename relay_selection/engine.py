@@ -0,0 +1,155 @@
+"""
+Concurrent request measurements on pycurl's CurlMulti.
+
+measure_request() runs one pycurl.Curl().perform() at a time and sleeps between requests.
+MeasurementEngine keeps up to max_in_flight requests going at once. Each request waits for its
+circuit, a concurrent.futures.Future prepared in another thread, and its transfer then runs on a
+shared CurlMulti. Every transfer is sent to the SocksPort with the SOCKS username of its circuit,
+so the StreamDispatcher attaches it to that circuit, and it reports the same latency, TTFB and
+throughput as measure_request().
+"""
+import concurrent.futures
+import io
+import time
+
+import pycurl
+
+# --------------------- Constants ---------------------#
+SOCKS_PORT = 9050
+
+# Requests in flight at once, counting the ones still waiting for their circuit
+MAX_IN_FLIGHT = 8
+
+# Seconds the engine waits for socket activity or a circuit before checking again
+SELECT_TIMEOUT = 0.1
+
+
+class MeasurementEngine:
+    """
+    Runs request transfers through Tor concurrently, each on its own circuit.
+
+    Args:
+    - dispatcher: the relay_selection.dispatcher.StreamDispatcher of the controller
+    - socks_port: the SocksPort of the Tor client
+    - max_in_flight: largest number of requests in flight at once
+    """
+
+    def __init__(self, dispatcher, socks_port=SOCKS_PORT, max_in_flight=MAX_IN_FLIGHT):
+        self.dispatcher = dispatcher
+        self.socks_port = socks_port
+        self.max_in_flight = max_in_flight
+        self.multi = pycurl.CurlMulti()
+        # (url, circuit future, record) of the requests waiting for their circuit
+        self._waiting = []
+        # Curl handle -> (record, circuit, output buffer) of the running transfers
+        self._active = {}
+
+    def in_flight(self):
+        """
+        Returns the number of requests started and not finished, waiting for a circuit or transferring.
+        """
+        return len(self._waiting) + len(self._active)
+
+    def _start(self, url, circuit, record):
+        username = self.dispatcher.route(circuit["circuit_id"])
+        output = io.BytesIO()
+        query = pycurl.Curl()
+        query.setopt(pycurl.URL, url)
+        query.setopt(pycurl.PROXY, "localhost")
+        query.setopt(pycurl.PROXYPORT, self.socks_port)
+        query.setopt(pycurl.PROXYTYPE, pycurl.PROXYTYPE_SOCKS5_HOSTNAME)
+        query.setopt(pycurl.PROXYUSERNAME, username)
+        query.setopt(pycurl.WRITEFUNCTION, output.write)
+        query.setopt(pycurl.HEADERFUNCTION, output.write)
+        self._active[query] = (record, circuit, output)
+        self.multi.add_handle(query)
+
+    def _finish(self, query, error):
+        end_time = time.time()
+        record, circuit, output = self._active.pop(query)
+        self.multi.remove_handle(query)
+        self.dispatcher.unroute(circuit["circuit_id"])
+
+        measurements = None
+        if error is None:
+            # Same measurements as measure_request(), see curl_easy_getinfo
+            total_req_time = query.getinfo(pycurl.TOTAL_TIME)
+            measurements = {
+                "latency": query.getinfo(pycurl.CONNECT_TIME),
+                "ttfb": query.getinfo(pycurl.STARTTRANSFER_TIME),
+                "throughput": len(output.getvalue()) / total_req_time,
+                "end_time": end_time,
+            }
+        query.close()
+        return record, circuit, measurements, error
+
+    def _start_ready(self):
+        # Starts the transfers whose circuit is ready, yields the requests that got no circuit
+        for job in [job for job in self._waiting if job[1].done()]:
+            self._waiting.remove(job)
+            url, future, record = job
+            try:
+                circuit = future.result()
+            except Exception as exc:
+                yield record, None, None, f"Unable to create a new circuit: {exc}"
+                continue
+            if circuit == "error":
+                yield record, None, None, "Unable to create a new circuit"
+                continue
+            self._start(url, circuit, record)
+
+    def _read_finished(self):
+        while self.multi.perform()[0] == pycurl.E_CALL_MULTI_PERFORM:
+            pass
+        while True:
+            queued, succeeded, failed = self.multi.info_read()
+            for query in succeeded:
+                yield self._finish(query, None)
+            for query, errno, message in failed:
+                yield self._finish(query, message)
+            if not queued:
+                return
+
+    def run(self, next_job):
+        """
+        Runs requests until next_job() has none left and every request finished.
+
+        Args:
+        - next_job: function called whenever a request can start. Returns (url, circuit, record), or
+        None if no request should start now. circuit is a concurrent.futures.Future resolving to a
+        circuit dictionary with at least its "circuit_id", e.g. from CircuitReuse, or to "error".
+        record is handed back with the request's result, e.g. its start time.
+
+        Returns:
+        - a generator of (record, circuit, measurements, error) for each request as it finishes.
+        measurements holds the "latency", "ttfb", "throughput" and "end_time" of the transfer, and
+        is None if it failed, in which case error says why. circuit is None if the request got no
+        circuit.
+        """
+        while True:
+            while self.in_flight() < self.max_in_flight:
+                job = next_job()
+                if job is None:
+                    break
+                self._waiting.append(job)
+            if not self.in_flight():
+                return
+
+            yield from self._start_ready()
+            if self._active:
+                yield from self._read_finished()
+                self.multi.select(SELECT_TIMEOUT)
+            elif self._waiting:
+                concurrent.futures.wait(
+                    [future for url, future, record in self._waiting],
+                    timeout=SELECT_TIMEOUT,
+                    return_when=concurrent.futures.FIRST_COMPLETED,
+                )
+
+    def close(self):
+        """
+        Stops the transfers still running and closes the CurlMulti.
+        """
+        for query in list(self._active):
+            self._finish(query, "Engine closed")
+        self.multi.close()
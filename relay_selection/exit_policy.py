@@ -0,0 +1,130 @@
+"""
+Exit policy index for the relays of a RelayTable.
+
+Onionoo (and the consensus reader) give each relay its exit policy as a list of rules such as
+"reject *:25" or "accept *:80-443". Most relays share one of a few policies, so every distinct
+policy is compiled once into the sorted port ranges it accepts, and "which of these exits allow
+port P" becomes a lookup per distinct policy followed by an index into the relay column.
+"""
+import bisect
+from urllib.parse import urlsplit
+
+import numpy as np
+
+# --------------------- Constants ---------------------#
+# Address patterns that match every IPv4 destination
+WILDCARD_ADDRESSES = ("*", "*4", "0.0.0.0/0")
+
+DEFAULT_PORTS = {"http": 80, "https": 443}
+
+
+def url_port(url):
+    """
+    Returns the port a request to url connects to, e.g. 80 for "http://google.com/".
+    """
+    parts = urlsplit(url)
+    return parts.port or DEFAULT_PORTS[parts.scheme]
+
+
+def parse_ports(ports):
+    """
+    Returns the (first, last) port range of a rule's port pattern, "*", "80" or "20-23".
+    """
+    if ports == "*":
+        return 1, 65535
+    first, _, last = ports.partition("-")
+    return int(first), int(last or first)
+
+
+def compile_policy(rules):
+    """
+    Compiles an exit policy into the port ranges it accepts for an arbitrary destination.
+
+    Like Tor does for a destination it does not know yet, only rules that match every address
+    decide a port. The first such rule covering a port wins and ports no rule covers are
+    rejected. Rules for specific networks (e.g. "reject 10.0.0.0/8:*") and IPv6 rules are skipped.
+
+    Args:
+    - rules: the relay's exit_policy, e.g. ["reject *:25", "accept *:*"]
+
+    Returns:
+    - a tuple (starts, ends) of sorted lists with the first and last port of each accepted range
+    """
+    decided = []  # (first, last, accept) of the ports decided so far, in rule order
+    for rule in rules:
+        action, _, pattern = rule.partition(" ")
+        if action not in ("accept", "reject"):
+            continue
+        address, _, ports = pattern.rpartition(":")
+        if address not in WILDCARD_ADDRESSES:
+            continue
+        try:
+            decided.append(parse_ports(ports) + (action == "accept",))
+        except ValueError:
+            continue
+
+    # Walk the port space once, each port takes the decision of the first rule covering it
+    boundaries = sorted({1, 65536} | {first for first, _, _ in decided} | {last + 1 for _, last, _ in decided})
+    starts, ends = [], []
+    for first, next_first in zip(boundaries, boundaries[1:]):
+        accept = next((action for low, high, action in decided if low <= first <= high), False)
+        if not accept:
+            continue
+        if ends and ends[-1] == first - 1:
+            ends[-1] = next_first - 1
+        else:
+            starts.append(first)
+            ends.append(next_first - 1)
+    return starts, ends
+
+
+def policy_allows(compiled, port):
+    """
+    Returns True if a policy compiled by compile_policy() accepts a port.
+    """
+    starts, ends = compiled
+    position = bisect.bisect_right(starts, port) - 1
+    return position >= 0 and port <= ends[position]
+
+
+class ExitPolicyIndex:
+    """
+    The distinct exit policies of a set of relays, each compiled once, and the policy of each relay.
+
+    Args:
+    - records: the relay dictionaries, e.g. RelayTable.records, in row order
+    """
+
+    def __init__(self, records):
+        policy_ids = {}
+        self.policy = np.empty(len(records), dtype=np.intp)
+        for row, relay in enumerate(records):
+            rules = tuple(relay.get("exit_policy", ()))
+            if rules not in policy_ids:
+                policy_ids[rules] = len(policy_ids)
+            self.policy[row] = policy_ids[rules]
+        self.policies = list(policy_ids)
+        self.compiled = [compile_policy(rules) for rules in self.policies]
+        # Port -> boolean array telling which distinct policies accept it
+        self._allowed = {}
+
+    def policies_allowing(self, port):
+        """
+        Returns a boolean array with one entry per distinct policy telling whether it accepts a port.
+        """
+        allowed = self._allowed.get(port)
+        if allowed is None:
+            allowed = np.array([policy_allows(compiled, port) for compiled in self.compiled], dtype=bool)
+            self._allowed[port] = allowed
+        return allowed
+
+    def allows_port(self, port, rows=None):
+        """
+        Returns a boolean mask telling which relays' exit policies accept a port.
+
+        Args:
+        - port: the destination port, e.g. url_port(url)
+        - rows: row indices to test, e.g. the exit pool, all relays if None
+        """
+        policy = self.policy if rows is None else self.policy[rows]
+        return self.policies_allowing(port)[policy]
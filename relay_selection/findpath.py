@@ -0,0 +1,81 @@
+"""
+Client side of the patched FINDPATH control command (see Appendix_B_find_path_patch).
+
+"FINDPATH <count> [FRESHGUARDS]" returns count paths in one multi-line reply, one
+"250-PATH $FINGERPRINT~Name,..." line per path. find_paths() sends one such command per batch
+and yields the paths of the reply one at a time, so a run of 100000 paths costs 100000 / batch_size
+control port round trips instead of two (DROPGUARDS and FINDPATH) per path.
+"""
+import re
+
+import stem
+
+# --------------------- Constants ---------------------#
+# Same pattern the experiment scripts use to pull fingerprints out of a FINDPATH reply
+FINGERPRINT_PATTERN = re.compile("[A-Z0-9]{40}")
+
+# Paths asked for per FINDPATH command
+BATCH_SIZE = 1000
+
+# FINDPATH_MAX_COUNT in the patched control_cmd.c
+MAX_BATCH_SIZE = 10000
+
+# Batches in a row without a single path before find_paths() gives up
+MAX_EMPTY_BATCHES = 3
+
+
+def findpath_command(count=None, fresh_guards=False):
+    """
+    Returns the FINDPATH command for count paths, e.g. "FINDPATH 1000 FRESHGUARDS". Without a
+    count the command is the unbatched "FINDPATH", which returns a single path. FRESHGUARDS
+    needs a count, so a single path with fresh guards is asked for as "FINDPATH 1 FRESHGUARDS".
+    """
+    if count is None and fresh_guards:
+        count = 1
+    command = "FINDPATH" if count is None else f"FINDPATH {count}"
+    return command + " FRESHGUARDS" if fresh_guards else command
+
+
+def parse_paths(msg):
+    """
+    Yields the path of each PATH line of a FINDPATH reply as a list of [entry, middle, exit]
+    fingerprints. NOPATH lines, for paths Tor could not find, are skipped.
+    """
+    for code, divider, content in msg.content():
+        if content.startswith("PATH "):
+            yield FINGERPRINT_PATTERN.findall(content)
+
+
+def find_paths(controller, count=None, fresh_guards=True, batch_size=BATCH_SIZE):
+    """
+    Yields paths from Tor's own path selection, batch_size paths per FINDPATH command.
+
+    Args:
+    - controller: an authenticated stem Controller of a Tor with the FINDPATH patch
+    - count: number of paths to yield, None for as many as are asked for
+    - fresh_guards: drop the entry guards before every path, like DROPGUARDS before each FINDPATH
+    - batch_size: paths per FINDPATH command, at most MAX_BATCH_SIZE
+
+    Returns:
+    - a generator of lists of [entry, middle, exit] fingerprints
+    """
+    batch_size = min(batch_size, MAX_BATCH_SIZE)
+    remaining = count
+    empty_batches = 0
+    while remaining is None or remaining > 0:
+        batch = batch_size if remaining is None else min(remaining, batch_size)
+        msg = controller.msg(findpath_command(batch, fresh_guards))
+        if not msg.is_ok():
+            raise stem.ControllerError(
+                "FINDPATH command failed with error '%s'. Is your tor client patched?" % str(msg)
+            )
+
+        found = 0
+        for path in parse_paths(msg):
+            found += 1
+            yield path
+        empty_batches = 0 if found else empty_batches + 1
+        if empty_batches == MAX_EMPTY_BATCHES:
+            raise stem.ControllerError(f"FINDPATH found no path in {MAX_EMPTY_BATCHES} commands in a row")
+        if remaining is not None:
+            remaining -= found
@@ -0,0 +1,104 @@
+"""
+Relay flags encoded as integer bitmasks.
+
+Each relay's flag list is encoded once, when the RelayTable is built, into one uint32 with a
+bit per flag. Flag filters and the entry/middle/exit categorization are then bitwise operations
+over the whole flags column instead of string membership tests per relay.
+"""
+import numpy as np
+
+# --------------------- Constants ---------------------#
+# Relay flags (https://spec.torproject.org/dir-spec), one bit each in the flags column
+TOR_FLAGS = (
+    "Authority",
+    "BadExit",
+    "Exit",
+    "Fast",
+    "Guard",
+    "HSDir",
+    "MiddleOnly",
+    "NoEdConsensus",
+    "Running",
+    "Stable",
+    "StaleDesc",
+    "Sybil",
+    "V2Dir",
+    "Valid",
+)
+FLAG_BITS = {flag: 1 << bit for bit, flag in enumerate(TOR_FLAGS)}
+
+
+def encode_flags(flags):
+    """
+    Encodes a list of flag names as an integer bitmask, unknown flags are ignored.
+    """
+    mask = 0
+    for flag in flags:
+        mask |= FLAG_BITS.get(flag, 0)
+    return mask
+
+
+def decode_flags(mask):
+    """
+    Returns the flag names set in a bitmask, in TOR_FLAGS order.
+    """
+    return [flag for flag in TOR_FLAGS if int(mask) & FLAG_BITS[flag]]
+
+
+def encode_column(flag_lists):
+    """
+    Encodes the flag lists of many relays as a uint32 column. Relays share a few flag
+    combinations, so each combination is only encoded once.
+
+    Args:
+    - flag_lists: an iterable with the list (or tuple) of flags of each relay
+
+    Returns:
+    - a uint32 array with the bitmask of each relay
+    """
+    masks = {}
+    column = []
+    for flags in flag_lists:
+        flags = tuple(flags)
+        if flags not in masks:
+            masks[flags] = encode_flags(flags)
+        column.append(masks[flags])
+    return np.array(column, dtype=np.uint32)
+
+
+def flag_mask(flags, required=(), forbidden=()):
+    """
+    Returns a boolean mask telling which relays have all the required flags and none of the
+    forbidden ones.
+
+    Unlike encode_flags(), unknown flag names raise a ValueError, since the filter would
+    otherwise silently ignore a misspelled flag.
+
+    Args:
+    - flags: a flags column (uint32 bitmasks)
+    - required: flag names a relay must have
+    - forbidden: flag names a relay must not have
+    """
+    unknown = [flag for flag in (*required, *forbidden) if flag not in FLAG_BITS]
+    if unknown:
+        raise ValueError(f"Unknown relay flags {unknown}, expected flags from {TOR_FLAGS}")
+    required_bits = encode_flags(required)
+    forbidden_bits = encode_flags(forbidden)
+    return ((flags & required_bits) == required_bits) & ((flags & forbidden_bits) == 0)
+
+
+def category_masks(flags):
+    """
+    Splits relays into entry, middle and exit relays by their flags. Relays with the 'Guard'
+    flag are entries, relays with 'Exit' and not 'Guard' are exits, the rest are middles.
+
+    Args:
+    - flags: a flags column (uint32 bitmasks)
+
+    Returns:
+    - a tuple of three boolean masks (entry, middle and exit)
+    """
+    entry = flag_mask(flags, required=("Guard",))
+    exit = flag_mask(flags, required=("Exit",), forbidden=("Guard",))
+    middle = ~(entry | exit)
+    return entry, middle, exit
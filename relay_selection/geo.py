@@ -0,0 +1,45 @@
+"""
+Geographic helpers for the relay selection pipeline.
+"""
+import numpy as np
+
+# --------------------- Constants ---------------------#
+# Earth's radius in kilometers, as used by the list based calc_distance() the experiment scripts had
+EARTH_RADIUS = 6373.0
+
+
+def haversine_distance(latitude, longitude, client_lat, client_long, radius=EARTH_RADIUS):
+    """
+    Calculates the great-circle distance between the client and many points in one go.
+
+    Points without coordinates (NaN latitude or longitude) are masked out and get an infinite
+    distance, like relays without a location in calc_distance().
+
+    Args:
+    - latitude, longitude: arrays of coordinates in degrees
+    - client_lat, client_long: the client location in degrees
+    - radius: the radius of the sphere, in the unit the distances should be in
+
+    Returns:
+    - an array of distances, inf where a point has no coordinates
+    """
+    latitude = np.asarray(latitude, dtype=float)
+    longitude = np.asarray(longitude, dtype=float)
+    located = ~(np.isnan(latitude) | np.isnan(longitude))
+
+    # The client terms are the same for every point
+    lat1 = np.radians(client_lat)
+    lon1 = np.radians(client_long)
+    cos_lat1 = np.cos(lat1)
+
+    lat2 = np.radians(latitude[located])
+    lon2 = np.radians(longitude[located])
+
+    dlon = lon2 - lon1
+    dlat = lat2 - lat1
+    a = np.sin(dlat / 2) ** 2 + cos_lat1 * np.cos(lat2) * np.sin(dlon / 2) ** 2
+    c = 2 * np.arctan2(np.sqrt(a), np.sqrt(1 - a))
+
+    distance = np.full(latitude.shape, np.inf)
+    distance[located] = radius * c
+    return distance
@@ -0,0 +1,355 @@
+"""
+Shared MaxMind reader and persistent cache for the GeoIP lookups of relay addresses.
+
+Each mmdb file is opened once per process in mmap mode by open_reader(), and lookup_locations()
+and lookup_asns() look up whole lists of addresses and return NumPy arrays. The experiment
+scripts and GeoIPPlotter/geoipplotter.py both go through these functions.
+
+Most relay addresses stay the same from one experiment to the next, so every address that has
+been looked up is saved to disk together with its latitude, longitude, country and ASN. Only
+addresses that are not in the cache are looked up in the MaxMind database.
+
+The cache file is named after the path and build epoch of the databases it was made with, so a
+new mmdb file automatically starts a new cache and the old cache of the same database path is
+removed when the new one is saved. Caches of other databases are left alone.
+"""
+import functools
+import glob
+import hashlib
+import os
+import socket
+import struct
+
+import maxminddb
+import numpy as np
+
+from relay_selection.onionoo import DEFAULT_CACHE_DIR
+
+# --------------------- Constants ---------------------#
+# Country code stored for addresses the database has no country for
+UNKNOWN_COUNTRY = ""
+
+# ASN stored for addresses without an autonomous system, or when no ASN database is used
+UNKNOWN_ASN = -1
+
+# Number of single address lookups kept in memory by GeoIPCache.lookup()
+LRU_SIZE = 1 << 16
+
+
+def address_to_int(address):
+    """
+    Returns an IPv4 address in dotted notation as an unsigned 32 bit integer.
+    """
+    return struct.unpack("!I", socket.inet_aton(address))[0]
+
+
+def int_to_address(value):
+    """
+    Returns the dotted notation of an IPv4 address stored as an integer.
+    """
+    return socket.inet_ntoa(struct.pack("!I", int(value)))
+
+
+def parse_location(data):
+    """
+    Returns (latitude, longitude, country) from a GeoLite2 City record, NaN and UNKNOWN_COUNTRY
+    for the parts that are missing.
+    """
+    latitude = longitude = np.nan
+    country = UNKNOWN_COUNTRY
+    if data is not None:
+        try:
+            latitude = data["location"]["latitude"]
+            longitude = data["location"]["longitude"]
+        except (KeyError, TypeError):
+            pass
+        try:
+            country = data["country"]["iso_code"]
+        except (KeyError, TypeError):
+            pass
+    return latitude, longitude, country
+
+
+def parse_asn(data):
+    """
+    Returns the autonomous system number from a GeoLite2 ASN record, or UNKNOWN_ASN.
+    """
+    try:
+        return data["autonomous_system_number"]
+    except (KeyError, TypeError):
+        return UNKNOWN_ASN
+
+
+# --------------------- Shared reader ---------------------#
+# Readers opened by this process, path -> (file identity, reader)
+_readers = {}
+
+
+def _file_identity(path):
+    stat = os.stat(path)
+    return stat.st_size, stat.st_mtime
+
+
+def open_reader(database):
+    """
+    Returns the process-wide reader for an mmdb file, opening it in mmap mode on first use.
+    The file is opened again if it has been replaced since.
+
+    Args:
+    - database: path to a MaxMind mmdb file
+
+    Returns:
+    - a maxminddb Reader
+    """
+    path = os.path.abspath(database)
+    identity = _file_identity(path)
+    opened = _readers.get(path)
+    if opened is None or opened[0] != identity:
+        if opened is not None:
+            opened[1].close()
+        opened = _readers[path] = (identity, maxminddb.open_database(path, maxminddb.MODE_MMAP))
+    return opened[1]
+
+
+def close_readers():
+    """
+    Closes every reader opened by open_reader().
+    """
+    for _, reader in _readers.values():
+        reader.close()
+    _readers.clear()
+
+
+def build_epoch(database):
+    """
+    Returns the build epoch of an mmdb file, which changes with every database release.
+    """
+    return open_reader(database).metadata().build_epoch
+
+
+def _get(reader, address):
+    try:
+        return reader.get(address)
+    except ValueError:
+        # Not a valid IP address
+        return None
+
+
+def lookup_locations(database, addresses):
+    """
+    Looks up the location and country of many addresses in a GeoLite2 City database.
+
+    Args:
+    - database: path to the GeoLite2 City mmdb file
+    - addresses: IP addresses as strings, None is allowed
+
+    Returns:
+    - a tuple of arrays (latitude, longitude, country), NaN and UNKNOWN_COUNTRY for addresses
+    that are None, invalid or not in the database
+    """
+    reader = open_reader(database)
+    size = len(addresses)
+    latitude = np.full(size, np.nan)
+    longitude = np.full(size, np.nan)
+    country = np.full(size, UNKNOWN_COUNTRY, dtype="U2")
+    for row, address in enumerate(addresses):
+        if address is not None:
+            latitude[row], longitude[row], country[row] = parse_location(_get(reader, address))
+    return latitude, longitude, country
+
+
+def lookup_asns(database, addresses):
+    """
+    Looks up the autonomous system number of many addresses in a GeoLite2 ASN database.
+
+    Args:
+    - database: path to the GeoLite2 ASN mmdb file
+    - addresses: IP addresses as strings, None is allowed
+
+    Returns:
+    - an int64 array of ASNs, UNKNOWN_ASN for addresses that are None, invalid or not found
+    """
+    reader = open_reader(database)
+    asn = np.full(len(addresses), UNKNOWN_ASN, dtype=np.int64)
+    for row, address in enumerate(addresses):
+        if address is not None:
+            asn[row] = parse_asn(_get(reader, address))
+    return asn
+
+
+# --------------------- Persistent cache ---------------------#
+class GeoIPCache:
+    """
+    Maps IPv4 addresses to (latitude, longitude, country, ASN), backed by a .npz file.
+
+    The file holds the cached addresses as a sorted uint32 array with one column per field, so
+    a batch of addresses is matched with a single binary search. New lookups are kept in memory
+    until save() merges them into the file. Single lookups go through an in-process LRU cache.
+
+    Args:
+    - database: path to the GeoLite2 City mmdb file
+    - asn_database: path to the GeoLite2 ASN mmdb file, ASNs are UNKNOWN_ASN if None
+    - cache_dir: directory the cache file is written to
+    """
+
+    def __init__(self, database, asn_database=None, cache_dir=DEFAULT_CACHE_DIR):
+        self.database = database
+        self.asn_database = asn_database
+        self.cache_dir = cache_dir
+
+        databases = [database] if asn_database is None else [database, asn_database]
+        # Short hash of the database paths, the prefix shared by every cache of these databases
+        paths = "\n".join(os.path.abspath(path) for path in databases)
+        key = hashlib.sha1(paths.encode("utf-8")).hexdigest()[:12]
+        self.prefix = os.path.join(cache_dir, f"geoip_{key}_")
+        self.path = self.prefix + "_".join(str(build_epoch(path)) for path in databases) + ".npz"
+
+        # Lookups that are not saved yet, address (int) -> (latitude, longitude, country, asn)
+        self._pending = {}
+        self._load()
+        self.lookup = functools.lru_cache(maxsize=LRU_SIZE)(self._lookup)
+
+    def _load(self):
+        self.addresses = np.empty(0, dtype=np.uint32)
+        self.latitude = np.empty(0)
+        self.longitude = np.empty(0)
+        self.country = np.empty(0, dtype="U2")
+        self.asn = np.empty(0, dtype=np.int64)
+        if not os.path.exists(self.path):
+            return
+        try:
+            with np.load(self.path, allow_pickle=False) as data:
+                self.addresses = data["addresses"]
+                self.latitude = data["latitude"]
+                self.longitude = data["longitude"]
+                self.country = data["country"]
+                self.asn = data["asn"]
+        except (OSError, ValueError, KeyError):
+            print(f"ERROR: Unable to read GeoIP cache {self.path}, starting a new one")
+
+    def __len__(self):
+        return len(self.addresses) + len(self._pending)
+
+    def _query_databases(self, values):
+        """
+        Looks up addresses (as integers) in the MaxMind databases and keeps them as pending.
+        """
+        addresses = [int_to_address(value) for value in values]
+        latitude, longitude, country = lookup_locations(self.database, addresses)
+        if self.asn_database is not None:
+            asn = lookup_asns(self.asn_database, addresses)
+        else:
+            asn = np.full(len(addresses), UNKNOWN_ASN, dtype=np.int64)
+        for row, value in enumerate(values):
+            self._pending[value] = (latitude[row], longitude[row], country[row], asn[row])
+
+    def lookup_many(self, addresses):
+        """
+        Returns the location, country and ASN of many addresses. Only addresses that are not
+        cached yet are looked up in the database.
+
+        Args:
+        - addresses: IPv4 addresses in dotted notation, None for relays without one
+
+        Returns:
+        - a tuple of arrays (latitude, longitude, country, asn), with NaN, UNKNOWN_COUNTRY and
+        UNKNOWN_ASN for addresses that are None or not in the database
+        """
+        size = len(addresses)
+        latitude = np.full(size, np.nan)
+        longitude = np.full(size, np.nan)
+        country = np.full(size, UNKNOWN_COUNTRY, dtype="U2")
+        asn = np.full(size, UNKNOWN_ASN, dtype=np.int64)
+
+        valid = np.array([address is not None for address in addresses], dtype=bool)
+        rows = np.flatnonzero(valid)
+        if len(rows) == 0:
+            return latitude, longitude, country, asn
+        values = np.fromiter(
+            (address_to_int(addresses[row]) for row in rows), dtype=np.uint32, count=len(rows)
+        )
+
+        # Addresses saved in the cache file
+        positions = np.searchsorted(self.addresses, values)
+        positions[positions == len(self.addresses)] = 0
+        cached = (self.addresses[positions] == values) if len(self.addresses) else np.zeros(len(rows), dtype=bool)
+        hits = positions[cached]
+        latitude[rows[cached]] = self.latitude[hits]
+        longitude[rows[cached]] = self.longitude[hits]
+        country[rows[cached]] = self.country[hits]
+        asn[rows[cached]] = self.asn[hits]
+
+        # Everything else comes from this process' pending lookups or the database
+        missing = [int(value) for value in np.unique(values[~cached]) if int(value) not in self._pending]
+        if missing:
+            self._query_databases(missing)
+        for row, value in zip(rows[~cached], values[~cached]):
+            latitude[row], longitude[row], country[row], asn[row] = self._pending[int(value)]
+
+        return latitude, longitude, country, asn
+
+    def _lookup(self, address):
+        latitude, longitude, country, asn = self.lookup_many([address])
+        return float(latitude[0]), float(longitude[0]), str(country[0]), int(asn[0])
+
+    def save(self):
+        """
+        Merges the pending lookups into the cache file and removes the cache files made with older
+        builds of the same databases. Does nothing when there are no new lookups.
+        """
+        if not self._pending:
+            return
+        values = np.fromiter(self._pending.keys(), dtype=np.uint32, count=len(self._pending))
+        fields = list(zip(*self._pending.values()))
+
+        addresses = np.concatenate([self.addresses, values])
+        order = np.argsort(addresses, kind="stable")
+        self.addresses = addresses[order]
+        self.latitude = np.concatenate([self.latitude, np.array(fields[0], dtype=float)])[order]
+        self.longitude = np.concatenate([self.longitude, np.array(fields[1], dtype=float)])[order]
+        self.country = np.concatenate([self.country, np.array(fields[2], dtype="U2")])[order]
+        self.asn = np.concatenate([self.asn, np.array(fields[3], dtype=np.int64)])[order]
+        self._pending = {}
+
+        os.makedirs(self.cache_dir, exist_ok=True)
+        with open(self.path + ".tmp", "wb") as outfile:
+            np.savez(
+                outfile,
+                addresses=self.addresses,
+                latitude=self.latitude,
+                longitude=self.longitude,
+                country=self.country,
+                asn=self.asn,
+            )
+        os.replace(self.path + ".tmp", self.path)
+
+        for path in glob.glob(glob.escape(self.prefix) + "*.npz"):
+            if os.path.abspath(path) != os.path.abspath(self.path):
+                os.remove(path)
+
+
+# Caches shared by all experiments in the same process, one per database and cache directory
+_caches = {}
+
+
+def get_geoip_cache(database, asn_database=None, cache_dir=DEFAULT_CACHE_DIR):
+    """
+    Returns the shared GeoIPCache for a database, creating it on first use. A new cache is
+    created when the database file has been replaced since.
+
+    Args:
+    - database: path to the GeoLite2 City mmdb file
+    - asn_database: path to the GeoLite2 ASN mmdb file, or None
+    - cache_dir: directory the cache file is written to
+
+    Returns:
+    - a GeoIPCache
+    """
+    paths = [database] if asn_database is None else [database, asn_database]
+    identity = tuple((os.path.abspath(path),) + _file_identity(path) for path in paths)
+    key = (identity, cache_dir)
+
+    cache = _caches.get(key)
+    if cache is None:
+        cache = _caches[key] = GeoIPCache(database, asn_database, cache_dir)
+    return cache
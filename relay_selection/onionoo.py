@@ -0,0 +1,352 @@
+"""
+On-disk cache for the Onionoo relay directory (https://metrics.torproject.org/onionoo.html).
+
+Every experiment used to download and parse the full details document. The cache keeps the
+raw document on disk together with its ETag/Last-Modified headers, serves it while it is
+fresh and revalidates it with a conditional GET once it is older than max_age.
+
+The relay list can also be read with iter_relays(), which parses the document one relay at a
+time and keeps only the fields the relay selection pipeline uses.
+"""
+import hashlib
+import json
+import os
+import re
+import sys
+import time
+
+import requests
+
+# --------------------- Constants ---------------------#
+ONIONOO_DETAILS_URL = "https://onionoo.torproject.org/details"
+
+# Relay fields used by the relay selection pipeline
+RELAY_FIELDS = (
+    "fingerprint",
+    "or_addresses",
+    "flags",
+    "observed_bandwidth",
+    "consensus_weight",
+    "overload_general_timestamp",
+    "exit_policy",
+    "effective_family",
+)
+
+# Query parameters requested by the experiment scripts
+ONIONOO_PARAMS = {
+    "running": "true",
+    "fields": ",".join(RELAY_FIELDS),
+}
+
+# A new consensus is published every hour, Onionoo follows shortly after
+CONSENSUS_INTERVAL = 60 * 60
+
+DEFAULT_CACHE_DIR = "./relay_cache"
+
+# Start of the relay array in an Onionoo document
+_RELAYS_START = re.compile(r'"relays"\s*:\s*\[')
+
+
+# --------------------- Streaming parser ---------------------#
+def compact_relay(relay, fields=RELAY_FIELDS, shared=None):
+    """
+    Builds a compact relay record holding only the given fields.
+
+    Flags, exit policies and families are stored as tuples, and identical tuples are shared
+    between relays through the shared dictionary, since most relays have one of a few
+    combinations and every member of a family lists the same family.
+
+    Args:
+    - relay: a relay dictionary from Onionoo
+    - fields: the fields to keep
+    - shared: a dictionary used to share identical flag, exit policy and family tuples between records
+
+    Returns:
+    - a dictionary with the fields of the relay that are in fields
+    """
+    if shared is None:
+        shared = {}
+    record = {}
+    for field in fields:
+        if field not in relay:
+            continue
+        value = relay[field]
+        if field in ("flags", "exit_policy", "effective_family"):
+            value = tuple(sys.intern(item) for item in value)
+            value = shared.setdefault(value, value)
+        record[field] = value
+    return record
+
+
+def iter_relays(infile, fields=RELAY_FIELDS, chunk_size=1 << 16):
+    """
+    Parses the "relays" array of an Onionoo document incrementally and yields compact records.
+
+    Only one chunk of the file and the relay being decoded are held in memory at a time, so the
+    memory used scales with the records that are kept rather than with the raw document.
+
+    Args:
+    - infile: a text file object positioned at the start of an Onionoo details document
+    - fields: the relay fields to keep, see compact_relay()
+    - chunk_size: number of characters read from the file at a time
+
+    Returns:
+    - a generator of relay dictionaries
+    """
+    decoder = json.JSONDecoder()
+    shared = {}
+    buffer = ""
+    eof = False
+
+    def read_more():
+        nonlocal buffer, eof
+        chunk = infile.read(chunk_size)
+        if not chunk:
+            eof = True
+        buffer += chunk
+
+    # Skip the document header up to the start of the relay array
+    while True:
+        match = _RELAYS_START.search(buffer)
+        if match:
+            buffer = buffer[match.end():]
+            break
+        if eof:
+            return
+        # Keep the tail in case the key is split between two chunks
+        buffer = buffer[-32:]
+        read_more()
+
+    position = 0
+    while True:
+        # Skip whitespace and the separating commas
+        while position < len(buffer) and buffer[position] in " \t\r\n,":
+            position += 1
+        if position == len(buffer):
+            if eof:
+                raise ValueError("Onionoo document ended inside the relay array")
+            buffer = ""
+            position = 0
+            read_more()
+            continue
+        if buffer[position] == "]":
+            return
+
+        try:
+            relay, end = decoder.raw_decode(buffer, position)
+        except json.JSONDecodeError:
+            if eof:
+                raise
+            # The relay object continues in the next chunk
+            buffer = buffer[position:]
+            position = 0
+            read_more()
+            continue
+
+        yield compact_relay(relay, fields, shared)
+        position = end
+
+
+class OnionooCache:
+    """
+    Stores Onionoo documents on disk and revalidates them with If-Modified-Since/If-None-Match.
+
+    Each (url, params) pair gets its own cache entry, consisting of the raw response body and a
+    small metadata file with the validators and the time the entry was last validated.
+
+    Args:
+    - cache_dir: directory the cache entries are written to
+    - max_age: number of seconds a cached document is served without asking Onionoo,
+    defaults to one consensus interval
+    - timeout: timeout in seconds for the HTTP request
+    """
+
+    def __init__(self, cache_dir=DEFAULT_CACHE_DIR, max_age=CONSENSUS_INTERVAL, timeout=120):
+        self.cache_dir = cache_dir
+        self.max_age = max_age
+        self.timeout = timeout
+        # Parsed documents kept in memory, keyed by entry name -> (fetched_at, document)
+        self._parsed = {}
+
+    def entry_name(self, url, params):
+        """
+        Returns the file name prefix of the cache entry for a url and its query parameters.
+        """
+        key = json.dumps([url, sorted((params or {}).items())])
+        return "details_" + hashlib.sha1(key.encode("utf-8")).hexdigest()[:16]
+
+    def body_path(self, url, params):
+        """
+        Returns the path of the cached response body for a url and its query parameters.
+        """
+        return os.path.join(self.cache_dir, self.entry_name(url, params) + ".json")
+
+    def _meta_path(self, url, params):
+        return os.path.join(self.cache_dir, self.entry_name(url, params) + ".meta.json")
+
+    def _load_meta(self, url, params):
+        meta_path = self._meta_path(url, params)
+        if not os.path.exists(meta_path) or not os.path.exists(self.body_path(url, params)):
+            return None
+        try:
+            with open(meta_path, "r") as infile:
+                return json.load(infile)
+        except (OSError, ValueError):
+            return None
+
+    def _write_meta(self, url, params, meta):
+        meta_path = self._meta_path(url, params)
+        with open(meta_path + ".tmp", "w") as outfile:
+            json.dump(meta, outfile, indent=4)
+        os.replace(meta_path + ".tmp", meta_path)
+
+    def is_fresh(self, meta):
+        """
+        Returns True if a cache entry was validated less than max_age seconds ago.
+        """
+        return meta is not None and time.time() - meta["validated_at"] < self.max_age
+
+    def fetch(self, url=ONIONOO_DETAILS_URL, params=ONIONOO_PARAMS):
+        """
+        Makes sure an up to date copy of the document is on disk and returns its path.
+
+        A fresh entry is returned as is. A stale entry is revalidated with a conditional GET,
+        a 304 response only updates the validation time. If Onionoo can not be reached the
+        stale copy is used rather than failing the experiment.
+
+        Args:
+        - url: the Onionoo endpoint
+        - params: the query parameters sent to Onionoo
+
+        Returns:
+        - the path of the cached response body
+        """
+        os.makedirs(self.cache_dir, exist_ok=True)
+        body_path = self.body_path(url, params)
+        meta = self._load_meta(url, params)
+        if self.is_fresh(meta):
+            return body_path
+
+        headers = {}
+        if meta is not None:
+            if meta.get("etag"):
+                headers["If-None-Match"] = meta["etag"]
+            if meta.get("last_modified"):
+                headers["If-Modified-Since"] = meta["last_modified"]
+
+        try:
+            response = requests.get(
+                url, params=params, headers=headers, stream=True, timeout=self.timeout
+            )
+            if response.status_code == 304 and meta is not None:
+                print("Onionoo document not modified, using cached copy")
+                response.close()
+                meta["validated_at"] = time.time()
+                self._write_meta(url, params, meta)
+                return body_path
+            response.raise_for_status()
+
+            # Stream the body to disk so the raw document is never held in memory twice
+            with open(body_path + ".tmp", "wb") as outfile:
+                for chunk in response.iter_content(chunk_size=1 << 16):
+                    outfile.write(chunk)
+            os.replace(body_path + ".tmp", body_path)
+        except requests.RequestException as exc:
+            if meta is None:
+                raise
+            print(f"ERROR: Unable to revalidate Onionoo document: {exc}, using cached copy")
+            return body_path
+
+        now = time.time()
+        self._write_meta(
+            url,
+            params,
+            {
+                "url": url,
+                "params": params,
+                "etag": response.headers.get("ETag"),
+                "last_modified": response.headers.get("Last-Modified"),
+                "fetched_at": now,
+                "validated_at": now,
+            },
+        )
+        return body_path
+
+    def get_details(self, url=ONIONOO_DETAILS_URL, params=ONIONOO_PARAMS):
+        """
+        Returns the parsed Onionoo document, downloading it only when the cache is stale.
+
+        The parsed document is kept in memory until a new copy is downloaded, so several
+        experiments in one process parse it only once. Each call returns shallow copies of the
+        relay dictionaries, since the experiment functions add keys to them.
+
+        Args:
+        - url: the Onionoo endpoint
+        - params: the query parameters sent to Onionoo
+
+        Returns:
+        - the Onionoo document as a dictionary with a "relays" list
+        """
+        body_path = self.fetch(url, params)
+        fetched_at = self._load_meta(url, params)["fetched_at"]
+
+        name = self.entry_name(url, params)
+        cached = self._parsed.get(name)
+        if cached is None or cached[0] != fetched_at:
+            with open(body_path, "rb") as infile:
+                cached = (fetched_at, json.load(infile))
+            self._parsed[name] = cached
+
+        data = dict(cached[1])
+        data["relays"] = [dict(relay) for relay in cached[1].get("relays", [])]
+        return data
+
+    def get_relays(self, url=ONIONOO_DETAILS_URL, params=ONIONOO_PARAMS, fields=RELAY_FIELDS):
+        """
+        Returns the relays in the Onionoo document as compact records, see iter_relays().
+
+        The document is streamed from the cache file instead of being parsed as a whole, and the
+        records are kept in memory until a new copy is downloaded. Each call returns shallow
+        copies, since the experiment functions add keys to the relay dictionaries.
+
+        Args:
+        - url: the Onionoo endpoint
+        - params: the query parameters sent to Onionoo
+        - fields: the relay fields to keep
+
+        Returns:
+        - a list of relay dictionaries
+        """
+        body_path = self.fetch(url, params)
+        fetched_at = self._load_meta(url, params)["fetched_at"]
+
+        name = (self.entry_name(url, params), tuple(fields))
+        cached = self._parsed.get(name)
+        if cached is None or cached[0] != fetched_at:
+            with open(body_path, "r", encoding="utf-8") as infile:
+                cached = (fetched_at, list(iter_relays(infile, fields)))
+            self._parsed[name] = cached
+
+        return [dict(relay) for relay in cached[1]]
+
+
+# Caches shared by all experiments in the same process, one per cache directory
+_caches = {}
+
+
+def get_cache(cache_dir=DEFAULT_CACHE_DIR, max_age=CONSENSUS_INTERVAL):
+    """
+    Returns the shared OnionooCache for a cache directory, creating it on first use.
+
+    Args:
+    - cache_dir: directory the cache entries are written to
+    - max_age: number of seconds a cached document is served without asking Onionoo
+
+    Returns:
+    - an OnionooCache
+    """
+    cache = _caches.get(cache_dir)
+    if cache is None:
+        cache = _caches[cache_dir] = OnionooCache(cache_dir, max_age)
+    cache.max_age = max_age
+    return cache
@@ -0,0 +1,77 @@
+"""
+Sorted index of the overload_general_timestamp column for multi-horizon overload queries.
+
+The overload filter keeps relays whose last overload is at least H hours old. The index sorts
+the timestamps of a snapshot once, so "relays not overloaded within the last H hours" is a
+binary search for any number of horizons, and the masks or counts for a whole list of horizons
+come out of one comparison.
+"""
+import time
+
+import numpy as np
+
+from relay_selection.table import overload_threshold
+
+
+class OverloadIndex:
+    """
+    The overload column of a RelayTable sorted once, with the rank of each relay in that order.
+
+    Relays that never reported an overload are stored as NO_OVERLOAD, the smallest int64, so
+    they sort first and pass every horizon.
+
+    Args:
+    - table: a RelayTable
+    """
+
+    def __init__(self, table):
+        order = np.argsort(table.overload, kind="stable")
+        self.timestamps = table.overload[order]
+        self.rank = np.empty(len(order), dtype=np.intp)
+        self.rank[order] = np.arange(len(order))
+
+    def thresholds(self, horizons, now=None):
+        """
+        Returns the overload_threshold() of each horizon (in hours) as an int64 array, all
+        relative to the same now.
+        """
+        if now is None:
+            now = time.time()
+        return np.array([overload_threshold(horizon, now) for horizon in horizons], dtype=np.int64)
+
+    def passing(self, horizons, now=None):
+        """
+        Returns, for each horizon, the number of relays that are not overloaded within it, i.e.
+        the length of the prefix of the sorted timestamps at or below its threshold.
+        """
+        return np.searchsorted(self.timestamps, self.thresholds(horizons, now), side="right")
+
+    def masks(self, horizons, now=None):
+        """
+        Returns a boolean array of shape (len(horizons), number of relays), where row h is the
+        mask of relays that are not overloaded within horizons[h] hours.
+        """
+        return self.rank[None, :] < self.passing(horizons, now)[:, None]
+
+    def mask(self, horizon, now=None):
+        """
+        Returns the mask of relays that are not overloaded within horizon hours.
+        """
+        return self.masks([horizon], now)[0]
+
+    def counts(self, horizons, rows=None, now=None):
+        """
+        Returns the number of relays that are not overloaded within each horizon.
+
+        Args:
+        - horizons: a list of horizons in hours
+        - rows: row indices to count, e.g. a pool, all relays if None
+        - now: current time in seconds since the epoch, time.time() if None
+
+        Returns:
+        - an int array with one count per horizon
+        """
+        passing = self.passing(horizons, now)
+        if rows is None:
+            return passing
+        return np.searchsorted(np.sort(self.rank[rows]), passing, side="left")
@@ -0,0 +1,295 @@
+"""
+Bandwidth weighted path sampler for the relay selection experiments.
+
+The patched FINDPATH control command asks Tor for one path per call, after a DROPGUARDS, so
+every path costs two control port round trips. PathSampler draws paths from the entry, middle
+and exit pools in Python the way Tor's path selection does:
+
+- the exit is chosen first, then the entry, then the middle relay
+- each position is weighted by the relay's consensus weight times the consensus bandwidth
+  weight of its position and class (Wgg, Wmg, Wee, Wgd, ..., see dir-spec "bandwidth-weights")
+- a relay is not chosen if it is already in the path, shares an effective family with a relay
+  in the path or has an IPv4 address in the same /16 (EnforceDistinctSubnets)
+
+Each position has an alias table over its pool, so a draw is O(1), and excluded relays are drawn
+again, which gives the same distribution as choosing among the remaining relays. compare_with_findpath()
+tests whether paths from FINDPATH follow the sampler's distribution.
+"""
+import numpy as np
+from scipy import stats
+
+from relay_selection.geoip import address_to_int
+
+# --------------------- Constants ---------------------#
+# A bandwidth weight of WEIGHT_SCALE is 1.0 (the consensus "bwweightscale" parameter)
+WEIGHT_SCALE = 10000
+
+# Bandwidth weight of each relay class in each position, see compute_weighted_bandwidths() in
+# Tor's node_select.c. Classes: "g" Guard, "e" Exit, "d" Guard and Exit, "m" neither.
+POSITION_WEIGHTS = {
+    "entry": {"g": "Wgg", "m": "Wgm", "e": None, "d": "Wgd"},
+    "middle": {"g": "Wmg", "m": "Wmm", "e": "Wme", "d": "Wmd"},
+    "exit": {"g": "Weg", "m": "Wem", "e": "Wee", "d": "Wed"},
+}
+
+# Order the positions are chosen in, and their order in a path
+SELECTION_ORDER = ("exit", "entry", "middle")
+PATH_ORDER = ("entry", "middle", "exit")
+
+# Times a conflicting draw is repeated before the pool is considered exhausted
+MAX_REDRAWS = 1000
+
+# Paths drawn at once by PathSampler.paths()
+CHUNK_SIZE = 1 << 16
+
+
+# --------------------- Relay attributes ---------------------#
+def relay_classes(table, rows):
+    """
+    Returns the bandwidth weight class ("g", "e", "d" or "m") of each relay. Relays with the
+    BadExit flag are not counted as exits, like in Tor.
+    """
+    guard = table.has_flag("Guard", rows)
+    exit = table.match_flags(required=("Exit",), forbidden=("BadExit",), rows=rows)
+    classes = np.full(len(rows), "m")
+    classes[guard & ~exit] = "g"
+    classes[exit & ~guard] = "e"
+    classes[guard & exit] = "d"
+    return classes
+
+
+def position_weights(table, rows, position, bandwidth_weights=None):
+    """
+    Returns the selection weight of each relay in a position.
+
+    Args:
+    - table: a RelayTable
+    - rows: the row indices of the pool
+    - position: "entry", "middle" or "exit"
+    - bandwidth_weights: the consensus bandwidth weights, e.g. read_bandwidth_weights(). If None,
+    every weight is 1.0 and relays are weighted by consensus weight alone.
+
+    Returns:
+    - a float array with the weight of each relay in rows
+    """
+    classes = relay_classes(table, rows)
+    factors = np.zeros(len(rows))
+    for relay_class, name in POSITION_WEIGHTS[position].items():
+        if name is None:
+            continue
+        weight = WEIGHT_SCALE if bandwidth_weights is None else bandwidth_weights.get(name, WEIGHT_SCALE)
+        factors[classes == relay_class] = weight / WEIGHT_SCALE
+    weights = table.consensus_weight[rows] * factors
+    if position == "exit":
+        # Tor never picks a BadExit as exit
+        weights[table.has_flag("BadExit", rows)] = 0
+    return weights
+
+
+def family_ids(table):
+    """
+    Returns a family ID for each relay. Relays listed in each other's effective_family share an
+    ID, and the relation is followed transitively, so a relay is never excluded less than Tor
+    would exclude it. Relays without a family get an ID of their own.
+    """
+    parent = list(range(len(table)))
+
+    def find(row):
+        while parent[row] != row:
+            parent[row] = parent[parent[row]]
+            row = parent[row]
+        return row
+
+    for row, relay in enumerate(table.records):
+        for member in relay.get("effective_family", ()):
+            other = table.index.get(member.lstrip("$"))
+            if other is not None:
+                parent[find(other)] = find(row)
+    return np.array([find(row) for row in range(len(table))], dtype=np.intp)
+
+
+def subnet_ids(table):
+    """
+    Returns the IPv4 /16 network of each relay as an integer. Relays without an IPv4 address get
+    a negative ID of their own, so they never share a network.
+    """
+    subnets = np.empty(len(table), dtype=np.int64)
+    for row, address in enumerate(table.ipv4_address):
+        subnets[row] = address_to_int(address) >> 16 if address is not None else -(row + 1)
+    return subnets
+
+
+# --------------------- Alias table ---------------------#
+class AliasTable:
+    """
+    Walker's alias table (Vose's construction) for drawing indices in proportion to weights in
+    O(1) per draw.
+
+    Args:
+    - weights: non-negative weights, at least one of them positive
+    """
+
+    def __init__(self, weights):
+        weights = np.asarray(weights, dtype=float)
+        size = len(weights)
+        total = weights.sum()
+        if size == 0 or total <= 0:
+            raise ValueError("An alias table needs at least one positive weight")
+
+        scaled = weights * size / total
+        self.probability = np.ones(size)
+        self.alias = np.arange(size, dtype=np.intp)
+        small = [index for index in range(size) if scaled[index] < 1]
+        large = [index for index in range(size) if scaled[index] >= 1]
+        while small and large:
+            less, more = small.pop(), large.pop()
+            self.probability[less] = scaled[less]
+            self.alias[less] = more
+            scaled[more] -= 1 - scaled[less]
+            (small if scaled[more] < 1 else large).append(more)
+        # Whatever is left has a scaled weight of 1 up to rounding errors
+
+    def __len__(self):
+        return len(self.probability)
+
+    def draw(self, rng, count):
+        """
+        Returns count indices drawn in proportion to the weights.
+        """
+        columns = rng.integers(0, len(self), count)
+        keep = rng.random(count) < self.probability[columns]
+        return np.where(keep, columns, self.alias[columns])
+
+
+# --------------------- Path sampler ---------------------#
+class PathSampler:
+    """
+    Draws paths from filtered entry, middle and exit pools with Tor's position weighting and its
+    family and /16 exclusions.
+
+    Guards are drawn fresh for every path, like FINDPATH after DROPGUARDS.
+
+    Args:
+    - table: a RelayTable
+    - entry_pool, middle_pool, exit_pool: row indices of each pool, e.g. FilterPipeline.pools()
+    - bandwidth_weights: the consensus bandwidth weights, see position_weights()
+    - seed: seed of the random number generator, or a numpy Generator
+    """
+
+    def __init__(self, table, entry_pool, middle_pool, exit_pool, bandwidth_weights=None, seed=None):
+        self.table = table
+        self.pools = {
+            "entry": np.asarray(entry_pool, dtype=np.intp),
+            "middle": np.asarray(middle_pool, dtype=np.intp),
+            "exit": np.asarray(exit_pool, dtype=np.intp),
+        }
+        self.rng = np.random.default_rng(seed)
+        self.family = family_ids(table)
+        self.subnet = subnet_ids(table)
+
+        self.alias_tables = {}
+        for position, pool in self.pools.items():
+            try:
+                self.alias_tables[position] = AliasTable(position_weights(table, pool, position, bandwidth_weights))
+            except ValueError:
+                raise ValueError(f"The {position} pool has no relay with a positive weight") from None
+
+    def _conflicts(self, rows, chosen):
+        conflict = np.zeros(len(rows), dtype=bool)
+        for other in chosen:
+            conflict |= rows == other
+            conflict |= self.family[rows] == self.family[other]
+            conflict |= self.subnet[rows] == self.subnet[other]
+        return conflict
+
+    def _draw(self, position, count, chosen):
+        pool = self.pools[position]
+        alias_table = self.alias_tables[position]
+        rows = pool[alias_table.draw(self.rng, count)]
+        redraw = np.flatnonzero(self._conflicts(rows, chosen))
+        for _ in range(MAX_REDRAWS):
+            if not len(redraw):
+                return rows
+            rows[redraw] = pool[alias_table.draw(self.rng, len(redraw))]
+            conflict = self._conflicts(rows[redraw], [other[redraw] for other in chosen])
+            redraw = redraw[conflict]
+        raise ValueError(f"No {position} relay is outside the family and /16 of the rest of the path")
+
+    def sample(self, count):
+        """
+        Draws count paths.
+
+        Returns:
+        - an intp array of shape (count, 3) with the entry, middle and exit row of each path
+        """
+        chosen = {}
+        for position in SELECTION_ORDER:
+            chosen[position] = self._draw(position, count, list(chosen.values()))
+        return np.stack([chosen[position] for position in PATH_ORDER], axis=1)
+
+    def paths(self, count):
+        """
+        Yields count paths as lists of [entry, middle, exit] fingerprints, the relay_fingerprints
+        measure_request() gets from FINDPATH.
+        """
+        while count > 0:
+            chunk = self.sample(min(count, CHUNK_SIZE))
+            for path in self.table.fingerprint[chunk].tolist():
+                yield path
+            count -= len(chunk)
+
+
+# --------------------- Validation ---------------------#
+def compare_with_findpath(sampler, findpath_paths, samples=1000000, min_expected=5):
+    """
+    Tests whether paths from the patched FINDPATH command follow the sampler's distribution, one
+    chi-square goodness of fit test per position.
+
+    The expected frequency of each relay is estimated from samples paths of the sampler. Relays
+    expected less than min_expected times among the FINDPATH paths are merged into one bin,
+    together with relays the sampler never chose.
+
+    Args:
+    - sampler: a PathSampler over the pools Tor was started with
+    - findpath_paths: lists of [entry, middle, exit] fingerprints returned by FINDPATH
+    - samples: number of paths drawn from the sampler
+    - min_expected: smallest expected count of a bin
+
+    Returns:
+    - a dictionary with, for each position, the chi-square "statistic", "pvalue" and
+    "degrees_of_freedom", and the number of FINDPATH relays the sampler never chose ("unknown")
+    """
+    table = sampler.table
+    observed_rows = np.array(
+        [[table.index.get(fingerprint, -1) for fingerprint in path] for path in findpath_paths], dtype=np.intp
+    ).reshape(-1, len(PATH_ORDER))
+    reference = sampler.sample(samples)
+
+    results = {}
+    for column, position in enumerate(PATH_ORDER):
+        rows = observed_rows[:, column]
+        known = rows >= 0
+        observed = np.bincount(rows[known], minlength=len(table)).astype(float)
+        expected = np.bincount(reference[:, column], minlength=len(table)) * (len(rows) / samples)
+
+        unknown = int((~known).sum() + observed[expected == 0].sum())
+        large = expected >= min_expected
+        observed_bins = np.append(observed[large], observed[~large].sum() + (~known).sum())
+        expected_bins = np.append(expected[large], expected[~large].sum())
+        if expected_bins[-1] == 0 and observed_bins[-1] == 0:
+            observed_bins, expected_bins = observed_bins[:-1], expected_bins[:-1]
+
+        if len(expected_bins) < 2:
+            statistic, pvalue = 0.0, 1.0
+        elif expected_bins[-1] == 0:
+            # FINDPATH chose relays the sampler never did
+            statistic, pvalue = float("inf"), 0.0
+        else:
+            statistic, pvalue = stats.chisquare(observed_bins, expected_bins)
+        results[position] = {
+            "statistic": float(statistic),
+            "pvalue": float(pvalue),
+            "degrees_of_freedom": max(len(expected_bins) - 1, 0),
+            "unknown": unknown,
+        }
+    return results
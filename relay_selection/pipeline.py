@@ -0,0 +1,291 @@
+"""
+Declarative filter pipeline for the relay selection experiments.
+
+A FilterPipeline is a chain of stages over a RelayTable, e.g.
+
+    pipeline = FilterPipeline(table).distance(0.6).fast_flag().bandwidth(0.5).overload(1)
+    entry_pool, middle_pool, exit_pool = pipeline.pools()
+
+Each stage produces a boolean mask over all relays in the table. Nothing is evaluated until
+rows() or pools() is called, and then the masks are combined in the order the stages were
+added. Stage masks are memoized by the snapshot ID of the table and the parameters of the stage
+(and of the stages before it when the stage depends on them), so running the same configuration
+on the same relays again costs a dictionary lookup.
+"""
+import collections
+import hashlib
+
+import numpy as np
+
+from relay_selection import table as relay_table
+
+# --------------------- Constants ---------------------#
+# Number of stage masks kept in memory
+MEMO_SIZE = 256
+
+# Memoized stage masks, (snapshot ID, stage keys) -> boolean mask
+_masks = collections.OrderedDict()
+
+
+def snapshot_digest(table):
+    """
+    Returns a SHA256 of the columns the filter stages read, used as snapshot ID of a RelayTable
+    that was not saved to a SnapshotStore.
+    """
+    digest = hashlib.sha256()
+    digest.update("\n".join(table.fingerprint.tolist()).encode("utf-8"))
+    digest.update("\n".join("" if address is None else address for address in table.ipv4_address).encode("utf-8"))
+    for column in (table.distance, table.observed_bandwidth, table.overload, table.flags):
+        digest.update(np.ascontiguousarray(column).tobytes())
+    exit_policies = table.exit_policies()
+    digest.update(repr(exit_policies.policies).encode("utf-8"))
+    digest.update(exit_policies.policy.tobytes())
+    return digest.hexdigest()
+
+
+def _rows_to_mask(size, rows):
+    mask = np.zeros(size, dtype=bool)
+    mask[rows] = True
+    return mask
+
+
+def clear_memo():
+    """
+    Forgets every memoized stage mask.
+    """
+    _masks.clear()
+
+
+# --------------------- Stages ---------------------#
+class Stage:
+    """
+    A filter stage. Subclasses set name, their parameters in params, and implement evaluate().
+
+    Stages that only look at the relay itself (e.g. its flags) set depends_on_upstream to False,
+    so their mask is shared between pipelines with different stages before them.
+    """
+
+    name = None
+    depends_on_upstream = True
+
+    def __init__(self, *params):
+        self.params = params
+
+    def key(self):
+        """
+        Returns the stage name and parameters, the memo key of the stage.
+        """
+        return (self.name,) + self.params
+
+    def evaluate(self, table, mask, upstream):
+        """
+        Returns the boolean mask of relays the stage keeps.
+
+        Args:
+        - table: a RelayTable
+        - mask: boolean mask of the relays left after the stages before this one
+        - upstream: the stages before this one
+        """
+        raise NotImplementedError
+
+
+class DistanceStage(Stage):
+    """
+    Drops the distance_threshold share of relays furthest away from the client, like
+    sort_relay_distances() followed by filter_out_high_distance_relays().
+    """
+
+    name = "distance"
+
+    def __init__(self, distance_threshold):
+        super().__init__(distance_threshold)
+        self.distance_threshold = distance_threshold
+
+    def evaluate(self, table, mask, upstream):
+        kept = relay_table.select_closest_relays(table, np.flatnonzero(mask), self.distance_threshold)
+        return _rows_to_mask(len(table), kept)
+
+
+class FlagStage(Stage):
+    """
+    Keeps the relays that have all the required flags and none of the forbidden ones, e.g.
+    FlagStage(("Fast",)) like filter_based_on_flags().
+    """
+
+    name = "flag"
+    depends_on_upstream = False
+
+    def __init__(self, required=("Fast",), forbidden=()):
+        super().__init__(tuple(required), tuple(forbidden))
+        self.required = tuple(required)
+        self.forbidden = tuple(forbidden)
+
+    def evaluate(self, table, mask, upstream):
+        return table.match_flags(self.required, self.forbidden)
+
+
+class BandwidthStage(Stage):
+    """
+    Drops the relay_bandwidth_cutoff share of relays with the lowest bandwidth from each of the
+    entry, middle and exit pools, like sort_relays_by_bandwidth() followed by
+    filter_out_low_bandwidth_relays(). Ties are broken by distance if a DistanceStage ran before.
+    """
+
+    name = "bandwidth"
+
+    def __init__(self, relay_bandwidth_cutoff):
+        super().__init__(relay_bandwidth_cutoff)
+        self.relay_bandwidth_cutoff = relay_bandwidth_cutoff
+
+    def evaluate(self, table, mask, upstream):
+        pools = relay_table.categorize_relays(table, np.flatnonzero(mask))
+        ties_by_distance = any(isinstance(stage, DistanceStage) for stage in upstream)
+        kept = relay_table.select_high_bandwidth_relays(
+            table, *pools, self.relay_bandwidth_cutoff, ties_by_distance=ties_by_distance
+        )
+        return _rows_to_mask(len(table), np.concatenate(kept))
+
+
+class OverloadStage(Stage):
+    """
+    Drops the relays with an overload_general_timestamp after a threshold in milliseconds, see
+    relay_table.overload_threshold(). Relays that never reported an overload are kept.
+    """
+
+    name = "overload"
+    depends_on_upstream = False
+
+    def __init__(self, time_filter):
+        super().__init__(time_filter)
+        self.time_filter = time_filter
+
+    def evaluate(self, table, mask, upstream):
+        return table.overload <= self.time_filter
+
+
+class ExitPortStage(Stage):
+    """
+    Drops the exit relays whose exit policy rejects a port, so Tor is only given exits that can
+    carry the measured request. Entry and middle relays are kept.
+    """
+
+    name = "exit_port"
+    depends_on_upstream = False
+
+    def __init__(self, port):
+        super().__init__(port)
+        self.port = port
+
+    def evaluate(self, table, mask, upstream):
+        return relay_table.exit_port_mask(table, self.port)
+
+
+# --------------------- Pipeline ---------------------#
+class FilterPipeline:
+    """
+    An immutable chain of filter stages over a RelayTable. Adding a stage returns a new pipeline,
+    so a shorter pipeline can be kept around, e.g. for the relays before the pool filters.
+
+    The stage methods take the experiment parameters as they are, and a parameter of 0 leaves
+    the stage out, like the "if x != 0" checks in experiment().
+
+    Args:
+    - table: a RelayTable with its distances calculated
+    - snapshot_id: ID of the relay snapshot the table holds, snapshot_digest(table) if None
+    - stages: the stages of the pipeline, in order
+    """
+
+    def __init__(self, table, snapshot_id=None, stages=()):
+        self.table = table
+        self.snapshot_id = snapshot_digest(table) if snapshot_id is None else snapshot_id
+        self.stages = tuple(stages)
+        self._mask = None
+
+    def then(self, stage):
+        """
+        Returns a new pipeline with a stage added at the end.
+        """
+        return FilterPipeline(self.table, self.snapshot_id, self.stages + (stage,))
+
+    def distance(self, distance_threshold):
+        """
+        Adds a DistanceStage, unless distance_threshold is 0.
+        """
+        return self.then(DistanceStage(distance_threshold)) if distance_threshold else self
+
+    def fast_flag(self, flags=1):
+        """
+        Adds a FlagStage for the 'Fast' flag, unless flags is 0.
+        """
+        return self.then(FlagStage(("Fast",))) if flags else self
+
+    def with_flags(self, required=(), forbidden=()):
+        """
+        Adds a FlagStage keeping relays with all the required flags and none of the forbidden
+        ones, e.g. with_flags(("Stable",), ("BadExit",)).
+        """
+        return self.then(FlagStage(required, forbidden))
+
+    def bandwidth(self, relay_bandwidth_cutoff):
+        """
+        Adds a BandwidthStage, unless relay_bandwidth_cutoff is 0.
+        """
+        return self.then(BandwidthStage(relay_bandwidth_cutoff)) if relay_bandwidth_cutoff else self
+
+    def overload(self, overload, now=None):
+        """
+        Adds an OverloadStage dropping relays overloaded within the last overload hours, unless
+        overload is 0.
+        """
+        if not overload:
+            return self
+        return self.then(OverloadStage(relay_table.overload_threshold(overload, now)))
+
+    def exit_port(self, port):
+        """
+        Adds an ExitPortStage for a destination port, unless port is None.
+        """
+        return self.then(ExitPortStage(port)) if port is not None else self
+
+    def _stage_mask(self, index, mask):
+        stage = self.stages[index]
+        if stage.depends_on_upstream:
+            key = (self.snapshot_id,) + tuple(upstream.key() for upstream in self.stages[: index + 1])
+        else:
+            key = (self.snapshot_id, stage.key())
+
+        stage_mask = _masks.get(key)
+        if stage_mask is None:
+            stage_mask = stage.evaluate(self.table, mask, self.stages[:index])
+            stage_mask.setflags(write=False)
+            _masks[key] = stage_mask
+            if len(_masks) > MEMO_SIZE:
+                _masks.popitem(last=False)
+        else:
+            _masks.move_to_end(key)
+        return stage_mask
+
+    def mask(self):
+        """
+        Returns the boolean mask of the relays that pass every stage, evaluating the stages the
+        first time it is called.
+        """
+        if self._mask is None:
+            mask = np.ones(len(self.table), dtype=bool)
+            for index in range(len(self.stages)):
+                mask = mask & self._stage_mask(index, mask)
+            self._mask = mask
+        return self._mask
+
+    def rows(self):
+        """
+        Returns the row indices of the relays that pass every stage, in table order.
+        """
+        return np.flatnonzero(self.mask())
+
+    def pools(self):
+        """
+        Returns the entry, middle and exit pools of the relays that pass every stage, see
+        relay_table.categorize_relays().
+        """
+        return relay_table.categorize_relays(self.table, self.rows())
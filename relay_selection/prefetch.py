@@ -0,0 +1,138 @@
+"""
+Background path prefetching for the measurement loop.
+
+Getting a path from Tor (a batched FINDPATH, see findpath.py) happens in a worker thread that
+keeps a bounded queue of ready paths filled, so measure_request() gets its next path from the
+queue without waiting on the control port. Paths whose relays are no longer in the current
+entry, middle and exit pools are discarded, and every time the loop finds the queue empty it
+is recorded as an underflow.
+"""
+import queue
+import threading
+import time
+
+# --------------------- Constants ---------------------#
+# Paths kept ready in the queue
+PREFETCH_SIZE = 32
+
+# Seconds the worker waits on a full queue before checking whether it was closed
+POLL_INTERVAL = 0.5
+
+# Put in the queue by the worker when the path source is exhausted or failed
+_DONE = object()
+
+
+class PathPrefetcher:
+    """
+    A bounded queue of paths filled from a path source by a background thread. It is an
+    iterator, so measure_request() takes the next path with next(prefetcher).
+
+    Args:
+    - source: an iterable of [entry, middle, exit] fingerprint lists, e.g. find_paths(controller)
+    - size: number of paths kept ready
+    - pools: the (entry, middle, exit) fingerprints paths must be drawn from, None to keep every path
+
+    Attributes:
+    - underflows: time.time() of every request that found the queue empty and had to wait
+    - discarded: number of paths dropped because a relay left its pool
+    """
+
+    def __init__(self, source, size=PREFETCH_SIZE, pools=None):
+        self.source = iter(source)
+        self.queue = queue.Queue(maxsize=size)
+        self.pools = None
+        if pools is not None:
+            self.update_pools(*pools)
+        self.underflows = []
+        self.discarded = 0
+        self._error = None
+        self._exhausted = False
+        self._closed = threading.Event()
+        self._worker = threading.Thread(target=self._fill, name="path-prefetch", daemon=True)
+        self._worker.start()
+
+    def update_pools(self, entry_pool, middle_pool, exit_pool):
+        """
+        Sets the fingerprints of the current pools. Queued paths with a relay outside its pool are
+        discarded when they are taken out of the queue.
+        """
+        self.pools = (frozenset(entry_pool), frozenset(middle_pool), frozenset(exit_pool))
+
+    def is_current(self, path):
+        """
+        Returns True if each relay of the path is in the pool of its position.
+        """
+        pools = self.pools
+        return pools is None or all(fingerprint in pool for fingerprint, pool in zip(path, pools))
+
+    def _put(self, item):
+        while not self._closed.is_set():
+            try:
+                self.queue.put(item, timeout=POLL_INTERVAL)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _fill(self):
+        try:
+            for path in self.source:
+                if self._closed.is_set():
+                    return
+                if not self.is_current(path):
+                    self.discarded += 1
+                    continue
+                if not self._put(path):
+                    return
+        except Exception as exc:
+            self._error = exc
+        self._exhausted = self._put(_DONE)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        """
+        Returns the next path that is still in the current pools, waiting for the worker if the
+        queue is empty.
+
+        Raises:
+        - StopIteration when the path source is exhausted
+        - the exception the path source raised, e.g. a stem.ControllerError from FINDPATH
+        """
+        while True:
+            try:
+                path = self.queue.get_nowait()
+            except queue.Empty:
+                self.underflows.append(time.time())
+                path = self.queue.get()
+
+            if path is _DONE:
+                # Leave the marker for later calls
+                self.queue.put_nowait(_DONE)
+                if self._error is not None:
+                    raise self._error
+                raise StopIteration
+            if self.is_current(path):
+                return path
+            self.discarded += 1
+
+    def stats(self):
+        """
+        Returns the number of underflows, discarded paths and paths queued right now.
+        """
+        queued = self.queue.qsize() - int(self._exhausted)
+        return {"underflows": len(self.underflows), "discarded": self.discarded, "queued": max(queued, 0)}
+
+    def close(self):
+        """
+        Stops the worker. It finishes the path it is fetching, so a FINDPATH in flight completes.
+        """
+        self._closed.set()
+        self._worker.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
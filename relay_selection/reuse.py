@@ -0,0 +1,127 @@
+"""
+Circuit reuse across requests.
+
+By default measure_request() builds a circuit, makes one request and closes it, so most of an
+experiment is spent building circuits. CircuitReuse keeps the circuit of the last request open
+and hands it to the next requests, up to requests_per_circuit requests or until dirtiness seconds
+have passed since its first request, like a Tor client reusing a circuit for new streams. The
+measurements then show the steady-state latency of circuits from the filtered pools.
+
+Tor itself closes a used circuit MaxCircuitDirtiness (10 minutes by default) after its first
+stream, so a longer dirtiness only ends in a failed request and a new circuit.
+
+Requests running concurrently may share the current circuit. A circuit replaced while requests
+are still on it is closed once the last of them is released.
+"""
+import threading
+import time
+
+import stem
+
+
+class CircuitReuse:
+    """
+    Hands the current circuit to requests until it has carried its requests or is too dirty.
+
+    Args:
+    - controller: an authenticated stem Controller, used to close finished circuits
+    - requests_per_circuit: requests carried by each circuit, 1 builds a circuit for every request
+    - dirtiness: seconds a circuit is reused for after its first request, None for no limit
+
+    Attributes:
+    - current: the circuit being reused, a dictionary with its "circuit_id", "path", "rtt",
+    "first_used" time, number of "requests" so far and number of "active" requests, or None
+    """
+
+    def __init__(self, controller, requests_per_circuit=1, dirtiness=None):
+        self.controller = controller
+        self.requests_per_circuit = requests_per_circuit
+        self.dirtiness = dirtiness
+        self.current = None
+        self._lock = threading.Lock()
+        # Circuit ID -> circuit dictionary of the circuits with active requests or current
+        self._circuits = {}
+
+    def _usable(self, circuit, now):
+        if circuit["requests"] >= self.requests_per_circuit:
+            return False
+        return self.dirtiness is None or now - circuit["first_used"] < self.dirtiness
+
+    def _close(self, circuit_id):
+        try:
+            self.controller.close_circuit(circuit_id)
+        except stem.ControllerError as exc:
+            print(f"ERROR:Unable to close circuit: {exc}, Moving on..")
+
+    def take(self):
+        """
+        Returns the current circuit for one more request, or None if a new circuit has to be
+        built. A circuit that got too dirty while waiting for the request is closed.
+        """
+        with self._lock:
+            circuit = self.current
+            if circuit is None:
+                return None
+            if self._usable(circuit, time.time()):
+                circuit["requests"] += 1
+                circuit["active"] += 1
+                # A copy, so concurrent requests keep their own request number
+                return dict(circuit)
+            self.current = None
+            closing = circuit["circuit_id"] if circuit["active"] == 0 else None
+            if closing is not None:
+                del self._circuits[closing]
+        if closing is not None:
+            self._close(closing)
+        return None
+
+    def start(self, circuit_id, path, rtt):
+        """
+        Makes a newly built circuit the current one and counts its first request.
+
+        Returns:
+        - a copy of the circuit dictionary, see the current attribute
+        """
+        circuit = {
+            "circuit_id": circuit_id, "path": path, "rtt": rtt, "first_used": time.time(), "requests": 1, "active": 1
+        }
+        with self._lock:
+            previous = self.current
+            closing = None
+            if previous is not None and previous["active"] == 0:
+                closing = previous["circuit_id"]
+                del self._circuits[closing]
+            self.current = self._circuits[circuit_id] = circuit
+        if closing is not None:
+            self._close(closing)
+        return dict(circuit)
+
+    def release(self, circuit_id, failed=False):
+        """
+        Ends a request on a circuit. The circuit is closed if the request failed or the circuit
+        has no request left, otherwise it is kept for the next request.
+        """
+        with self._lock:
+            circuit = self._circuits.get(circuit_id)
+            if circuit is not None:
+                circuit["active"] -= 1
+                if circuit is self.current:
+                    if not failed and self._usable(circuit, time.time()):
+                        return
+                    self.current = None
+                if circuit["active"] > 0:
+                    # Closed by the last request still on it
+                    return
+                del self._circuits[circuit_id]
+        self._close(circuit_id)
+
+    def close(self):
+        """
+        Closes the current circuit and the circuits with requests still on them.
+        """
+        with self._lock:
+            circuit_ids = list(self._circuits)
+            self._circuits.clear()
+            self.current = None
+        for circuit_id in circuit_ids:
+            self._close(circuit_id)
@@ -0,0 +1,73 @@
+"""
+Circuit round-trip time probes.
+
+The RTT of a circuit is measured the way measure_circuit_rtt() in the experiment scripts did it:
+a SOCKS connection to an address in 127.0.0.0/8 is attached to the circuit, the exit refuses it,
+and the time from the connect to the refusal is one round trip through the circuit.
+
+RttProber binds each probe socket before it connects and routes its source port to the circuit
+through a StreamDispatcher, so no listener is registered per probe and several circuits can be
+probed at once.
+"""
+import socket
+import time
+
+from socks import PROXY_TYPE_SOCKS5, socksocket
+
+# --------------------- Constants ---------------------#
+SOCKS_PORT = 9050
+
+# Address and port the probes connect to, every exit rejects them
+PROBE_ADDRESS = "127.0.0.1"
+PROBE_PORT = 80
+
+# Seconds before a probe gives up on its stream
+PROBE_TIMEOUT = 30
+
+
+class RttProber:
+    """
+    Measures the RTT of circuits through Tor's SOCKS port.
+
+    Args:
+    - dispatcher: the relay_selection.dispatcher.StreamDispatcher of the controller
+    - socks_port: the SocksPort of the Tor client
+    - timeout: seconds before a probe gives up
+    """
+
+    def __init__(self, dispatcher, socks_port=SOCKS_PORT, timeout=PROBE_TIMEOUT):
+        self.dispatcher = dispatcher
+        self.socks_port = socks_port
+        self.timeout = timeout
+
+    def probe(self, circuit_id):
+        """
+        Measures the RTT of one circuit.
+
+        Returns:
+        - the RTT in seconds, or None if the stream could not be attached to the circuit or the
+        probe timed out
+        """
+        probe_socket = socksocket()
+        # The source port is known before connecting, so the dispatcher can tell the probe's stream apart
+        probe_socket.bind(("127.0.0.1", 0))
+        source_port = probe_socket.getsockname()[1]
+        username = self.dispatcher.route(circuit_id, source_port)
+        probe_socket.setproxy(PROXY_TYPE_SOCKS5, "127.0.0.1", self.socks_port, True, username, "rtt")
+        probe_socket.settimeout(self.timeout)
+
+        timed_out = False
+        start_time_rtt = time.time()
+        try:
+            probe_socket.connect((PROBE_ADDRESS, PROBE_PORT))
+        except Exception as error:
+            # Tor's SOCKS implementation sends a general error response when the exit refuses the
+            # connection, see stream_end_reason_to_socks5_response(). PySocks wraps a timeout.
+            timed_out = isinstance(getattr(error, "socket_err", error), socket.timeout)
+        end_time_rtt = time.time()
+        probe_socket.close()
+
+        failed = self.dispatcher.unroute(circuit_id, source_port)
+        if timed_out or failed:
+            return None
+        return end_time_rtt - start_time_rtt
@@ -0,0 +1,174 @@
+"""
+Content-addressed store for relay snapshots.
+
+The experiments used to save the full relay list and each pool as separate JSON files, which
+are mostly copies of the same relay data. Instead, every relay snapshot (the relays of a
+RelayTable with their location and distance) is saved once under the hash of its content, and
+an experiment only records the snapshot ID and the row indices of its pools.
+
+load_view() rebuilds the old {filename}_relays.json, _entry_pool.json, _middle_pool.json and
+_exit_pool.json lists on demand. Run this module from the repository root with a results folder to
+write them to disk:
+
+    python -m relay_selection.snapshots ./results/combined_60-95_modified_data
+"""
+import argparse
+import gzip
+import hashlib
+import json
+import os
+
+from relay_selection.table import RelayTable
+
+# --------------------- Constants ---------------------#
+DEFAULT_SNAPSHOT_DIR = "./results/snapshots"
+
+# Views saved by the experiment scripts, as {filename}_{view}.json
+VIEWS = ("relays", "entry_pool", "middle_pool", "exit_pool")
+
+
+class SnapshotStore:
+    """
+    Saves relay snapshots as gzipped JSON files named after the SHA256 of their content.
+
+    Args:
+    - root: directory the snapshots are written to
+    """
+
+    def __init__(self, root=DEFAULT_SNAPSHOT_DIR):
+        self.root = root
+
+    def path(self, snapshot_id):
+        """
+        Returns the path of the snapshot file for a snapshot ID.
+        """
+        return os.path.join(self.root, f"{snapshot_id}.json.gz")
+
+    def save(self, relays):
+        """
+        Saves a list of relay dictionaries unless a snapshot with the same content exists.
+
+        Args:
+        - relays: a list of relays, where each relay is a dictionary
+
+        Returns:
+        - the snapshot ID, the hex SHA256 of the canonical JSON encoding of relays
+        """
+        content = json.dumps(relays, sort_keys=True, separators=(",", ":")).encode("utf-8")
+        snapshot_id = hashlib.sha256(content).hexdigest()
+
+        path = self.path(snapshot_id)
+        if not os.path.exists(path):
+            os.makedirs(self.root, exist_ok=True)
+            with gzip.open(path + ".tmp", "wb") as outfile:
+                outfile.write(content)
+            os.replace(path + ".tmp", path)
+        return snapshot_id
+
+    def save_table(self, table):
+        """
+        Saves every relay of a RelayTable, see RelayTable.to_relays(). Row i of the table is
+        relay i of the snapshot, so pools of row indices can be resolved against it.
+        """
+        return self.save(table.to_relays(table.all_rows()))
+
+    def load(self, snapshot_id):
+        """
+        Returns the list of relay dictionaries saved under a snapshot ID.
+        """
+        with gzip.open(self.path(snapshot_id), "rb") as infile:
+            return json.loads(infile.read().decode("utf-8"))
+
+    def load_table(self, snapshot_id):
+        """
+        Returns the RelayTable of a snapshot saved by save_table(), with the location and distance
+        of each relay restored, so its rows are the row indices the pools were saved with.
+        """
+        relays = self.load(snapshot_id)
+        table = RelayTable(relays)
+        for row, relay in enumerate(relays):
+            if "latitude" in relay:
+                table.latitude[row] = relay["latitude"]
+                table.longitude[row] = relay["longitude"]
+            table.distance[row] = relay.get("distance", float("inf"))
+        return table
+
+
+def write_pools(path, snapshot_id, pools, parameters=None):
+    """
+    Saves the pools of an experiment as row indices into a snapshot.
+
+    Args:
+    - path: the file to write, e.g. ./results/{filename}/{filename}_pools.json
+    - snapshot_id: the ID returned by SnapshotStore.save_table()
+    - pools: a dictionary mapping view names (see VIEWS) to arrays of row indices
+    - parameters: the filter parameters the pools were made with, e.g. the distance, bandwidth,
+    overload, flags and exit_port of the experiment
+    """
+    record = {
+        "snapshot": snapshot_id,
+        "pools": {name: [int(row) for row in rows] for name, rows in pools.items()},
+    }
+    if parameters is not None:
+        record["parameters"] = parameters
+    with open(path, "w") as outfile:
+        json.dump(record, outfile)
+
+
+def load_pools(path):
+    """
+    Returns the snapshot ID and the pools dictionary saved by write_pools().
+    """
+    with open(path, "r") as infile:
+        record = json.load(infile)
+    return record["snapshot"], record["pools"]
+
+
+def load_view(results_dir, filename, view, store=None):
+    """
+    Returns one of the old per-experiment relay lists, e.g. the entry pool of an experiment.
+
+    Results saved before the snapshot store have the list in {filename}_{view}.json, which is
+    read directly. Newer results are rebuilt from {filename}_pools.json and the snapshot.
+
+    Args:
+    - results_dir: the folder of the experiment, e.g. ./results/{filename}
+    - filename: the filename the experiment was run with
+    - view: one of VIEWS
+    - store: the SnapshotStore the snapshot was saved in
+
+    Returns:
+    - a list of relays, where each relay is a dictionary
+    """
+    legacy_path = os.path.join(results_dir, f"{filename}_{view}.json")
+    if os.path.exists(legacy_path):
+        with open(legacy_path, "r") as infile:
+            return json.load(infile)
+
+    if store is None:
+        store = SnapshotStore()
+    snapshot_id, pools = load_pools(os.path.join(results_dir, f"{filename}_pools.json"))
+    relays = store.load(snapshot_id)
+    return [relays[row] for row in pools[view]]
+
+
+def main():
+    arguments = argparse.ArgumentParser(description="Write the relay and pool JSON files of an experiment from its snapshot")
+    arguments.add_argument("results_dir", help="Folder of the experiment, e.g. ./results/combined_60-95_modified_data")
+    arguments.add_argument("--snapshots", default=DEFAULT_SNAPSHOT_DIR, help="Folder of the snapshot store")
+    args = arguments.parse_args()
+
+    filename = os.path.basename(os.path.normpath(args.results_dir))
+    store = SnapshotStore(args.snapshots)
+    for view in VIEWS:
+        path = os.path.join(args.results_dir, f"{filename}_{view}.json")
+        if os.path.exists(path):
+            continue
+        relays = load_view(args.results_dir, filename, view, store)
+        with open(path, "w") as outfile:
+            json.dump(relays, outfile)
+        print(f"Wrote {path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,202 @@
+"""
+Parameter sweep engine for the relay selection experiments.
+
+The find optimal values experiment runs the same relay snapshot through many (distance,
+bandwidth, overload, flags) points. Instead of rebuilding the pools for every point, the
+SweepEngine ranks the relays by distance once, and orders each of the entry, middle and exit
+pools by bandwidth once. The pools of a point then follow from comparing those ranks with the
+cut-offs of the point, and grid() derives the pools of a whole distance x bandwidth grid at once.
+
+The pools are the same as the ones FilterPipeline (and the sort based functions) build for the
+same parameters, including relays tied at a cut-off.
+"""
+import numpy as np
+
+from relay_selection import table as relay_table
+from relay_selection.overload import OverloadIndex
+
+# --------------------- Constants ---------------------#
+POOLS = ("entry_pool", "middle_pool", "exit_pool")
+
+
+def _keep_count(size, cutoff):
+    # Same rounding as filter_out_high_distance_relays() and filter_out_low_bandwidth_relays()
+    return int(size * (1 - cutoff)) if cutoff else size
+
+
+def point_result(table, pools):
+    """
+    Describes the pools of one sweep point.
+
+    Args:
+    - table: the RelayTable the pools index into
+    - pools: a tuple of three row index arrays (entry, middle and exit)
+
+    Returns:
+    - a dictionary with the row indices of each pool under its name (see POOLS), the number
+    of relays in each pool under "sizes" and the fingerprints of each pool under "fingerprints"
+    """
+    result = dict(zip(POOLS, pools))
+    result["sizes"] = {name: len(pool) for name, pool in zip(POOLS, pools)}
+    result["fingerprints"] = {name: frozenset(table.fingerprints(pool)) for name, pool in zip(POOLS, pools)}
+    return result
+
+
+class SweepEngine:
+    """
+    Precomputed distance and bandwidth ranks of one relay snapshot.
+
+    Args:
+    - table: a RelayTable with its distances calculated
+    """
+
+    def __init__(self, table):
+        self.table = table
+        size = len(table)
+
+        # Position of each relay in sort_relay_distances() order
+        self.distance_rank = np.empty(size, dtype=np.intp)
+        self.distance_rank[np.argsort(table.distance, kind="stable")] = np.arange(size)
+        self.fast = table.has_flag("Fast")
+        self.pools = relay_table.categorize_relays(table, table.all_rows())
+        self.overload_index = OverloadIndex(table)
+
+        # Each pool in sort_relays_by_bandwidth() order. Bandwidth ties keep the order the pool
+        # had before, which is by distance when the distance filter ran and by row otherwise.
+        bandwidth = table.observed_bandwidth
+        self.bandwidth_order = {
+            False: tuple(pool[np.argsort(-bandwidth[pool], kind="stable")] for pool in self.pools),
+            True: tuple(pool[np.lexsort((self.distance_rank[pool], -bandwidth[pool]))] for pool in self.pools),
+        }
+
+    def relay_mask(self, distance, flags):
+        """
+        Returns the boolean mask of relays left after the distance and flag filters.
+        """
+        mask = self.distance_rank < _keep_count(len(self.table), distance)
+        if flags:
+            mask &= self.fast
+        return mask
+
+    def overload_mask(self, overload, now=None):
+        """
+        Returns the boolean mask of relays that pass the overload filter, all True if overload is 0.
+        """
+        if not overload:
+            return np.ones(len(self.table), dtype=bool)
+        return self.overload_index.mask(overload, now)
+
+    def exit_port_mask(self, exit_port):
+        """
+        Returns the mask dropping exits whose policy rejects exit_port, all True if it is None.
+        """
+        if exit_port is None:
+            return np.ones(len(self.table), dtype=bool)
+        return relay_table.exit_port_mask(self.table, exit_port)
+
+    def relays(self, distance, flags):
+        """
+        Returns the row indices of the relays left after the distance and flag filters.
+        """
+        return np.flatnonzero(self.relay_mask(distance, flags))
+
+    def pools_for(self, distance, bandwidth, overload, flags, now=None, exit_port=None):
+        """
+        Returns the entry, middle and exit pools of one point, like FilterPipeline(table)
+        .distance(distance).fast_flag(flags).bandwidth(bandwidth).overload(overload)
+        .exit_port(exit_port).pools().
+
+        Args:
+        - distance, bandwidth, overload, flags: the experiment parameters, 0 leaves a filter out
+        - now: current time in seconds since the epoch for the overload filter, time.time() if None
+        - exit_port: drop exits whose exit policy rejects this port, no exit filter if None
+
+        Returns:
+        - a tuple of three row index arrays (entry, middle and exit)
+        """
+        mask = self.relay_mask(distance, flags)
+        if bandwidth:
+            kept = np.zeros(len(self.table), dtype=bool)
+            for order in self.bandwidth_order[distance != 0]:
+                left = mask[order]
+                # 1-based rank of each remaining relay among the remaining relays of the pool
+                rank = np.cumsum(left)
+                count = int(rank[-1]) if len(rank) else 0
+                kept[order[left & (rank <= _keep_count(count, bandwidth))]] = True
+            mask = kept
+        mask = mask & self.overload_mask(overload, now) & self.exit_port_mask(exit_port)
+        return tuple(pool[mask[pool]] for pool in self.pools)
+
+    def point(self, distance, bandwidth, overload, flags, now=None, exit_port=None):
+        """
+        Returns the pools, pool sizes and fingerprint sets of one point, see point_result().
+        """
+        return point_result(self.table, self.pools_for(distance, bandwidth, overload, flags, now, exit_port))
+
+    def grid(self, distances, bandwidths, overload=0, flags=0, now=None, exit_port=None):
+        """
+        Derives the pools of every (distance, bandwidth) point of a grid in one vectorized pass.
+
+        Args:
+        - distances, bandwidths: the values of the grid, 0 leaves a filter out
+        - overload, flags: the parameters shared by every point
+        - now: current time in seconds since the epoch for the overload filter, time.time() if None
+        - exit_port: drop exits whose exit policy rejects this port, no exit filter if None
+
+        Returns:
+        - a dictionary mapping (distance, bandwidth) to the point_result() of that point
+        """
+        distances = list(distances)
+        bandwidths = list(bandwidths)
+        size = len(self.table)
+
+        cutoffs = np.array([_keep_count(size, distance) for distance in distances], dtype=np.intp)
+        relay_masks = self.distance_rank[None, :] < cutoffs[:, None]
+        if flags:
+            relay_masks &= self.fast[None, :]
+        overload_mask = self.overload_mask(overload, now) & self.exit_port_mask(exit_port)
+
+        # pool_masks[i, j] is the mask of relays in a pool at (distances[i], bandwidths[j])
+        pool_masks = np.zeros((len(distances), len(bandwidths), size), dtype=bool)
+        for ties_by_distance in (False, True):
+            group = [i for i, distance in enumerate(distances) if (distance != 0) == ties_by_distance]
+            if not group:
+                continue
+            for order in self.bandwidth_order[ties_by_distance]:
+                left = relay_masks[group][:, order]
+                rank = np.cumsum(left, axis=1)
+                counts = rank[:, -1] if len(order) else np.zeros(len(group), dtype=np.intp)
+                keep = np.array(
+                    [[_keep_count(int(count), bandwidth) for bandwidth in bandwidths] for count in counts],
+                    dtype=np.intp,
+                ).reshape(len(group), len(bandwidths))
+                kept = left[:, None, :] & (rank[:, None, :] <= keep[:, :, None])
+                pool_masks[np.ix_(group, range(len(bandwidths)), order)] = kept & overload_mask[order]
+
+        results = {}
+        for i, distance in enumerate(distances):
+            for j, bandwidth in enumerate(bandwidths):
+                pools = tuple(pool[pool_masks[i, j, pool]] for pool in self.pools)
+                results[(distance, bandwidth)] = point_result(self.table, pools)
+        return results
+
+    def overload_sweep(self, overloads, distance=0, bandwidth=0, flags=0, now=None, exit_port=None):
+        """
+        Counts the relays left in each pool for a list of overload horizons at once. The overload
+        filter runs last, so the pools before it are built once and counted with the overload index.
+
+        Args:
+        - overloads: the overload horizons in hours
+        - distance, bandwidth, flags: the parameters shared by every point
+        - now: current time in seconds since the epoch, time.time() if None
+        - exit_port: drop exits whose exit policy rejects this port, no exit filter if None
+
+        Returns:
+        - a dictionary mapping each horizon to the size of each pool, keyed by pool name
+        """
+        pools = self.pools_for(distance, bandwidth, 0, flags, exit_port=exit_port)
+        counts = [self.overload_index.counts(overloads, pool, now) for pool in pools]
+        return {
+            overload: {name: int(count[h]) for name, count in zip(POOLS, counts)}
+            for h, overload in enumerate(overloads)
+        }
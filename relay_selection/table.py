@@ -0,0 +1,393 @@
+"""
+Columnar relay table used by the relay selection pipeline.
+
+The relays from Onionoo are stored once in a RelayTable with one NumPy array per column. The
+entry, middle and exit pools are integer arrays of row indices into the table, so the filters
+below work on whole columns at once and never copy relay dictionaries.
+
+Each filter has the same name and semantics as the list based function the experiment scripts
+used before, including the stable ordering of sorted() for relays with equal values.
+"""
+import time
+
+import numpy as np
+
+from relay_selection.exit_policy import ExitPolicyIndex
+from relay_selection.flags import category_masks, encode_column, flag_mask
+from relay_selection.geo import haversine_distance
+from relay_selection.geoip import get_geoip_cache
+
+# --------------------- Constants ---------------------#
+# Stored in the overload column for relays that have never reported an overload
+NO_OVERLOAD = np.iinfo(np.int64).min
+
+
+def get_ipv4_address(relay):
+    """
+    Returns the last IPv4 address in a relay's or_addresses without the port, or None.
+
+    This is the address filter_out_ipv6() stores as "ipv4_address" in the experiment scripts.
+    """
+    ipv4_address = None
+    for address in relay.get("or_addresses", []):
+        if "." in address:
+            ipv4_address = address.split(":")[0]
+    return ipv4_address
+
+
+class RelayTable:
+    """
+    Relays stored as NumPy columns, one row per relay.
+
+    Columns:
+    - fingerprint: relay fingerprints (object array of str)
+    - ipv4_address: IPv4 address of each relay, None if it has none (object array)
+    - latitude, longitude: location of the relay, NaN until get_lat_long() has found it
+    - distance: distance from the client in kilometers, inf until calc_distance() has set it
+    - observed_bandwidth, consensus_weight: as reported by Onionoo (int64)
+    - overload: overload_general_timestamp in milliseconds, NO_OVERLOAD if never overloaded
+    - flags: bitmask of the relay's flags, encoded once when the table is built, see flags.FLAG_BITS
+
+    The relay records the table was built from are kept in records, and index maps
+    fingerprints to rows. Exit policies stay in the records, see exit_policies().
+
+    Args:
+    - relays: a list of relays, where each relay is a dictionary returned from Tor Metrics
+    (https://metrics.torproject.org/onionoo.html)
+    """
+
+    def __init__(self, relays):
+        self.records = list(relays)
+        size = len(self.records)
+
+        self.fingerprint = np.array([relay["fingerprint"] for relay in self.records], dtype=object)
+        self.ipv4_address = np.array([get_ipv4_address(relay) for relay in self.records], dtype=object)
+        self.latitude = np.full(size, np.nan)
+        self.longitude = np.full(size, np.nan)
+        self.distance = np.full(size, np.inf)
+        self.observed_bandwidth = np.fromiter(
+            (relay.get("observed_bandwidth", 0) for relay in self.records), dtype=np.int64, count=size
+        )
+        self.consensus_weight = np.fromiter(
+            (relay.get("consensus_weight", 0) for relay in self.records), dtype=np.int64, count=size
+        )
+        self.overload = np.fromiter(
+            (relay.get("overload_general_timestamp", NO_OVERLOAD) for relay in self.records),
+            dtype=np.int64,
+            count=size,
+        )
+        self.flags = encode_column(relay.get("flags", ()) for relay in self.records)
+
+        self.index = {fingerprint: row for row, fingerprint in enumerate(self.fingerprint)}
+        self._exit_policies = None
+
+    def __len__(self):
+        return len(self.records)
+
+    def all_rows(self):
+        """
+        Returns the row indices of every relay in the table.
+        """
+        return np.arange(len(self), dtype=np.intp)
+
+    def rows_for(self, fingerprints):
+        """
+        Returns the row indices of the given fingerprints, unknown fingerprints are skipped.
+        """
+        rows = [self.index[fingerprint] for fingerprint in fingerprints if fingerprint in self.index]
+        return np.array(rows, dtype=np.intp)
+
+    def has_flag(self, flag, rows=None):
+        """
+        Returns a boolean mask telling which relays have a flag.
+
+        Args:
+        - flag: the flag name, e.g. "Guard"
+        - rows: row indices to test, all relays if None
+        """
+        return self.match_flags(required=(flag,), rows=rows)
+
+    def match_flags(self, required=(), forbidden=(), rows=None):
+        """
+        Returns a boolean mask telling which relays have all the required flags and none of the
+        forbidden ones, see flags.flag_mask().
+
+        Args:
+        - required: flag names a relay must have
+        - forbidden: flag names a relay must not have
+        - rows: row indices to test, all relays if None
+        """
+        flags = self.flags if rows is None else self.flags[rows]
+        return flag_mask(flags, required, forbidden)
+
+    def exit_policies(self):
+        """
+        Returns the ExitPolicyIndex of the relays' exit policies, compiled on first use.
+        """
+        if self._exit_policies is None:
+            self._exit_policies = ExitPolicyIndex(self.records)
+        return self._exit_policies
+
+    def columns(self):
+        """
+        Returns the columns of the table as a dictionary of NumPy arrays, keyed by column name.
+        """
+        return {
+            "fingerprint": self.fingerprint,
+            "ipv4_address": self.ipv4_address,
+            "latitude": self.latitude,
+            "longitude": self.longitude,
+            "distance": self.distance,
+            "observed_bandwidth": self.observed_bandwidth,
+            "consensus_weight": self.consensus_weight,
+            "overload": self.overload,
+            "flags": self.flags,
+        }
+
+    def fingerprints(self, rows):
+        """
+        Returns the fingerprints of the given rows as a list of str.
+        """
+        return self.fingerprint[rows].tolist()
+
+    def to_relays(self, rows):
+        """
+        Rebuilds relay dictionaries for the given rows, in the format the experiment scripts
+        used to save, i.e. the Onionoo fields plus ipv4_address, latitude, longitude and distance.
+        """
+        relays = []
+        for row in rows:
+            relay = dict(self.records[row])
+            if self.ipv4_address[row] is not None:
+                relay["ipv4_address"] = self.ipv4_address[row]
+            if not np.isnan(self.latitude[row]):
+                relay["latitude"] = float(self.latitude[row])
+                relay["longitude"] = float(self.longitude[row])
+            relay["distance"] = float(self.distance[row])
+            relays.append(relay)
+        return relays
+
+
+# --------------------- Table-native filters ---------------------#
+def _first_k(rows, key, k, tiebreak=None):
+    """
+    Returns the k rows a stable sort by key (then tiebreak) would put first, in their order in
+    rows. Only the rows tied with the k-th smallest key are sorted.
+    """
+    if k >= len(rows):
+        return rows
+    if k <= 0:
+        return rows[:0]
+    kth = np.partition(key, k - 1)[k - 1]
+    keep = key < kth
+    tied = np.flatnonzero(key == kth)
+    if tiebreak is not None:
+        tied = tied[np.argsort(tiebreak[tied], kind="stable")]
+    keep[tied[: k - np.count_nonzero(keep)]] = True
+    return rows[keep]
+
+
+def get_lat_long(table, database, rows=None):
+    """
+    Looks up the latitude and longitude of each relay's IPv4 address in a MaxMind GeoLite database
+    and stores them in the table. Lookups go through the persistent GeoIP cache, so only addresses
+    that have not been seen with this database before are looked up in it.
+
+    Args:
+    - table: a RelayTable
+    - database: path to the GeoLite2 City mmdb file
+    - rows: row indices to look up, all relays if None
+    """
+    if rows is None:
+        rows = table.all_rows()
+    if len(rows) == 0:
+        return
+
+    cache = get_geoip_cache(database)
+    latitude, longitude, _, _ = cache.lookup_many(table.ipv4_address[rows])
+    table.latitude[rows] = latitude
+    table.longitude[rows] = longitude
+    cache.save()
+
+
+def calc_distance(table, client_lat, client_long, rows=None):
+    """
+    Calculates the haversine distance in kilometers between the client and every relay.
+    Relays without a location get an infinite distance.
+
+    Args:
+    - table: a RelayTable
+    - client_lat, client_long: the client location in degrees
+    - rows: row indices to calculate the distance for, all relays if None
+    """
+    if rows is None:
+        rows = table.all_rows()
+
+    table.distance[rows] = haversine_distance(
+        table.latitude[rows], table.longitude[rows], client_lat, client_long
+    )
+
+
+def sort_relay_distances(table, rows):
+    """
+    Sorts rows by their relay's distance from the client, closest first.
+    """
+    return rows[np.argsort(table.distance[rows], kind="stable")]
+
+
+def filter_out_high_distance_relays(rows, distance_threshold):
+    """
+    Drops the distance_threshold share of relays at the end of rows sorted by distance.
+    """
+    cutoff = int(len(rows) * (1 - distance_threshold))
+    return rows[:cutoff]
+
+
+def select_closest_relays(table, rows, distance_threshold, ordered=False):
+    """
+    Keeps the same relays as sort_relay_distances() followed by filter_out_high_distance_relays(),
+    but selects them with a partial sort in O(n). Relays at the same distance as the last kept
+    relay are kept in the order they have in rows, like the stable sort does.
+
+    Args:
+    - table: a RelayTable
+    - rows: row indices of the relays to filter
+    - distance_threshold: the share of relays furthest away from the client to drop
+    - ordered: sort the kept rows by distance, otherwise they keep their order in rows
+
+    Returns:
+    - the row indices of the kept relays
+    """
+    cutoff = int(len(rows) * (1 - distance_threshold))
+    kept = _first_k(rows, table.distance[rows], cutoff)
+    if ordered:
+        kept = sort_relay_distances(table, kept)
+    return kept
+
+
+def filter_based_on_flags(table, rows):
+    """
+    Keeps the rows whose relay has the 'Fast' flag.
+    """
+    return rows[table.has_flag("Fast", rows)]
+
+
+def categorize_relays(table, rows):
+    """
+    Splits rows into entry, middle and exit pools based on their relay's flags. Relays with the
+    'Guard' flag are entries, relays with 'Exit' and not 'Guard' are exits, the rest are middles.
+
+    Returns:
+    - a tuple of three row index arrays (entry, middle and exit)
+    """
+    entry, middle, exit = category_masks(table.flags[rows])
+    return rows[entry], rows[middle], rows[exit]
+
+
+def sort_relays_by_bandwidth(table, entry_pool, middle_pool, exit_pool):
+    """
+    Sorts the rows in each pool by their relay's observed bandwidth, highest first.
+    """
+
+    def sort_pool(pool):
+        return pool[np.argsort(-table.observed_bandwidth[pool], kind="stable")]
+
+    return sort_pool(entry_pool), sort_pool(middle_pool), sort_pool(exit_pool)
+
+
+def filter_out_low_bandwidth_relays(entry_pool, middle_pool, exit_pool, relay_bandwidth_cutoff):
+    """
+    Drops the relay_bandwidth_cutoff share of relays at the end of each pool sorted by bandwidth.
+    """
+
+    def apply_cutoff(pool, cutoff):
+        cutoff_index = int(len(pool) * (1 - cutoff))
+        return pool[:cutoff_index]
+
+    return (
+        apply_cutoff(entry_pool, relay_bandwidth_cutoff),
+        apply_cutoff(middle_pool, relay_bandwidth_cutoff),
+        apply_cutoff(exit_pool, relay_bandwidth_cutoff),
+    )
+
+
+def select_high_bandwidth_relays(
+    table, entry_pool, middle_pool, exit_pool, relay_bandwidth_cutoff, ties_by_distance=False, ordered=False
+):
+    """
+    Keeps the same relays as sort_relays_by_bandwidth() followed by
+    filter_out_low_bandwidth_relays(), but selects them with a partial sort in O(n).
+
+    The sorted pools kept relays with equal bandwidth in the order they were in before. When
+    the pools came from sort_relay_distances() that order is by distance, so pass
+    ties_by_distance=True if the rows were selected with select_closest_relays() instead.
+
+    Args:
+    - table: a RelayTable
+    - entry_pool, middle_pool, exit_pool: row index arrays
+    - relay_bandwidth_cutoff: the share of relays with the lowest bandwidth to drop from each pool
+    - ties_by_distance: break bandwidth ties by distance before the order of the pool
+    - ordered: sort the kept rows by bandwidth, otherwise they keep their order in the pool
+
+    Returns:
+    - a tuple of three row index arrays (entry, middle and exit)
+    """
+
+    def select_pool(pool):
+        cutoff = int(len(pool) * (1 - relay_bandwidth_cutoff))
+        key = -table.observed_bandwidth[pool]
+        tiebreak = table.distance[pool] if ties_by_distance else None
+        kept = _first_k(pool, key, cutoff, tiebreak)
+        if ordered:
+            key = -table.observed_bandwidth[kept]
+            if ties_by_distance:
+                kept = kept[np.lexsort((table.distance[kept], key))]
+            else:
+                kept = kept[np.argsort(key, kind="stable")]
+        return kept
+
+    return select_pool(entry_pool), select_pool(middle_pool), select_pool(exit_pool)
+
+
+def exit_port_mask(table, port):
+    """
+    Returns a boolean mask that is False for the exit relays (see categorize_relays()) whose exit
+    policy rejects port, and True for every other relay.
+    """
+    _, _, exit = category_masks(table.flags)
+    return ~exit | table.exit_policies().allows_port(port)
+
+
+def overload_threshold(overload, now=None):
+    """
+    Returns the latest overload_general_timestamp (in milliseconds) a relay may have to pass the
+    overload filter, i.e. overload hours before now.
+    """
+    if now is None:
+        now = time.time()
+    return int(round((now - overload * 60 * 60) * 1000))
+
+
+def filter_by_overload_general_timestamp(table, entry_pool, middle_pool, exit_pool, overload, now=None):
+    """
+    Drops the relays in each pool that reported an overload within the last overload hours.
+
+    Args:
+    - table: a RelayTable
+    - entry_pool, middle_pool, exit_pool: row index arrays
+    - overload: number of hours to filter out recent overload_general_timestamps
+    - now: current time in seconds since the epoch, time.time() if None
+
+    Returns:
+    - a tuple of three row index arrays (entry, middle and exit)
+    """
+    time_filter = overload_threshold(overload, now)
+
+    def filter_pool_overload(pool):
+        return pool[table.overload[pool] <= time_filter]
+
+    return (
+        filter_pool_overload(entry_pool),
+        filter_pool_overload(middle_pool),
+        filter_pool_overload(exit_pool),
+    )
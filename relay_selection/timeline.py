@@ -0,0 +1,128 @@
+"""
+Per-hop circuit build timelines from Tor's CIRC events.
+
+Tor reports a circuit as LAUNCHED, then EXTENDED once per hop with the path built so far, then
+BUILT, or FAILED and CLOSED with a reason. CircuitTimeline records when each of these events
+arrived, so the build time of a circuit splits into the time each hop took to extend: the
+guard's from LAUNCHED to the first EXTENDED, the middle's to the second and the exit's to the
+third. A failed build also records the hop it failed at, so slow and failing builds can be
+attributed to a guard, middle or exit relay.
+"""
+import threading
+import time
+
+from stem import CircStatus
+from stem.control import EventType
+
+# --------------------- Constants ---------------------#
+# Position of each hop of a three hop circuit
+HOP_POSITIONS = ("guard", "middle", "exit")
+
+
+def hop_position(index):
+    """
+    Returns the position name of the hop at index of a circuit, e.g. "guard" for 0.
+    """
+    return HOP_POSITIONS[index] if index < len(HOP_POSITIONS) else f"hop {index + 1}"
+
+
+def _arrival(event):
+    # Time the event was read from the control socket, not when the listener got to it
+    return getattr(event, "arrived_at", None) or time.time()
+
+
+class CircuitTimeline:
+    """
+    Records the CIRC events of every circuit the Tor client builds.
+
+    Args:
+    - controller: an authenticated stem Controller
+
+    Attributes:
+    - timelines: circuit ID -> dictionary with the "launched", "built" and "closed" event times,
+    the final "status" and "reason", and the fingerprint and "extended" time of each hop in "hops"
+    """
+
+    def __init__(self, controller):
+        self.controller = controller
+        self.timelines = {}
+        self._lock = threading.Lock()
+        controller.add_event_listener(self._circuit_event, EventType.CIRC)
+
+    def _circuit_event(self, event):
+        arrived_at = _arrival(event)
+        with self._lock:
+            timeline = self.timelines.get(event.id)
+            if timeline is None or event.status == CircStatus.LAUNCHED:
+                timeline = self.timelines[event.id] = {
+                    "launched": arrived_at if event.status == CircStatus.LAUNCHED else None,
+                    "built": None,
+                    "closed": None,
+                    "status": None,
+                    "reason": None,
+                    "hops": [],
+                }
+
+            hops = timeline["hops"]
+            if event.status in (CircStatus.EXTENDED, CircStatus.BUILT):
+                for fingerprint, nickname in (event.path or ())[len(hops):]:
+                    hops.append({"fingerprint": fingerprint, "extended": arrived_at})
+
+            if event.status in (CircStatus.FAILED, CircStatus.CLOSED):
+                timeline["closed"] = arrived_at
+                # A CLOSED event follows FAILED, the failure is what is kept
+                if timeline["status"] != "FAILED":
+                    timeline["status"] = str(event.status)
+                    reason = event.remote_reason or event.reason
+                    timeline["reason"] = str(reason) if reason is not None else None
+            else:
+                timeline["status"] = str(event.status)
+                if event.status == CircStatus.BUILT:
+                    timeline["built"] = arrived_at
+
+    def record(self, circuit_id):
+        """
+        Returns the build timeline of one circuit as it is stored in the result records.
+
+        Returns:
+        - a dictionary with the "status" and "reason" of the circuit, its "build_time" in seconds,
+        the position, fingerprint and extend "latency" in seconds of each hop in "hops", and the
+        position of the hop a failed circuit did not get past in "failed_hop". None if no CIRC
+        event of the circuit was seen.
+        """
+        with self._lock:
+            timeline = self.timelines.get(circuit_id)
+            if timeline is None:
+                return None
+            hops = [dict(hop) for hop in timeline["hops"]]
+            launched, built, status, reason = (
+                timeline["launched"], timeline["built"], timeline["status"], timeline["reason"]
+            )
+
+        previous = launched
+        for position, hop in enumerate(hops):
+            hop["position"] = hop_position(position)
+            hop["latency"] = hop["extended"] - previous if previous is not None else None
+            previous = hop.pop("extended")
+
+        return {
+            "status": status,
+            "reason": reason,
+            "build_time": built - launched if built is not None and launched is not None else None,
+            "hops": hops,
+            "failed_hop": hop_position(len(hops)) if status == "FAILED" else None,
+        }
+
+    def records(self):
+        """
+        Returns the record() of every circuit seen, keyed by circuit ID.
+        """
+        with self._lock:
+            circuit_ids = list(self.timelines)
+        return {circuit_id: self.record(circuit_id) for circuit_id in circuit_ids}
+
+    def close(self):
+        """
+        Stops listening for CIRC events, the timelines recorded so far are kept.
+        """
+        self.controller.remove_event_listener(self._circuit_event)
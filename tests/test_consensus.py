@@ -0,0 +1,75 @@
+"""
+Tests for relay_selection/consensus.py against a small fixture of Tor's DataDirectory.
+
+tests/fixtures/consensus holds a microdescriptor consensus with three running relays and one
+that is not running, their microdescriptors and server descriptors, and the Onionoo details
+document of the same relays. Run with python -m pytest tests
+"""
+import os
+import sys
+
+import pytest
+
+# Shared relay selection helpers in the repository root
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from relay_selection.consensus import read_bandwidth_weights, read_cached_relays
+from relay_selection.onionoo import iter_relays
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures", "consensus")
+CONSENSUS = os.path.join(FIXTURES, "cached-microdesc-consensus")
+MICRODESCRIPTORS = os.path.join(FIXTURES, "cached-microdescs")
+
+
+def onionoo_relays():
+    with open(os.path.join(FIXTURES, "onionoo_details.json"), "r") as infile:
+        return list(iter_relays(infile))
+
+
+def test_relays_match_onionoo():
+    assert read_cached_relays(FIXTURES) == onionoo_relays()
+
+
+def test_running_only():
+    relays = read_cached_relays(FIXTURES, running_only=False)
+    assert len(relays) == 4
+    assert "Running" not in relays[-1]["flags"]
+
+
+def test_without_server_descriptors():
+    relays = read_cached_relays(
+        consensus_path=CONSENSUS, microdescriptor_paths=[MICRODESCRIPTORS], server_descriptor_paths=[]
+    )
+    expected = onionoo_relays()
+    for relay, onionoo in zip(relays, expected):
+        # Observed bandwidth is estimated from the consensus weight, overload is unknown
+        assert relay["observed_bandwidth"] == relay["consensus_weight"] * 1000
+        assert "overload_general_timestamp" not in relay
+        # Exit policies and families come from the microdescriptors
+        assert relay["exit_policy"] == onionoo["exit_policy"]
+        assert relay["effective_family"] == onionoo["effective_family"]
+
+
+def test_missing_microdescriptors_fail():
+    with pytest.raises(FileNotFoundError):
+        read_cached_relays(consensus_path=CONSENSUS, microdescriptor_paths=[], server_descriptor_paths=[])
+
+
+def test_outdated_microdescriptors_warn(tmp_path, capsys):
+    # Keep the microdescriptors of the guard and middle relay, the exit's is missing
+    with open(MICRODESCRIPTORS, "r") as infile:
+        microdescriptors = infile.read().split("onion-key\n")[1:]
+    partial = tmp_path / "cached-microdescs"
+    partial.write_text("".join("onion-key\n" + microdescriptor for microdescriptor in microdescriptors[:2]))
+
+    relays = read_cached_relays(
+        consensus_path=CONSENSUS, microdescriptor_paths=[str(partial)], server_descriptor_paths=[]
+    )
+    assert relays[2]["exit_policy"] == ("reject *:*",)
+    assert "WARNING: 1 of 3 relays have no microdescriptor" in capsys.readouterr().out
+
+
+def test_bandwidth_weights():
+    weights = read_bandwidth_weights(FIXTURES)
+    assert weights["Wgg"] == 5899
+    assert weights["Wmg"] == 4101
+    assert weights["Wee"] == 10000
@@ -0,0 +1,75 @@
+"""
+Tests for relay_selection/exit_policy.py: compiling exit policies and matching ports.
+
+Run with python -m pytest tests
+"""
+import os
+import sys
+
+import numpy as np
+from stem.exit_policy import MicroExitPolicy
+
+# Shared relay selection helpers in the repository root
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from relay_selection.consensus import exit_policy_rules
+from relay_selection.exit_policy import ExitPolicyIndex, compile_policy, policy_allows, url_port
+
+
+def allowed_ports(rules, ports):
+    compiled = compile_policy(rules)
+    return [port for port in ports if policy_allows(compiled, port)]
+
+
+def test_accept_and_reject_ranges():
+    assert compile_policy(["accept *:80-443", "accept *:8080", "reject *:*"]) == ([80, 8080], [443, 8080])
+    assert compile_policy(["reject *:1-1023", "accept *:*"]) == ([1024], [65535])
+
+
+def test_first_match_wins():
+    # The reject of port 25 comes first, so the accept range does not reopen it
+    rules = ["reject *:25", "accept *:20-30", "reject *:*"]
+    assert compile_policy(rules) == ([20, 26], [24, 30])
+    assert allowed_ports(rules, [19, 20, 24, 25, 26, 30, 31]) == [20, 24, 26, 30]
+    # A later reject does not close ports an earlier accept opened
+    assert allowed_ports(["accept *:443", "reject *:400-500", "accept *:*"], [399, 443, 444, 501]) == [399, 443, 501]
+
+
+def test_reject_all():
+    assert compile_policy(["reject *:*"]) == ([], [])
+    assert compile_policy(["reject *:*", "accept *:80"]) == ([], [])
+    # Ports no rule covers are rejected
+    assert compile_policy([]) == ([], [])
+    assert allowed_ports(["accept *:80"], [79, 80, 81]) == [80]
+
+
+def test_address_specific_rules_are_skipped():
+    rules = ["reject 10.0.0.0/8:*", "reject 192.168.1.1:80", "accept [::]/0:22", "accept *:80", "reject *:*"]
+    assert compile_policy(rules) == ([80], [80])
+    assert compile_policy(["accept *4:443", "accept 0.0.0.0/0:80", "reject *:*"]) == ([80, 443], [80, 443])
+
+
+def test_consensus_summaries():
+    accept = exit_policy_rules(MicroExitPolicy("accept 80,443,6660-6669"))
+    assert allowed_ports(accept, [22, 80, 443, 6660, 6669, 6670]) == [80, 443, 6660, 6669]
+    reject = exit_policy_rules(MicroExitPolicy("reject 1-24,26-79"))
+    assert allowed_ports(reject, [1, 24, 25, 79, 80, 65535]) == [25, 80, 65535]
+    assert allowed_ports(exit_policy_rules(None), [80, 443]) == []
+
+
+def test_index_allows_port():
+    web = ["accept *:80", "accept *:443", "reject *:*"]
+    records = [
+        {"fingerprint": "A", "exit_policy": web},
+        {"fingerprint": "B", "exit_policy": ["reject *:25", "accept *:*"]},
+        {"fingerprint": "C", "exit_policy": list(web)},
+        {"fingerprint": "D"},
+    ]
+    index = ExitPolicyIndex(records)
+    # A and C share one compiled policy
+    assert len(index.policies) == 3
+    assert index.policy[0] == index.policy[2]
+
+    np.testing.assert_array_equal(index.allows_port(url_port("https://example.com/")), [True, True, True, False])
+    np.testing.assert_array_equal(index.allows_port(25), [False, False, False, False])
+    np.testing.assert_array_equal(index.allows_port(8080), [False, True, False, False])
+    np.testing.assert_array_equal(index.allows_port(80, rows=np.array([3, 1])), [False, True])
@@ -0,0 +1,214 @@
+"""
+Regression tests comparing the table-based relay filters with the list based filters the
+experiment scripts used before.
+
+The reference functions below are the list based filters of the baseline experiment scripts, with
+now passed in instead of read from time.time(). The relays have many equal distances and
+bandwidths, relays without a location (infinite distance) and relays that never reported an
+overload, so the tests cover which tied relays the cut-offs keep. Run with python -m pytest tests
+"""
+import datetime
+import os
+import sys
+
+import numpy as np
+import pytest
+
+# Shared relay selection helpers in the repository root
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from relay_selection.overload import OverloadIndex
+from relay_selection.pipeline import FilterPipeline
+from relay_selection.sweep import SweepEngine
+from relay_selection.table import RelayTable, _first_k
+
+NOW = 1700000000.0
+DISTANCES = [0, 0.1, 0.25, 0.5, 0.9]
+BANDWIDTHS = [0, 0.1, 0.3, 0.5, 0.75]
+OVERLOADS = [0, 1, 24, 72]
+
+
+# --------------------- Baseline list filters ---------------------#
+def sort_relay_distances(relays):
+    return sorted(relays, key=lambda relay: relay.get("distance", float("inf")))
+
+
+def filter_out_high_distance_relays(relays, distance_threshold):
+    cutoff = int(len(relays) * (1 - distance_threshold))
+    return relays[:cutoff]
+
+
+def filter_based_on_flags(relays):
+    return [relay for relay in relays if "Fast" in relay.get("flags", [])]
+
+
+def categorize_relays(relays):
+    entry_pool, middle_pool, exit_pool = [], [], []
+    for relay in relays:
+        flags = relay.get("flags", [])
+        if "Guard" in flags:
+            entry_pool.append(relay)
+        elif "Exit" in flags:
+            exit_pool.append(relay)
+        else:
+            middle_pool.append(relay)
+    return entry_pool, middle_pool, exit_pool
+
+
+def sort_relays_by_bandwidth(*pools):
+    return tuple(sorted(pool, key=lambda relay: relay["observed_bandwidth"], reverse=True) for pool in pools)
+
+
+def filter_out_low_bandwidth_relays(entry_pool, middle_pool, exit_pool, relay_bandwidth_cutoff):
+    def apply_cutoff(pool, cutoff):
+        return pool[: int(len(pool) * (1 - cutoff))]
+
+    return tuple(apply_cutoff(pool, relay_bandwidth_cutoff) for pool in (entry_pool, middle_pool, exit_pool))
+
+
+def filter_by_overload_general_timestamp(entry_pool, middle_pool, exit_pool, overload, now):
+    def filter_pool_overload(pool):
+        filtered_pool = []
+        for relay in pool:
+            if "overload_general_timestamp" in relay:
+                current_time = datetime.datetime.fromtimestamp(now, datetime.timezone.utc)
+                X_hour_ago = current_time - datetime.timedelta(hours=overload)
+                time_filter = int(round(X_hour_ago.timestamp() * 1000))
+                if relay["overload_general_timestamp"] <= time_filter:
+                    filtered_pool.append(relay)
+            else:
+                filtered_pool.append(relay)
+        return filtered_pool
+
+    return tuple(filter_pool_overload(pool) for pool in (entry_pool, middle_pool, exit_pool))
+
+
+def baseline_pools(relays, distance, bandwidth, overload, flags, now=NOW):
+    # The filter order of experiment() in the baseline scripts
+    if distance != 0:
+        relays = sort_relay_distances(relays)
+        relays = filter_out_high_distance_relays(relays, distance)
+    if flags != 0:
+        relays = filter_based_on_flags(relays)
+    pools = categorize_relays(relays)
+    if bandwidth != 0:
+        pools = sort_relays_by_bandwidth(*pools)
+        pools = filter_out_low_bandwidth_relays(*pools, bandwidth)
+    if overload != 0:
+        pools = filter_by_overload_general_timestamp(*pools, overload, now)
+    return tuple(sorted(relay["fingerprint"] for relay in pool) for pool in pools)
+
+
+# --------------------- Fixtures ---------------------#
+def make_relays(count=400, seed=3):
+    rng = np.random.default_rng(seed)
+    relays = []
+    for row in range(count):
+        flags = ["Running", "Valid"]
+        flags += [flag for flag in ("Guard", "Exit", "Fast") if rng.random() < 0.5]
+        relay = {
+            "fingerprint": f"{row:040X}",
+            "flags": flags,
+            # Few distinct values, so many relays tie at every cut-off
+            "observed_bandwidth": int(rng.choice([1000, 5000, 5000, 20000, 80000])),
+            "consensus_weight": 10,
+        }
+        if rng.random() < 0.1:
+            relay["distance"] = float("inf")
+        else:
+            relay["distance"] = float(rng.choice([100.0, 250.0, 250.0, 800.0, 1500.0]))
+        if rng.random() < 0.6:
+            # Some exactly at the threshold of a horizon
+            hours = rng.choice([0.5, 1, 12, 24, 48, 100])
+            relay["overload_general_timestamp"] = int(round((NOW - hours * 60 * 60) * 1000))
+        relays.append(relay)
+    return relays
+
+
+def make_table(relays):
+    table = RelayTable(relays)
+    table.distance[:] = [relay["distance"] for relay in relays]
+    return table
+
+
+def fingerprint_pools(table, pools):
+    return tuple(sorted(table.fingerprints(pool)) for pool in pools)
+
+
+@pytest.fixture(scope="module")
+def relays():
+    return make_relays()
+
+
+@pytest.fixture(scope="module")
+def table(relays):
+    return make_table(relays)
+
+
+# --------------------- Tests ---------------------#
+@pytest.mark.parametrize("flags", [0, 1])
+@pytest.mark.parametrize("overload", OVERLOADS)
+def test_pools_for_matches_baseline(relays, table, overload, flags):
+    engine = SweepEngine(table)
+    for distance in DISTANCES:
+        for bandwidth in BANDWIDTHS:
+            expected = baseline_pools(relays, distance, bandwidth, overload, flags)
+            pools = engine.pools_for(distance, bandwidth, overload, flags, now=NOW)
+            assert fingerprint_pools(table, pools) == expected, (distance, bandwidth)
+
+
+@pytest.mark.parametrize("flags", [0, 1])
+@pytest.mark.parametrize("overload", OVERLOADS)
+def test_grid_matches_baseline(relays, table, overload, flags):
+    results = SweepEngine(table).grid(DISTANCES, BANDWIDTHS, overload, flags, now=NOW)
+    for distance in DISTANCES:
+        for bandwidth in BANDWIDTHS:
+            expected = baseline_pools(relays, distance, bandwidth, overload, flags)
+            result = results[(distance, bandwidth)]
+            pools = (result["entry_pool"], result["middle_pool"], result["exit_pool"])
+            assert fingerprint_pools(table, pools) == expected, (distance, bandwidth)
+            assert list(result["sizes"].values()) == [len(pool) for pool in expected]
+
+
+@pytest.mark.parametrize("flags", [0, 1])
+def test_filter_pipeline_matches_baseline(relays, table, flags):
+    for distance in DISTANCES:
+        for bandwidth in BANDWIDTHS:
+            pipeline = FilterPipeline(table).distance(distance).fast_flag(flags).bandwidth(bandwidth)
+            pools = pipeline.overload(24, now=NOW).pools()
+            assert fingerprint_pools(table, pools) == baseline_pools(relays, distance, bandwidth, 24, flags)
+
+
+def test_overload_index_matches_baseline(relays, table):
+    index = OverloadIndex(table)
+    horizons = [0.5, 1, 12, 24, 48, 100, 1000]
+    masks = index.masks(horizons, now=NOW)
+    pools = categorize_relays(relays)
+    entry_rows = table.rows_for(relay["fingerprint"] for relay in pools[0])
+    entry_counts = index.counts(horizons, entry_rows, now=NOW)
+    for h, horizon in enumerate(horizons):
+        expected = filter_by_overload_general_timestamp(relays, [], [], horizon, NOW)[0]
+        assert table.fingerprints(np.flatnonzero(masks[h])) == [relay["fingerprint"] for relay in expected]
+        assert index.passing([horizon], now=NOW)[0] == len(expected)
+        expected_entries = filter_by_overload_general_timestamp(*pools, horizon, NOW)[0]
+        assert entry_counts[h] == len(expected_entries)
+
+    # Relays that never reported an overload pass every horizon
+    never = np.array(["overload_general_timestamp" not in relay for relay in relays])
+    assert masks[:, never].all()
+
+
+def test_first_k_matches_stable_sort():
+    rng = np.random.default_rng(5)
+    rows = rng.permutation(60).astype(np.intp)
+    key = rng.choice([1.0, 2.0, 2.0, 3.0, np.inf], len(rows))
+    tiebreak = rng.choice([10.0, 20.0, np.inf], len(rows))
+    for k in range(-1, len(rows) + 2):
+        kept = _first_k(rows, key, k)
+        expected = rows[np.argsort(key, kind="stable")][: max(k, 0)]
+        assert sorted(kept) == sorted(expected)
+        # The kept rows stay in their order in rows
+        assert list(kept) == [row for row in rows if row in set(expected)]
+
+        kept = _first_k(rows, key, k, tiebreak)
+        expected = rows[np.lexsort((tiebreak, key))][: max(k, 0)]
+        assert sorted(kept) == sorted(expected)
@@ -0,0 +1,35 @@
+"""
+Tests for relay_selection/flags.py. Run with python -m pytest tests
+"""
+import os
+import sys
+
+import numpy as np
+import pytest
+
+# Shared relay selection helpers in the repository root
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from relay_selection.flags import category_masks, decode_flags, encode_column, encode_flags, flag_mask
+
+
+def test_encode_ignores_unknown_flags():
+    assert encode_flags(["Fast", "Unknown"]) == encode_flags(["Fast"])
+    assert decode_flags(encode_flags(["Valid", "Guard", "Unknown"])) == ["Guard", "Valid"]
+
+
+def test_flag_mask():
+    flags = encode_column([["Guard", "Fast"], ["Exit"], ["Exit", "BadExit"], []])
+    np.testing.assert_array_equal(flag_mask(flags, required=("Fast",)), [True, False, False, False])
+    np.testing.assert_array_equal(flag_mask(flags, ("Exit",), ("BadExit",)), [False, True, False, False])
+    entry, middle, exit = category_masks(flags)
+    np.testing.assert_array_equal(entry, [True, False, False, False])
+    np.testing.assert_array_equal(exit, [False, True, True, False])
+    np.testing.assert_array_equal(middle, [False, False, False, True])
+
+
+def test_flag_mask_rejects_unknown_flags():
+    flags = encode_column([["Fast"]])
+    with pytest.raises(ValueError):
+        flag_mask(flags, required=("Fats",))
+    with pytest.raises(ValueError):
+        flag_mask(flags, forbidden=("BadExit", "Bad Exit"))
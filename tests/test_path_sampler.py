@@ -0,0 +1,116 @@
+"""
+Tests for relay_selection/path_sampler.py on a small hand-made RelayTable.
+
+The relays share families and /16 networks in ways the sampler must exclude from a path. Run with
+python -m pytest tests
+"""
+import os
+import sys
+
+import numpy as np
+import pytest
+
+# Shared relay selection helpers in the repository root
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from relay_selection.path_sampler import AliasTable, PathSampler, family_ids, subnet_ids
+from relay_selection.table import RelayTable
+
+
+def relay(fingerprint, address, flags=(), consensus_weight=100, family=()):
+    or_addresses = [f"{address}:9001"] if address is not None else ["[2001:db8::1]:9001"]
+    return {
+        "fingerprint": fingerprint,
+        "or_addresses": or_addresses,
+        "flags": ["Running", "Valid", *flags],
+        "consensus_weight": consensus_weight,
+        "effective_family": [f"${member}" for member in family],
+    }
+
+
+def test_alias_table_frequencies():
+    weights = np.array([1, 2, 3, 0, 4], dtype=float)
+    draws = AliasTable(weights).draw(np.random.default_rng(7), 200000)
+    frequencies = np.bincount(draws, minlength=len(weights)) / len(draws)
+    assert frequencies[3] == 0
+    np.testing.assert_allclose(frequencies, weights / weights.sum(), atol=0.005)
+
+
+def test_alias_table_needs_positive_weight():
+    with pytest.raises(ValueError):
+        AliasTable([0, 0])
+    with pytest.raises(ValueError):
+        AliasTable([])
+
+
+def test_family_ids_are_transitive():
+    # A lists B and B lists C, so A and C share a family although neither lists the other
+    table = RelayTable([
+        relay("A", "10.0.0.1", family=("B",)),
+        relay("B", "10.1.0.1", family=("C",)),
+        relay("C", "10.2.0.1"),
+        relay("D", "10.3.0.1", family=("UNKNOWN",)),
+        relay("E", "10.4.0.1"),
+    ])
+    families = family_ids(table)
+    assert families[0] == families[1] == families[2]
+    assert len({families[0], families[3], families[4]}) == 3
+
+
+def test_subnet_ids():
+    table = RelayTable([
+        relay("A", "10.0.1.1"),
+        relay("B", "10.0.200.7"),
+        relay("C", "10.1.0.1"),
+        relay("D", None),
+        relay("E", None),
+    ])
+    subnets = subnet_ids(table)
+    assert subnets[0] == subnets[1]
+    assert subnets[0] != subnets[2]
+    # Relays without an IPv4 address never share a network
+    assert subnets[3] < 0 and subnets[4] < 0
+    assert subnets[3] != subnets[4]
+
+
+def sampler_table():
+    return RelayTable([
+        relay("G1", "10.0.1.1", flags=("Guard",), consensus_weight=500, family=("E1",)),
+        relay("G2", "10.0.2.1", flags=("Guard",), consensus_weight=300),
+        relay("G3", "10.1.0.1", flags=("Guard",), consensus_weight=200),
+        relay("M1", "10.2.0.1", consensus_weight=400, family=("E2",)),
+        relay("M2", "10.1.5.5", consensus_weight=300),
+        relay("E1", "10.3.0.1", flags=("Exit",), consensus_weight=600),
+        relay("E2", "10.4.0.1", flags=("Exit",), consensus_weight=300, family=("M3",)),
+        relay("E3", None, flags=("Exit",), consensus_weight=100),
+        relay("M3", "10.3.9.9", consensus_weight=200),
+    ])
+
+
+def test_paths_avoid_families_and_subnets():
+    table = sampler_table()
+    entry_pool = table.rows_for(["G1", "G2", "G3"])
+    exit_pool = table.rows_for(["E1", "E2", "E3"])
+    sampler = PathSampler(table, entry_pool, table.all_rows(), exit_pool, seed=1)
+    families = family_ids(table)
+    subnets = subnet_ids(table)
+
+    paths = sampler.sample(20000)
+    assert paths.shape == (20000, 3)
+    for first, second in ((0, 1), (0, 2), (1, 2)):
+        assert not np.any(paths[:, first] == paths[:, second])
+        assert not np.any(families[paths[:, first]] == families[paths[:, second]])
+        assert not np.any(subnets[paths[:, first]] == subnets[paths[:, second]])
+
+
+def test_paths_are_fingerprints():
+    table = sampler_table()
+    sampler = PathSampler(table, table.rows_for(["G3"]), table.rows_for(["M1"]), table.rows_for(["E1"]), seed=1)
+    assert list(sampler.paths(3)) == [["G3", "M1", "E1"]] * 3
+
+
+def test_exhausted_pool_fails():
+    # G1 and E1 are in one family, so no path exists
+    table = sampler_table()
+    sampler = PathSampler(table, table.rows_for(["G1"]), table.rows_for(["M2"]), table.rows_for(["E1"]), seed=1)
+    with pytest.raises(ValueError):
+        sampler.sample(1)